@@ -0,0 +1,25 @@
+--
+-- MEA Lightweight Integration Environment
+--
+-- Staging table for the set-based item specification load (ISPS). Run once
+-- per target database as a user with rights on the MAXIMO schema, then grant
+-- the MEALIE load user access to it.
+--
+-- A global temporary table: each session sees only its own rows, and they are
+-- deleted at commit or rollback.
+--
+
+CREATE GLOBAL TEMPORARY TABLE maximo.hul_mealie_isp_stage (
+    itemnum VARCHAR2(100),
+    classid VARCHAR2(100),
+    assetattrid VARCHAR2(100),
+    alnvalue VARCHAR2(4000),
+    numvalue NUMBER,
+    assetsequence NUMBER,
+    measureunitid VARCHAR2(100),
+    transid NUMBER,
+    transseq NUMBER)
+ON COMMIT DELETE ROWS;
+
+-- Replace MEALIE_USER with the user that mealie connects to the target as
+-- GRANT SELECT, INSERT ON maximo.hul_mealie_isp_stage TO mealie_user;
@@ -7,25 +7,35 @@ Created on 24 Jul 2012
 #### Import Module
 
 import cx_Oracle
-import xlrd
 import sys
 import time
 
-processed_ic = []
+from sheets import open_sheet
+from connpool import connect_target
+
 2222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222
 #### Class Definitions
 
+# Columns of the source spreadsheet read by InterfaceAttrStructureFromXLS
+sheet_columns = [
+    ('attrseq', 4),
+    ('propident', 5),
+    ('propname', 6),
+    ('measurecode', 7),
+    ('data_type', 10)
+]
+
 class InterfaceAttrStructureFromXLS:
     
-    def __init__(self, worksheet, i, c, logger):
+    def __init__(self, row, c, logger):
         
         #self.classid = worksheet.cell(i, 0).value
         #self.classname = worksheet.cell(i, 1).value
-        self.attrseq = worksheet.cell(i, 4).value
-        self.propident = worksheet.cell(i, 5).value
-        self.propname = worksheet.cell(i, 6).value
-        self.measurecode = worksheet.cell(i, 7).value
-        self.data_type = worksheet.cell(i, 10).value
+        self.attrseq = row.attrseq
+        self.propident = row.propident
+        self.propname = row.propname
+        self.measurecode = row.measurecode
+        self.data_type = row.data_type
         #self.useinitemdesc = worksheet.cell(i, 11).value
         
         logger.debug("Getting classname for attribute %s" % (self.propident))
@@ -93,7 +103,8 @@ def write_mea_queue(c, txid, logger):
 
 def Attribute_handler(er):
     type_handler = {
-        "XLS": attribute_handler_xls_ora
+        "XLS": attribute_handler_xls_ora,
+        "CSV": attribute_handler_xls_ora
         }
     return type_handler.get(er.source_type)(er)
 
@@ -115,7 +126,7 @@ def attr_exists(conn, c, cls, attr, logger):
         retval = True
     return retval
 
-def process_classid(ia, c, logger):
+def process_classid(ia, c, processed_ic, logger):
     
     q_write_interface = """
     INSERT INTO maximo.mxattribute_iface(
@@ -158,7 +169,7 @@ def process_classid(ia, c, logger):
                                      transid=trans_id, 
                                      transseq=trans_seq)
         logger.debug("Wrote interface")
-        processed_ic.append(ia.propident)        # We processed it, remember it
+        processed_ic.add(ia.propident)        # We processed it, remember it
 
         # Write the MEA queue
         write_mea_queue(c, trans_id, logger)
@@ -179,17 +190,13 @@ def attribute_handler_xls_ora(er):
 
     # Open source spreadsheet
 
-    try:
-        ifh = xlrd.open_workbook(er.source_xlsfile)
-    except IOError:
-        print("ERROR: Unable to open %s" % (er.source_xlsfile))
-        er.logger.error("Unable to open %s" % (er.source_xlsfile))
+    rows = open_sheet(er, sheet_columns)
+    if rows is None:
         return False
-    wsh = ifh.sheet_by_index(0)
     # Connect to MEA target database
 
     try:
-        conn_target = cx_Oracle.connect("%s/%s@%s" % (er.target_user, er.target_pwd, er.target_db))
+        conn_target = connect_target(er)
     except cx_Oracle.DatabaseError, exc:
         error, = exc.args
         print("ERROR: %s" % (error.message))
@@ -203,9 +210,9 @@ def attribute_handler_xls_ora(er):
     attr_name = []       # Array to store attribute names
     er.logger.debug("Loading attribute names")
 
-    for i in range(2, wsh.ncols):
-        attr_name.append(wsh.cell(0, i).value)
-        er.logger.debug("%d Loaded attribute %s" % (i, wsh.cell(0, i).value))
+    for i in range(2, len(rows.header)):
+        attr_name.append(rows.header[i])
+        er.logger.debug("%d Loaded attribute %s" % (i, rows.header[i]))
 
     er.logger.debug("Loaded a total of %d attributes" % len(attr_name))
 
@@ -241,20 +248,20 @@ def attribute_handler_xls_ora(er):
     #queued_batches = 0 
     total_ct = 0       # Total no. of items
 
-    start_row = 1      # The first row in spreadsheet that contains data (start at 0)
+    processed_ic = er.registry.keys('assetattrid')   # Keys already processed in this run. Only the first occurrence is processed
 
     # Iterate through all rows of data in input spreadsheet
 
 
-    for this_row in range(start_row, wsh.nrows):
+    for row in rows:
   
-        ia = InterfaceAttrStructureFromXLS(wsh, this_row, curs_target_seq, er.logger)
+        ia = InterfaceAttrStructureFromXLS(row, curs_target_seq, er.logger)
         er.logger.info("Processing ESPI %s" % (ia.propident))
         
         if (ia.is_valid(curs_target_lookup, er.logger)):
             
             #Obtain new Transaction Id for next classification
-            total_ct += process_classid(ia, curs_target_mea, er.logger)
+            total_ct += process_classid(ia, curs_target_mea, processed_ic, er.logger)
                 
         else:
 
@@ -271,9 +278,11 @@ def attribute_handler_xls_ora(er):
     if (not er.test_mode):
         er.logger.info("Committing changes to database target %s" % er.target_db)
         conn_target.commit() 
+        er.registry.commit()
     else:
         er.logger.info("Test Mode: Rolling back changes to %s" % er.target_db)
         conn_target.rollback() 
+        er.registry.rollback()
 
     er.logger.info("Processed %s %s entities" % (total_ct, er.entity_type))
 
@@ -18,11 +18,16 @@
 ########################################################################################
 
 import cx_Oracle
-import xlrd
 import sys
-import time
 
 from common import get_unspsc_class
+from meabatch import TxnIdAllocator, wait_for_mea
+from speccache import ClassSpecCache, SPEC_DATATYPE, SPEC_ASSETSEQUENCE, SPEC_MEASUREUNITID
+from sheets import open_sheet
+from connpool import connect_target
+
+# MEA transaction ids are allocated in blocks from the entity sequence
+txn_ids = TxnIdAllocator('maximo.hul_mealie_isp_seq')
 #from AttributeSpec import curs_target_lookup
 
 # Values of commodity that have been processed. Only first occurrence in file is processed
@@ -33,12 +38,26 @@ processed_ic = []
 #     Class definitions
 #
 ########################################################################################
+
+# Columns of the source spreadsheet read by InterfaceableItemCommodityFromXls
+sheet_columns = [
+    ('itemnum', 0),
+    ('classid', 1),
+    ('classname', 2),
+    ('commid', 3),
+    ('commtitle', 4),
+    ('propident', 9),
+    ('longdesc', 8),
+    ('propname', 10),
+    ('propvalue', 11)
+]
+
 class InterfaceableItemCommodityFromXls:
 
     """Class representing the Classification of Items, in a Hierarchy, to be associated with an Item and 
     loaded by MEA from a spreadsheet"""
 
-    def __init__(self, worksheet, i, c, logger):
+    def __init__(self, row, c, logger):
         
         # Values are taken from the Item Classification Template
 
@@ -46,15 +65,15 @@ class InterfaceableItemCommodityFromXls:
         # Template would have many duplicate Properties. Thus in effect only the first one 
         # encountered is loaded to MEA
 
-        self.itemnum = worksheet.cell(i, 0).value
-        self.classid = worksheet.cell(i, 1).value
-        self.classname = worksheet.cell(i, 2).value
-        self.commid = worksheet.cell(i, 3).value
-        self.commtitle = worksheet.cell(i, 4).value
-        self.propident = worksheet.cell(i, 9).value
-        self.longdesc = worksheet.cell(i, 8).value
-        self.propname = worksheet.cell(i, 10).value
-        self.propvalue = worksheet.cell(i, 11).value
+        self.itemnum = row.itemnum
+        self.classid = row.classid
+        self.classname = row.classname
+        self.commid = row.commid
+        self.commtitle = row.commtitle
+        self.propident = row.propident
+        self.longdesc = row.longdesc
+        self.propname = row.propname
+        self.propvalue = row.propvalue
 
         self.errmsg = None
         self.severity = None
@@ -105,15 +124,7 @@ class InterfaceableItemCommodityFromXls:
 def get_next_txn_id(c, logger):
 
     # Get the next available transaction id for a MEA batch
-    q_get_id = """
-    SELECT maximo.hul_mealie_isp_seq.NEXTVAL
-    FROM DUAL"""
-
-    c.execute(q_get_id)
-    txn_id = c.fetchone()
-    logger.debug("Obtained MEA Txn Id %s" % (txn_id[0]))
-
-    return txn_id[0]
+    return txn_ids.next_id(c, logger)
 
 def get_next_itemspec_seq(c, logger):
     
@@ -128,23 +139,6 @@ def get_next_itemspec_seq(c, logger):
     
     return item_spec_seq[0]
 
-def get_queued_batch_ct(c, logger):
-
-    # Get the number of batches for THIS INTERFACE that 
-    # have yet to be processed by MEA
-    q_get_ct = """
-    SELECT COUNT(*)
-    FROM maximo.mxin_inter_trans 
-    WHERE extsysname = 'EXTSYS1'
-    AND ifacename = 'MXITEMSPECINTERFACE'"""
-
-    time.sleep(5)       # t = seconds
-    c.execute(q_get_ct)
-    wait_ct = c.fetchone()
-    logger.info("MEA has %s unprocessed batches in the queue" % (wait_ct[0]))
-
-    return wait_ct[0]
-
 def write_mea_queue(c, txid, logger):
     # Insert row into MEA queue
         
@@ -161,48 +155,30 @@ def write_mea_queue(c, txid, logger):
     c.execute(q_write_queue, trans_id=txid)
 
     return True
-def get_spec_datatype(c, cls, attr):
+def get_spec_datatype(specs, cls, attr):
     
     #Get datatype of attribute of classification
-    q_get_type = """SELECT a.datatype
-    FROm assetattribute a
-    WHERE a.assetattrid = :assetattrid
-    AND a.assetattrid IN 
-    (SELECT c.assetattrid
-    FROm classspec c
-    WHERE c.classstructureid = :classificationid)"""
+    spec = specs.get(cls, attr)
     
-    c.execute(q_get_type, classificationid=cls, assetattrid=attr)
-    data_type = c.fetchone()
-    
-    
-    if (data_type == None):
+    if (spec == None):
         return None
     else:
-        return data_type[0]
+        return spec[SPEC_DATATYPE]
 
-def get_spec_MeasureAttrSeq(c, cls, attr):
+def get_spec_MeasureAttrSeq(specs, cls, attr):
     
     #Get measureunit id and attribute sequence of classification
+    spec = specs.get(cls, attr)
     
-    q_get_MeaAttrSeq = """SELECT c.assetsequence, c.measureunitid
-    FROM classspec c
-    WHERE c.classstructureid = :classificationid
-    AND c.assetattrid = :assetattrid"""
-    
-    c.execute(q_get_MeaAttrSeq, classificationid=cls, assetattrid=attr)
-    
-    for row in c.fetchall():
-        attr_seq = row[0]
-        measure_unit = row[1]
-        
-        return attr_seq, measure_unit
+    if (spec != None):
+        return spec[SPEC_ASSETSEQUENCE], spec[SPEC_MEASUREUNITID]
     
 
 def isp_handler(er):
 
     type_handler = {
-        "XLS": spec_handler_xls_ora
+        "XLS": spec_handler_xls_ora,
+        "CSV": spec_handler_xls_ora
     }
 
     return type_handler.get(er.source_type)(er)   # Call appropriate handler for the source type
@@ -219,18 +195,14 @@ def spec_handler_xls_ora(er):
 
     # Open source spreadsheet
 
-    try:
-        ifh = xlrd.open_workbook(er.source_xlsfile)
-    except IOError:
-        print("ERROR: Unable to open %s" % (er.source_xlsfile))
-        er.logger.error("Unable to open %s" % (er.source_xlsfile))
+    rows = open_sheet(er, sheet_columns)
+    if rows is None:
         return False
-    wsh = ifh.sheet_by_index(0)
 
     # Connect to MEA target database
 
     try:
-        conn_target = cx_Oracle.connect("%s/%s@%s" % (er.target_user, er.target_pwd, er.target_db))
+        conn_target = connect_target(er)
     except cx_Oracle.DatabaseError, exc:
         error, = exc.args
         print("ERROR: %s" % (error.message))
@@ -253,14 +225,17 @@ def spec_handler_xls_ora(er):
     # Initialise local variables for fetch loop
 
     total_ct = 0       # Total no. of items
-    start_row = 1      # The first row in spreadsheet that contains data (starting at 0)
     processed_ItemAttr = [] #Values of item+attribute that have already been proceseed  
 
+    # Classspec metadata for every classid in the sheet is read up front
+    spec_cache = ClassSpecCache(curs_target_lookup, er.logger)
+    spec_cache.preload([row.classid for row in rows])
+
     # Iterate through all rows of data in input spreadsheet
     
-    for this_row in range(start_row, wsh.nrows):
+    for row in rows:
 
-            ic = InterfaceableItemCommodityFromXls(wsh, this_row, curs_target_seq, er.logger)
+            ic = InterfaceableItemCommodityFromXls(row, curs_target_seq, er.logger)
             er.logger.info("Processing classid %s for item %s" % (ic.classid, ic.itemnum))
 
             if (ic.is_valid(curs_target_lookup, er.logger)):
@@ -275,7 +250,7 @@ def spec_handler_xls_ora(er):
         
                     trans_seq = 1          # Sequence within batch
                 
-                    data_type = get_spec_datatype(curs_target_lookup, ic.classid, ic.propident)
+                    data_type = get_spec_datatype(spec_cache, ic.classid, ic.propident)
                     er.logger.debug("Attribute %s is datatype %s" % (ic.propident, data_type))
                     
         
@@ -300,7 +275,7 @@ def spec_handler_xls_ora(er):
                                                     # Free the connection
                                 sys.exit(2)"""
                     #Get measureunit id and attribute sequence of classification for this row               
-                    (asset_sequence, measure_unit) = get_spec_MeasureAttrSeq(curs_target_lookup, ic.classid, ic.propident)
+                    (asset_sequence, measure_unit) = get_spec_MeasureAttrSeq(spec_cache, ic.classid, ic.propident)
                                         #asset_sequence = get_spec_MeasureAttrSeq(curs_target_lookup [1], ic.classid, ic.propident)
                     er.logger.debug("Attribute %s is Measureunitid %s" % (ic.propident, measure_unit))
                     er.logger.debug("Attribute %s is classified as sequence number %s" % (ic.propident, asset_sequence))
@@ -349,18 +324,14 @@ def spec_handler_xls_ora(er):
 
     er.logger.info("Processed %s %s entities" % (total_ct, er.entity_type))
 
-    # Wait until MEA has flushed the queue
+    rows.close()   # The sheet is not needed while MEA loads
 
-    er.logger.info("Wait for MEA to flush its queue")
-    queued_batches = get_queued_batch_ct(curs_target_mea, er.logger)
-    while (queued_batches):
-        er.logger.debug("MEA still has %s items in queue" % (queued_batches))
-        queued_batches = get_queued_batch_ct(curs_target_mea, er.logger)
+    # Wait until MEA has flushed the queue
 
-    if (not er.test_mode):
-        # Tune this value according to your cron configuration
-        er.logger.info("Waiting %d seconds for MEA to finish loading" % (er.mea_wait_interval))
-        time.sleep(er.mea_wait_interval)
+    if not wait_for_mea(curs_target_mea, 'MXITEMSPECINTERFACE', er):
+        print("ERROR: MEA did not flush its MXITEMSPECINTERFACE queue, aborting")
+        conn_target.close()         # Free the connection
+        sys.exit(2)
 
     print("Processed %s %s entities" % (total_ct, er.entity_type))
     print "See %s for full details of this run" % er.log_file
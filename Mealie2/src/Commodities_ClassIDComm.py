@@ -11,16 +11,17 @@ Created on 14 Apr 2014
 ########################################################################################
 
 import cx_Oracle
-import xlrd
 import sys
 import string
-import time
 
-from common import get_unspsc_class, commodity_exists
-from common import UNSPSCDictionaryEntry
+from common import get_unspsc_class
+from common import UNSPSCIndex
+from meabatch import TxnIdAllocator, MeaQueueWriter, wait_for_mea
+from sheets import open_sheet, NUMBER
+from connpool import connect_target
 
-# Values of commodity that have been processed. Only first occurrence in file is processed
-processed_ic = []
+# MEA transaction ids are allocated in blocks from the entity sequence
+txn_ids = TxnIdAllocator('maximo.hul_mealie_com_seq')
 
 ########################################################################################
 #
@@ -39,11 +40,18 @@ class Commodity:
         self.description = description
 
 
+# Columns of the source spreadsheet read by InterfaceableCommodityFromXls
+sheet_columns = [
+    ('itemnum', 0),
+    ('commodity', 4, NUMBER),
+    ('description', 4)
+]
+
 class InterfaceableCommodityFromXls:
 
     """Class representing a Commodity Group or Commodity Code to be loaded by MEA from a spreadsheet"""
 
-    def __init__(self, worksheet, i, c, logger):
+    def __init__(self, row, c, logger):
         
         # Values are taken from the Item Classification Template
 
@@ -51,15 +59,15 @@ class InterfaceableCommodityFromXls:
         # Template would have many duplicate Properties. Thus in effect only the first one 
         # encountered is loaded to MEA
 
-        self.itemnum = worksheet.cell(i, 0).value
-        self.commodity = worksheet.cell(i, 4).value
+        self.itemnum = row.itemnum
+        self.commodity = row.commodity
         self.parent = None
-        self.description = string.upper(worksheet.cell(i, 4).value)[:100]
+        self.description = string.upper(row.description)[:100]
 
         self.errmsg = None
         self.severity = None
 
-    def is_valid(self, c, logger):
+    def is_valid(self, unspsc_index, processed_ic, logger):
 
         # Test for exceptions. An ERROR will cause the whole run to abort,
         # rolling back the transaction
@@ -78,7 +86,7 @@ class InterfaceableCommodityFromXls:
             
             # Any item supplied must correlate with the dictionary
             logger.debug("Checking that a dictionary entry exists")
-            de = UNSPSCDictionaryEntry(self.commodity, c, logger)
+            de = unspsc_index.entry(self.commodity)
             logger.debug("de.code=%s" % de.code)
             logger.debug("de.description=%s" % de.description)
 
@@ -103,53 +111,8 @@ class InterfaceableCommodityFromXls:
 def get_next_txn_id(c, logger):
 
     # Get the next available transaction id for a MEA batch
-    q_get_id = """
-    SELECT maximo.hul_mealie_com_seq.NEXTVAL
-    FROM DUAL"""
-
-    c.execute(q_get_id)
-
-    txn_id = c.fetchone()
-    logger.debug("Obtained MEA Txn Id %s" % (txn_id[0]))
-
-    return txn_id[0]
-def get_queued_batch_ct(c, logger):
-
-    # Get the number of batches for THIS INTERFACE that 
-    # have yet to be processed by MEA
-    q_get_ct = """
-    SELECT COUNT(*)
-    FROM maximo.mxin_inter_trans 
-    WHERE extsysname = 'EXTSYS1'
-    AND ifacename = 'MXCOMMODITYInterface'"""
-
-    time.sleep(5)       # t = seconds
-    c.execute(q_get_ct)
-    wait_ct = c.fetchone()
-    logger.info("MEA has %s unprocessed batches in the queue" % (wait_ct[0]))
-
-    return wait_ct[0]
-
-
-def write_mea_queue(c, txid, logger):
-
-    # Insert row into MEA queue
-
-    q_write_queue = """
-    INSERT INTO maximo.mxin_inter_trans (
-                           extsysname,
-                           ifacename,
-                           action,
-                           transid
-                           )
-    VALUES ('EXTSYS1', 'MXCOMMODITYInterface', 'AddChange', :trans_id)"""
-
-    logger.debug("Writing MEA queue for transid %d" % txid)
-    c.execute(q_write_queue, trans_id=txid)
-
-    return True
-
-def process_commodity(co, c, logger):
+    return txn_ids.next_id(c, logger)
+def process_commodity(co, c, mea_queue, processed_ic, logger):
     
     # Insert a row into MEA interface for this entity type 
     q_write_interface = """
@@ -190,11 +153,11 @@ def process_commodity(co, c, logger):
                                      transid=trans_id,
                                      transseq=trans_seq)
         logger.debug("Wrote interface")
-        processed_ic.append(co.commodity)     # We processed it, remember it
+        processed_ic.add(co.commodity)     # We processed it, remember it
 
         # Write the MEA queue
-        write_mea_queue(c, trans_id, logger)
-        logger.debug("Wrote MEA queue for transid %d" % trans_id)
+        mea_queue.append(trans_id)
+        logger.debug("Queued transid %d" % trans_id)
         ct = 1
                 
     else:
@@ -208,7 +171,8 @@ def process_commodity(co, c, logger):
 def CommComm_handler(er):
 
     type_handler = {
-        "XLS": com_handler_xls_ora
+        "XLS": com_handler_xls_ora,
+        "CSV": com_handler_xls_ora
     }
 
     return type_handler.get(er.source_type)(er)   # Call appropriate handler for the source type
@@ -224,18 +188,14 @@ def com_handler_xls_ora(er):
 
     # Open source spreadsheet
 
-    try:
-        ifh = xlrd.open_workbook(er.source_xlsfile)
-    except IOError:
-        print("ERROR: Unable to open %s" % (er.source_xlsfile))
-        er.logger.error("Unable to open %s" % (er.source_xlsfile))
+    rows = open_sheet(er, sheet_columns)
+    if rows is None:
         return False
-    wsh = ifh.sheet_by_index(0)
 
     # Connect to MEA target database
 
     try:
-        conn_target = cx_Oracle.connect("%s/%s@%s" % (er.target_user, er.target_pwd, er.target_db))
+        conn_target = connect_target(er)
     except cx_Oracle.DatabaseError, exc:
         error, = exc.args
         print("ERROR: %s" % (error.message))
@@ -247,19 +207,29 @@ def com_handler_xls_ora(er):
     curs_target_mea = conn_target.cursor()
     curs_target_lookup = conn_target.cursor()
 
+    # Transids are queued for MEA in array-bound inserts
+    mea_queue = MeaQueueWriter(curs_target_mea, 'MXCOMMODITYInterface', er.batch_size, er.logger, 'AddChange')
+
     # Initialise local variables for fetch loop
 
     total_ct = 0       # Total no. of items
-    start_row = 1      # The first row in spreadsheet that contains data (starting at 0)
+    processed_ic = er.registry.keys('commodity')   # Keys already processed in this run. Only the first occurrence is processed
+
+    # Dictionary entries and existing commodities are read once for the whole
+    # sheet, for every commodity and the class it implies
+    commcodes = [row.commodity for row in rows]
+    classcodes = [get_unspsc_class(code) for code in commcodes if isinstance(code, float)]
+    unspsc_index = UNSPSCIndex()
+    unspsc_index.preload(curs_target_lookup, commcodes + classcodes, er.logger)
 
     # Iterate through all rows of data in input spreadsheet
 
-    for this_row in range(start_row, wsh.nrows):
+    for row in rows:
 
-        ic = InterfaceableCommodityFromXls(wsh, this_row, curs_target_mea, er.logger)
+        ic = InterfaceableCommodityFromXls(row, curs_target_mea, er.logger)
         er.logger.info("Processing commodity %s for item %s" % (ic.commodity, ic.itemnum))
 
-        if (ic.is_valid(curs_target_lookup, er.logger)):
+        if (ic.is_valid(unspsc_index, processed_ic, er.logger)):
             
             # Is this a UNSPSC Class Code or Commodity Code, i.e Parent or Child?
             er.logger.debug("Commodity %s has an implied parent %s" % (ic.commodity, get_unspsc_class(ic.commodity)))
@@ -268,7 +238,7 @@ def com_handler_xls_ora(er):
                 
                 # It is a parent so process it
                 er.logger.debug("Commodity %s is a UNSPSC Class Code" % (ic.commodity))
-                total_ct += process_commodity(Commodity(ic.commodity, ic.parent, ic.description), curs_target_mea, er.logger)
+                total_ct += process_commodity(Commodity(ic.commodity, ic.parent, ic.description), curs_target_mea, mea_queue, processed_ic, er.logger)
                 
             else:
                 
@@ -281,19 +251,19 @@ def com_handler_xls_ora(er):
                     # child and process the child
                     er.logger.debug("Implied parent %s has been processed" % get_unspsc_class(ic.commodity))
                     ic.parent = get_unspsc_class(ic.commodity)
-                    total_ct += process_commodity(Commodity(ic.commodity, ic.parent, ic.description), curs_target_mea, er.logger)
+                    total_ct += process_commodity(Commodity(ic.commodity, ic.parent, ic.description), curs_target_mea, mea_queue, processed_ic, er.logger)
                     
                 else:
                     
                     er.logger.debug("Implied parent %s has not been processed" % get_unspsc_class(ic.commodity))
                     er.logger.debug("Check if implied parent %s is an existing commodity" % get_unspsc_class(ic.commodity))
-                    if commodity_exists(get_unspsc_class(ic.commodity), curs_target_mea, er.logger):
+                    if unspsc_index.commodity_exists(get_unspsc_class(ic.commodity)):
 
                         # The implied parent exists anyway so assign the parent to the
                         # child and process the child
                         er.logger.debug("Implied parent %s is an existing commodity" % get_unspsc_class(ic.commodity))
                         ic.parent = get_unspsc_class(ic.commodity)
-                        total_ct += process_commodity(Commodity(ic.commodity, ic.parent, ic.description), curs_target_mea, er.logger)
+                        total_ct += process_commodity(Commodity(ic.commodity, ic.parent, ic.description), curs_target_mea, mea_queue, processed_ic, er.logger)
                         
                     else:
                         
@@ -302,7 +272,7 @@ def com_handler_xls_ora(er):
                         # Finally we must resort to the dictionary. If it is not there then our dictionary
                         # probably needs an update
                         er.logger.debug("Check if implied parent %s is in dictionary" % get_unspsc_class(ic.commodity))
-                        de = UNSPSCDictionaryEntry(get_unspsc_class(ic.commodity), curs_target_mea, er.logger)
+                        de = unspsc_index.entry(get_unspsc_class(ic.commodity))
                         
                         # Last resort failed
                         if de.code == None:
@@ -318,12 +288,12 @@ def com_handler_xls_ora(er):
                         er.logger.debug("de.definition=%s" % de.definition)
 
                         # Process the parent obtained from the dictionary
-                        total_ct += process_commodity(Commodity(de.code, None, de.description), curs_target_mea, er.logger)
+                        total_ct += process_commodity(Commodity(de.code, None, de.description), curs_target_mea, mea_queue, processed_ic, er.logger)
                         
                         # Assign the parent rom the dictionary to the child and process the child
                         er.logger.debug("Parent %s found in dictionary" % de.code)
                         ic.parent = de.code
-                        total_ct += process_commodity(Commodity(ic.commodity, ic.parent, ic.description), curs_target_mea, er.logger)
+                        total_ct += process_commodity(Commodity(ic.commodity, ic.parent, ic.description), curs_target_mea, mea_queue, processed_ic, er.logger)
 
         else:
 
@@ -339,26 +309,25 @@ def com_handler_xls_ora(er):
     # Otherwise we commit the whole transaction
 
     if (not er.test_mode):
+        mea_queue.flush()
         er.logger.info("Committing changes to MEA target %s" % er.target_db)
         conn_target.commit() 
+        er.registry.commit()
     else:
         er.logger.info("Test Mode: Rolling back changes to %s" % er.target_db)
         conn_target.rollback() 
+        er.registry.rollback()
 
     er.logger.info("Processed %s %s entities" % (total_ct, er.entity_type))
 
-    # Wait until MEA has flushed the queue
+    rows.close()   # The sheet is not needed while MEA loads
 
-    er.logger.info("Wait for MEA to flush its queue")
-    queued_batches = get_queued_batch_ct(curs_target_mea, er.logger)
-    while (queued_batches):
-        er.logger.debug("MEA still has %s items in queue" % (queued_batches))
-        queued_batches = get_queued_batch_ct(curs_target_mea, er.logger)
+    # Wait until MEA has flushed the queue and loaded our batches
 
-    if (not er.test_mode):
-        # Tune this value according to your cron configuration
-        er.logger.info("Waiting %d seconds for MEA to finish loading" % (er.mea_wait_interval))
-        time.sleep(er.mea_wait_interval)
+    if not wait_for_mea(curs_target_mea, 'MXCOMMODITYInterface', er, 'maximo.mxcommodity_iface', mea_queue.queued):
+        print("ERROR: MEA did not load its MXCOMMODITYInterface batches, aborting")
+        conn_target.close()         # Free the connection
+        sys.exit(2)
 
     print("Processed %s %s entities" % (total_ct, er.entity_type))
     print "See %s for full details of this run" % er.log_file
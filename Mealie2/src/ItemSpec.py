@@ -22,24 +22,38 @@
 ########################################################################################
 
 import cx_Oracle
-import xlrd
 import sys
-import time
 
 from common import get_unspsc_class
+from sheets import open_sheet, NUMBER
+from meabatch import TxnIdAllocator, wait_for_mea
+from connpool import connect_target
+
+# MEA transaction ids are allocated in blocks from the entity sequence
+txn_ids = TxnIdAllocator('maximo.itemspecseq')
 
           
 processed_ic = []  
+
+# Columns of the source spreadsheet read by ReadItemSpecFromXLS
+sheet_columns = [
+    ('itemnum', 0),
+    ('clsfy', 1, NUMBER),
+    ('classname', 2),
+    ('PropIdentifier', 9),
+    ('PropName', 10)
+]
+
 class ReadItemSpecFromXLS:
     
     """ Class representing a set of Item Specifications to be loaded by MEA:SPE from a Spreadsheet"""
     
-    def __init__(self, worksheet, i, c, logger):
-        self.itemnum = worksheet.cell(i, 0).value
-        self.clsfy = worksheet.cell(i, 1).value
-        self.classname  = worksheet.cell(i, 2).value
-        self.PropIdentifier = worksheet.cell(i, 9).value
-        self.PropName = worksheet.cell(i, 10).value
+    def __init__(self, row, c, logger):
+        self.itemnum = row.itemnum
+        self.clsfy = row.clsfy
+        self.classname  = row.classname
+        self.PropIdentifier = row.PropIdentifier
+        self.PropName = row.PropName
         
         logger.debug("Get itemid for item %s" % (self.itemnum))
         item_id = """
@@ -136,35 +150,9 @@ class ReadItemSpecFromXLS:
 ########################################################################################
 
 def get_next_txn_id(c, logger):
-    
-    #Get next available sequence number for batch 
-    
-    q_get_asp_seq = """
-    SELECT maximo.itemspecseq.NEXTVAL
-    FROm DUAL"""
-    
-    c.execute(q_get_asp_seq)
-    mealie_seq = c.fetchone()
-    logger.debug("Obtained MEA seq Id %s" % (mealie_seq[0]))
-    
-    return mealie_seq[0]
 
-def get_queued_batch_ct(c, logger):
-
-    # Get the number of batches for THIS INTERFACE that 
-    # have yet to be processed by MEA
-    q_get_ct = """
-    SELECT COUNT(*)
-    FROM maximo.mxin_inter_trans 
-    WHERE extsysname = 'EXTSYS1'
-    AND ifacename = 'MXITEMSPECINTERFACE'"""
-
-    time.sleep(5)       # t = seconds
-    c.execute(q_get_ct)
-    wait_ct = c.fetchone()
-    logger.info("MEA has %s unprocessed batches in the queue" % (wait_ct[0]))
-
-    return wait_ct[0]
+    # Get the next available transaction id for a MEA batch
+    return txn_ids.next_id(c, logger)
 
 def write_mea_queue(c, txid, logger):
     #Insert row into Queue
@@ -233,7 +221,8 @@ def process_itemSpec(ic, c, logger):
 def itemSpec_handler(er):
     
     type_handler = {
-        "XLS": spec_handler_xls_ora
+        "XLS": spec_handler_xls_ora,
+        "CSV": spec_handler_xls_ora
     }
 
     return type_handler.get(er.source_type)(er)   # Call appropriate handler for the source type
@@ -247,18 +236,14 @@ def spec_handler_xls_ora(er):
 
     # Open source spreadsheet
 
-    try:
-        ifh = xlrd.open_workbook(er.source_xlsfile)
-    except IOError:
-        print("ERROR: Unable to open %s" % (er.source_xlsfile))
-        er.logger.error("Unable to open %s" % (er.source_xlsfile))
+    rows = open_sheet(er, sheet_columns)
+    if rows is None:
         return False
-    wsh = ifh.sheet_by_index(0)
 
     # Connect to MEA target database
 
     try:
-        conn_target = cx_Oracle.connect("%s/%s@%s" % (er.target_user, er.target_pwd, er.target_db))
+        conn_target = connect_target(er)
     except cx_Oracle.DatabaseError, exc:
         error, = exc.args
         print("ERROR: %s" % (error.message))
@@ -273,13 +258,12 @@ def spec_handler_xls_ora(er):
     # Initialise local variables for fetch loop
 
     total_ct = 0       # Total no. of items
-    start_row = 1      # The first row in spreadsheet that contains data (starting at 0)
 
     # Iterate through all rows of data in input spreadsheet
 
-    for this_row in range(start_row, wsh.nrows):
+    for row in rows:
 
-        ic = ReadItemSpecFromXLS(wsh, this_row, curs_target_mea, er.logger)
+        ic = ReadItemSpecFromXLS(row, curs_target_mea, er.logger)
         er.logger.info("Processing classificationid %s for item %s" % (ic.clsfy, ic.itemnum))
 
         if (ic.is_valid(curs_target_lookup, er.logger)):
@@ -326,18 +310,14 @@ def spec_handler_xls_ora(er):
 
     er.logger.info("Processed %s %s entities" % (total_ct, er.entity_type))
 
-    # Wait until MEA has flushed the queue
+    rows.close()   # The sheet is not needed while MEA loads
 
-    er.logger.info("Wait for MEA to flush its queue")
-    queued_batches = get_queued_batch_ct(curs_target_mea, er.logger)
-    while (queued_batches):
-        er.logger.debug("MEA still has %s items in queue" % (queued_batches))
-        queued_batches = get_queued_batch_ct(curs_target_mea, er.logger)
+    # Wait until MEA has flushed the queue
 
-    if (not er.test_mode):
-        # Tune this value according to your cron configuration
-        er.logger.info("Waiting %d seconds for MEA to finish loading" % (er.mea_wait_interval))
-        time.sleep(er.mea_wait_interval)
+    if not wait_for_mea(curs_target_mea, 'MXITEMSPECINTERFACE', er):
+        print("ERROR: MEA did not flush its MXITEMSPECINTERFACE queue, aborting")
+        conn_target.close()         # Free the connection
+        sys.exit(2)
 
     print("Processed %s %s entities" % (total_ct, er.entity_type))
     print "See %s for full details of this run" % er.log_file
@@ -25,13 +25,18 @@ Test adding Long Description table to Integration Interface mxItemSpec_iface
 ########################################################################################
 
 import cx_Oracle
-import xlrd
 import sys
-import time
 import math
 
 from common import get_unspsc_class
 from common import update_attr_datatype
+from meabatch import TxnIdAllocator, InterfaceWriter, wait_for_mea
+from sheets import open_sheet
+from speccache import ClassSpecCache, SPEC_DATATYPE, SPEC_ITEMSEQUENCE, SPEC_MEASUREUNITID
+from connpool import connect_target
+
+# MEA transaction ids are allocated in blocks from the entity sequence
+txn_ids = TxnIdAllocator('maximo.hul_mealie_isp_seq')
 
 
 #from AttributeSpec import curs_target_lookup
@@ -44,12 +49,27 @@ processed_ic = []
 #     Class definitions
 #
 ########################################################################################
+
+# Columns of the source spreadsheet read by InterfaceableItemCommodityFromXls
+sheet_columns = [
+    ('itemnum', 0),
+    ('classid', 1),
+    ('classname', 2),
+    ('commid', 3),
+    ('commtitle', 4),
+    ('propident', 9),
+    ('shortdesc', 7),
+    ('longdesc', 8),
+    ('propname', 10),
+    ('propvalue', 11)
+]
+
 class InterfaceableItemCommodityFromXls:
 
     """Class representing a Commodity Group or Commodity Code to be associated with an Item and 
     loaded by MEA from a spreadsheet"""
 
-    def __init__(self, worksheet, i, c, logger):
+    def __init__(self, row, c, logger):
         
         # Values are taken from the Item Classification Template
 
@@ -57,16 +77,16 @@ class InterfaceableItemCommodityFromXls:
         # Template would have many duplicate Properties. Thus in effect only the first one 
         # encountered is loaded to MEA
 
-        self.itemnum = worksheet.cell(i, 0).value
-        self.classid = worksheet.cell(i, 1).value
-        self.classname = worksheet.cell(i, 2).value
-        self.commid = worksheet.cell(i, 3).value
-        self.commtitle = worksheet.cell(i, 4).value
-        self.propident = worksheet.cell(i, 9).value
-        self.shortdesc = worksheet.cell(i, 7).value
-        self.longdesc = worksheet.cell(i, 8).value
-        self.propname = worksheet.cell(i, 10).value
-        self.propvalue = worksheet.cell(i, 11).value
+        self.itemnum = row.itemnum
+        self.classid = row.classid
+        self.classname = row.classname
+        self.commid = row.commid
+        self.commtitle = row.commtitle
+        self.propident = row.propident
+        self.shortdesc = row.shortdesc
+        self.longdesc = row.longdesc
+        self.propname = row.propname
+        self.propvalue = row.propvalue
 
         self.errmsg = None
         self.severity = None
@@ -118,15 +138,7 @@ class InterfaceableItemCommodityFromXls:
 def get_next_txn_id(c, logger):
 
     # Get the next available transaction id for a MEA batch
-    q_get_id = """
-    SELECT maximo.hul_mealie_isp_seq.NEXTVAL
-    FROM DUAL"""
-
-    c.execute(q_get_id)
-    txn_id = c.fetchone()
-    logger.debug("Obtained MEA Txn Id %s" % (txn_id[0]))
-
-    return txn_id[0]
+    return txn_ids.next_id(c, logger)
 
 def get_next_itemspec_seq(c, logger):
     
@@ -154,23 +166,6 @@ def get_next_LongDesc_seq(c, logger):
     
     return long_desc_seq[0]
 
-def get_queued_batch_ct(c, logger):
-
-    # Get the number of batches for THIS INTERFACE that 
-    # have yet to be processed by MEA
-    q_get_ct = """
-    SELECT COUNT(*)
-    FROM maximo.mxin_inter_trans 
-    WHERE extsysname = 'EXTSYS1'
-    AND ifacename = 'MXITEMSPECINTERFACE'"""
-
-    time.sleep(5)       # t = seconds
-    c.execute(q_get_ct)
-    wait_ct = c.fetchone()
-    logger.info("MEA has %s unprocessed batches in the queue" % (wait_ct[0]))
-
-    return wait_ct[0]
-
 def write_mea_queue(c, txid, logger):
     # Insert row into MEA queue
         
@@ -188,48 +183,60 @@ def write_mea_queue(c, txid, logger):
 
     return True
 
-def get_spec_datatype(c, cls, attr):
+def get_spec_datatype(specs, cls, attr):
     
     #Get datatype of attribute of classification
-    q_get_type = """SELECT a.datatype
-    FROm assetattribute a
-    WHERE a.assetattrid = :assetattrid
-    AND a.assetattrid IN 
-    (SELECT c.assetattrid
-    FROm classspec c
-    WHERE c.classstructureid = :classificationid)"""
-    
-    c.execute(q_get_type, classificationid=cls, assetattrid=attr)
-    data_type = c.fetchone()
+    spec = specs.get(cls, attr)
     
-    
-    if (data_type == None):
+    if (spec == None):
         return None
     else:
-        return data_type[0]
+        return spec[SPEC_DATATYPE]
 
-def get_spec_MeasureAttrSeq(c, cls, attr):
+def get_spec_MeasureAttrSeq(specs, cls, attr):
     
     #Get measureunit id and attribute sequence of classification
+    spec = specs.get(cls, attr)
     
-    q_get_MeaAttrSeq = """SELECT c.itemsequence, c.measureunitid
-    FROM classspec c
-    WHERE c.classstructureid = :classificationid
-    AND c.assetattrid = :assetattrid"""
-    
-    c.execute(q_get_MeaAttrSeq, classificationid=cls, assetattrid=attr)
-    
-    for row in c.fetchall():
-        attr_seq = row[0]
-        measure_unit = row[1]
-        
-        return attr_seq, measure_unit
+    if (spec != None):
+        return spec[SPEC_ITEMSEQUENCE], spec[SPEC_MEASUREUNITID]
     
 
+def isp_stage_exists(c, logger):
+
+    # The staging table is a global temporary table, so each session only
+    # sees its own rows and they are gone at commit or rollback. It is created
+    # once by sql/hul_mealie_isp_stage.sql, not here: DDL needs rights on the
+    # MAXIMO schema and would commit whatever the session has open
+
+    q_stage_exists = """
+    SELECT COUNT(*)
+    FROM all_tables
+    WHERE owner = 'MAXIMO'
+    AND table_name = 'HUL_MEALIE_ISP_STAGE'
+    AND temporary = 'Y'"""
+
+    c.execute(q_stage_exists)
+    (stage_ct,) = c.fetchone()
+    if (stage_ct == 0):
+        logger.error("Staging table maximo.hul_mealie_isp_stage does not exist or is not visible, run sql/hul_mealie_isp_stage.sql")
+        return False
+    return True
+
 def isp_handler(er):
 
     type_handler = {
-        "XLS": spec_handler_xls_ora
+        "XLS": spec_handler_xls_ora,
+        "CSV": spec_handler_xls_ora
+    }
+
+    return type_handler.get(er.source_type)(er)   # Call appropriate handler for the source type
+
+def isps_handler(er):
+
+    type_handler = {
+        "XLS": spec_handler_xls_ora_set,
+        "CSV": spec_handler_xls_ora_set
     }
 
     return type_handler.get(er.source_type)(er)   # Call appropriate handler for the source type
@@ -246,18 +253,14 @@ def spec_handler_xls_ora(er):
 
     # Open source spreadsheet
 
-    try:
-        ifh = xlrd.open_workbook(er.source_xlsfile)
-    except IOError:
-        print("ERROR: Unable to open %s" % (er.source_xlsfile))
-        er.logger.error("Unable to open %s" % (er.source_xlsfile))
+    rows = open_sheet(er, sheet_columns)
+    if rows is None:
         return False
-    wsh = ifh.sheet_by_index(0)
 
     # Connect to MEA target database
 
     try:
-        conn_target = cx_Oracle.connect("%s/%s@%s" % (er.target_user, er.target_pwd, er.target_db))
+        conn_target = connect_target(er)
     except cx_Oracle.DatabaseError, exc:
         error, = exc.args
         print("ERROR: %s" % (error.message))
@@ -296,14 +299,17 @@ def spec_handler_xls_ora(er):
     # Initialise local variables for fetch loop
 
     total_ct = 0       # Total no. of items
-    start_row = 1      # The first row in spreadsheet that contains data (starting at 0)
     processed_ItemAttr = [] #Values of item+attribute that have already been proceseed  
 
+    # Classspec metadata for every classid in the sheet is read up front
+    spec_cache = ClassSpecCache(curs_target_lookup, er.logger)
+    spec_cache.preload([row.classid for row in rows])
+
     # Iterate through all rows of data in input spreadsheet
     
-    for this_row in range(start_row, wsh.nrows):
+    for row in rows:
 
-            ic = InterfaceableItemCommodityFromXls(wsh, this_row, curs_target_seq, er.logger)
+            ic = InterfaceableItemCommodityFromXls(row, curs_target_seq, er.logger)
             er.logger.info("Processing classid %s for item %s" % (ic.classid, ic.itemnum))
 
             if (ic.is_valid(curs_target_lookup, er.logger)):
@@ -324,7 +330,7 @@ def spec_handler_xls_ora(er):
                     
                     
                     # Get data-type for attribute
-                    data_type = get_spec_datatype(curs_target_lookup, ic.classid, ic.propident)
+                    data_type = get_spec_datatype(spec_cache, ic.classid, ic.propident)
                     
                     er.logger.debug("Attribute %s is datatype %s" % (ic.propident, data_type))
                     
@@ -356,12 +362,13 @@ def spec_handler_xls_ora(er):
                     if type(valuenum) is not int:
                             er.logger.error("Value %s doesn't match Attribute data-type NUMERIC" % (valuenum))
                             update_attr_datatype(curs_target_lookup, ic.propident, er.logger)
+                            spec_cache.set_datatype(ic.propident, 'ALN')
                             valuealn = ic.propvalue # 7793 Could be float or int if numeric cell value
                             valuenum = None
                         
                         
                     #Get measureunit id and attribute sequence of classification for this row               
-                    (asset_sequence, measure_unit) = get_spec_MeasureAttrSeq(curs_target_lookup, ic.classid, ic.propident)
+                    (asset_sequence, measure_unit) = get_spec_MeasureAttrSeq(spec_cache, ic.classid, ic.propident)
                     
                                         #asset_sequence = get_spec_MeasureAttrSeq(curs_target_lookup [1], ic.classid, ic.propident)
                     er.logger.debug("Attribute %s is Measureunitid %s" % (ic.propident, measure_unit))
@@ -412,28 +419,210 @@ def spec_handler_xls_ora(er):
 
     er.logger.info("Processed %s %s entities" % (total_ct, er.entity_type))
 
+    rows.close()   # The sheet is not needed while MEA loads
+
     # Wait until MEA has flushed the queue
 
-    er.logger.info("Wait for MEA to flush its queue")
-    queued_batches = get_queued_batch_ct(curs_target_mea, er.logger)
-    while (queued_batches):
-        er.logger.debug("MEA still has %s items in queue" % (queued_batches))
-        queued_batches = get_queued_batch_ct(curs_target_mea, er.logger)
+    if not wait_for_mea(curs_target_mea, 'MXITEMSPECINTERFACE', er):
+        print("ERROR: MEA did not flush its MXITEMSPECINTERFACE queue, aborting")
+        conn_target.close()         # Free the connection
+        sys.exit(2)
+
+    print("Processed %s %s entities" % (total_ct, er.entity_type))
+    print "See %s for full details of this run" % er.log_file
+
+    # Close open cursors and disconnect from MEA target database
+
+    curs_target_mea.close()
+    curs_target_lookup.close()
+
+    conn_target.close()
+
+    return True
+
+
+def spec_handler_xls_ora_set(er):
+
+    # Set-based variant of spec_handler_xls_ora. Parsed rows are array-inserted
+    # into a staging table and mxitemspec_iface is then written with a single
+    # INSERT..SELECT against item, instead of one INSERT..SELECT per row
+
+    # Prompt user for target password, if not in parameters
+    # file. When used in Production NEVER put passwords in the parameter file.
+
+    if (not er.target_pwd):
+        er.target_pwd = str(raw_input("Enter password for target %s@%s: " % (er.target_user, er.target_db)))
+
+    # Open source spreadsheet
+
+    rows = open_sheet(er, sheet_columns)
+    if rows is None:
+        return False
+
+    # Connect to MEA target database
+
+    try:
+        conn_target = connect_target(er)
+    except cx_Oracle.DatabaseError, exc:
+        error, = exc.args
+        print("ERROR: %s" % (error.message))
+        er.logger.error("%s" % (error.message))
+        return False
+
+    # Open the necessary cursors on target database
+
+    curs_target_mea = conn_target.cursor()
+    curs_target_lookup = conn_target.cursor()
+    curs_target_seq = conn_target.cursor()
+
+    if not isp_stage_exists(curs_target_lookup, er.logger):
+        print("ERROR: Staging table maximo.hul_mealie_isp_stage is missing, run sql/hul_mealie_isp_stage.sql on %s" % (er.target_db))
+        conn_target.close()         # Free the connection
+        return False
+
+    q_write_stage = """
+    INSERT INTO maximo.hul_mealie_isp_stage (itemnum, classid, assetattrid, alnvalue, numvalue,
+                    assetsequence, measureunitid, transid, transseq)
+    VALUES (:itemnum, :classid, :assetattrid, :alnvalue, :numvalue,
+                    :assetsequence, :measureunitid, :transid, :transseq)"""
+
+    # Insert every staged row into MEA interface for this entity type
+
+    q_write_interface = """
+    INSERT INTO maximo.mxitemspec_iface (itemnum, Rotating, lottype, capitalized,
+                    outside, sparepartautoadd, 
+                    classstructureid, inspectionrequired, sendersysid, attachonissue, commodity, 
+                    commoditygroup, conditionenabled, iskit, issueunit,
+                    itemid, itemsetid, itemtype, metername, orderunit, prorate, Assetattrid, 
+                    is_classstructid, Alllocspecusevalue, displaysequence, 
+                    numvalue, measureunitid, alnvalue, changedate, is_changeby, orgid, 
+                    itemspecid, transid, transseq)
+    SELECT i.itemnum, i.Rotating, i.lottype, i.capitalized,
+                    i.outside, i.sparepartautoadd, 
+                    s.classid, i.inspectionrequired, i.sendersysid, i.attachonissue, i.commodity, 
+                    i.commoditygroup, i.conditionenabled, i.iskit, i.issueunit, 
+                    i.itemid, i.itemsetid, i.itemtype, i.metername, i.orderunit, i.prorate, s.assetattrid, 
+                    s.classid, 1, s.assetsequence,
+                    s.numvalue, s.measureunitid, s.alnvalue, sysdate, 'MEALIE', '170', 
+                    maximo.hul_itemspec_seq.NEXTVAL, s.transid, s.transseq
+    FROM maximo.hul_mealie_isp_stage s
+    JOIN item i ON i.itemnum = s.itemnum"""
+
+    # Initialise local variables for fetch loop
+
+    staged_ct = 0      # Total no. of rows staged
+    updated_attrs = set()  # Attributes already switched to ALN in this run
+
+    # Classspec metadata for every classid in the sheet is read up front
+    spec_cache = ClassSpecCache(curs_target_lookup, er.logger)
+    spec_cache.preload([row.classid for row in rows])
+
+    # Staging rows are array-bound and written in batches of er.batch_size
+    stage_writer = InterfaceWriter(curs_target_mea, q_write_stage, er.batch_size, er.logger)
+
+    # Iterate through all rows of data in input spreadsheet
+
+    for row in rows:
+
+        ic = InterfaceableItemCommodityFromXls(row, curs_target_seq, er.logger)
+        er.logger.info("Processing classid %s for item %s" % (ic.classid, ic.itemnum))
+
+        if (ic.is_valid(curs_target_lookup, er.logger)):
+
+            trans_id = get_next_txn_id(curs_target_seq, er.logger)
+            trans_seq = 1          # Sequence within batch
+
+            # Get data-type for attribute
+            data_type = get_spec_datatype(spec_cache, ic.classid, ic.propident)
+            er.logger.debug("Attribute %s is datatype %s" % (ic.propident, data_type))
+
+            if (data_type == None):
+                er.logger.error("ERROR: Invalid attribute type for attribute %s, aborting" % (ic.propident))
+                print("ERROR: Invalid attribute type for attribute %s, aborting" % (ic.propident))
+
+            # Assign value to correct data-type, as spec_handler_xls_ora does
+            if (data_type == 'ALN'):
+                valuealn = ic.propvalue
+                valuenum = None
+                if ic.propvalue.endswith("MM"):
+                    valuealn = ic.propvalue[:-2]
+                if (len(valuealn) > 255):
+                    valuealn = 'Too long for database'
+            else:
+                valuealn = None
+                valuenum = ic.propvalue
+
+            if type(valuenum) is not int:
+                er.logger.error("Value %s doesn't match Attribute data-type NUMERIC" % (valuenum))
+                if ic.propident not in updated_attrs:     # One UPDATE per attribute is enough
+                    update_attr_datatype(curs_target_lookup, ic.propident, er.logger)
+                    spec_cache.set_datatype(ic.propident, 'ALN')
+                    updated_attrs.add(ic.propident)
+                valuealn = ic.propvalue
+                valuenum = None
+
+            # Get measureunit id and attribute sequence of classification for this row
+            (asset_sequence, measure_unit) = get_spec_MeasureAttrSeq(spec_cache, ic.classid, ic.propident)
+
+            stage_writer.write(itemnum=ic.itemnum,
+                               classid=ic.classid,
+                               assetattrid=ic.propident,
+                               alnvalue=valuealn,
+                               numvalue=valuenum,
+                               assetsequence=asset_sequence,
+                               measureunitid=measure_unit,
+                               transid=trans_id,
+                               transseq=trans_seq)
+            staged_ct += 1
+        else:
+            er.logger.error("ERROR: Values for itemnum %s, attribute %s %s are invalid, aborting" % (ic.itemnum, ic.propident, ic.propname))
+            print("ERROR: Values for itemnum %s, attribute %s %s are invalid, aborting" % (ic.itemnum, ic.propident, ic.propname))
+            conn_target.close()         # Free the connection
+            sys.exit(2)
+
+    # (-) End of item processing loop
+
+    stage_writer.flush()
+    er.logger.info("Staged %d item specifications" % (staged_ct))
+
+    # Rows for items that do not exist are dropped by the join, as the per-row
+    # INSERT..SELECT of spec_handler_xls_ora drops them
+
+    curs_target_mea.execute(q_write_interface)
+    total_ct = curs_target_mea.rowcount
+    if (total_ct != staged_ct):
+        er.logger.info("%d staged rows have no matching item" % (staged_ct - total_ct))
+
+    # The transaction will not be committed if we are in 'test mode'
+    # Otherwise we commit the whole transaction. Either empties the staging table
 
     if (not er.test_mode):
-        # Tune this value according to your cron configuration
-        er.logger.info("Waiting %d seconds for MEA to finish loading" % (er.mea_wait_interval))
-        time.sleep(er.mea_wait_interval)
+        er.logger.info("Committing changes to MEA target %s" % er.target_db)
+        conn_target.commit() 
+    else:
+        er.logger.info("Test Mode: Rolling back changes to %s" % er.target_db)
+        conn_target.rollback() 
+
+    er.logger.info("Processed %s %s entities" % (total_ct, er.entity_type))
+
+    rows.close()   # The sheet is not needed while MEA loads
+
+    # Wait until MEA has flushed the queue
+
+    if not wait_for_mea(curs_target_mea, 'MXITEMSPECINTERFACE', er):
+        print("ERROR: MEA did not flush its MXITEMSPECINTERFACE queue, aborting")
+        conn_target.close()         # Free the connection
+        sys.exit(2)
 
     print("Processed %s %s entities" % (total_ct, er.entity_type))
     print "See %s for full details of this run" % er.log_file
 
     # Close open cursors and disconnect from MEA target database
 
+    curs_target_seq.close()
     curs_target_mea.close()
     curs_target_lookup.close()
 
     conn_target.close()
 
     return True
-
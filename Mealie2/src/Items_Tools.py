@@ -24,17 +24,26 @@ Created on 23 Jul 2013
 ########################################################################################
 
 import cx_Oracle
-import xlrd
 import sys
-import time
+
+from meabatch import wait_for_mea
+from sheets import open_sheet
+from connpool import connect_target
+
+# Columns of the source spreadsheet read by InterfaceFromXLS
+sheet_columns = [
+    ('itemnum', 0),
+    ('item_desc', 1),
+    ('item_transid', 6)
+]
 
 class InterfaceFromXLS:
     
     
-    def __init__(self, worksheet, i, c, logger):
-        self.itemnum = worksheet.cell(i, 0).value
-        self.item_desc = worksheet.cell(i, 1).value
-        self.item_transid = worksheet.cell(i, 6).value
+    def __init__(self, row, c, logger):
+        self.itemnum = row.itemnum
+        self.item_desc = row.item_desc
+        self.item_transid = row.item_transid
         
     
     def is_valid(self, c, logger):
@@ -63,27 +72,11 @@ def get_next_txn_id(c, logger):
 
     return txn_id[0]
 
-def get_queued_batch_ct(c, logger):
-
-    # Get the number of batches for THIS INTERFACE that     
-    # have yet to be processed by MEA
-    q_get_ct = """
-    SELECT COUNT(*)
-    FROM maximo.mxin_inter_trans 
-    WHERE extsysname = 'EXTSYS1'
-    AND ifacename = 'MXTOOLITEMInterface'"""
-
-    time.sleep(5)       # t = seconds
-    c.execute(q_get_ct)
-    wait_ct = c.fetchone()
-    logger.info("MEA has %s unprocessed batches in the queue" % (wait_ct[0]))
-
-    return wait_ct[0]
-
 def ToolItem_handler(er):
 
     type_handler = {
-        "XLS": tool_handler_xls_ora
+        "XLS": tool_handler_xls_ora,
+        "CSV": tool_handler_xls_ora
     }
 
     return type_handler.get(er.source_type)(er)   # Call appropriate handler for the source type
@@ -100,18 +93,14 @@ def tool_handler_xls_ora(er):
 
     # Open source spreadsheet
 
-    try:
-        ifh = xlrd.open_workbook(er.source_xlsfile)
-    except IOError:
-        print("ERROR: Unable to open %s" % (er.source_xlsfile))
-        er.logger.error("Unable to open %s" % (er.source_xlsfile))
+    rows = open_sheet(er, sheet_columns)
+    if rows is None:
         return False
-    wsh = ifh.sheet_by_index(0)
 
     # Connect to MEA target database
 
     try:
-        conn_target = cx_Oracle.connect("%s/%s@%s" % (er.target_user, er.target_pwd, er.target_db))
+        conn_target = connect_target(er)
     except cx_Oracle.DatabaseError, exc:
         error, = exc.args
         print("ERROR: %s" % (error.message))
@@ -132,14 +121,13 @@ def tool_handler_xls_ora(er):
                     '0', :trans_id, '1')"""
     
     total_ct = 1       # Total no. of items
-    start_row = 1      # The first row in spreadsheet that contains data (starting at 0)
     processed_ItemAttr = [] #Values of item+attribute that have already been proceseed  
 
     # Iterate through all rows of data in input spreadsheet
     
-    for this_row in range(start_row, wsh.nrows):
+    for row in rows:
             
-            ic = InterfaceFromXLS(wsh, this_row, curs_target_seq, er.logger)
+            ic = InterfaceFromXLS(row, curs_target_seq, er.logger)
             er.logger.info("Processing for item %s" % (ic.itemnum))
             er.logger.info("Processing for item description %s" % (ic.item_desc))
             er.logger.info("Processing for item transid %s" % (ic.item_transid))
@@ -184,18 +172,14 @@ def tool_handler_xls_ora(er):
 
     er.logger.info("Processed %s %s entities" % (total_ct, er.entity_type))
 
-    # Wait until MEA has flushed the queue
+    rows.close()   # The sheet is not needed while MEA loads
 
-    er.logger.info("Wait for MEA to flush its queue")
-    queued_batches = get_queued_batch_ct(curs_target_mea, er.logger)
-    while (queued_batches):
-        er.logger.debug("MEA still has %s items in queue" % (queued_batches))
-        queued_batches = get_queued_batch_ct(curs_target_mea, er.logger)
+    # Wait until MEA has flushed the queue
 
-    if (not er.test_mode):
-        # Tune this value according to your cron configuration
-        er.logger.info("Waiting %d seconds for MEA to finish loading" % (er.mea_wait_interval))
-        time.sleep(er.mea_wait_interval)
+    if not wait_for_mea(curs_target_mea, 'MXTOOLITEMInterface', er):
+        print("ERROR: MEA did not flush its MXTOOLITEMInterface queue, aborting")
+        conn_target.close()         # Free the connection
+        sys.exit(2)
 
     print("Processed %s %s entities" % (total_ct, er.entity_type))
     print "See %s for full details of this run" % er.log_file
@@ -7,28 +7,42 @@ Created on 13- Jun 2012
 #### Import Module
 
 import cx_Oracle
-import xlrd
 import sys
 import time
+
+from sheets import open_sheet
 from pydoc import classname
+from connpool import connect_target
 #from IPython.zmq import parentpoller
 
 processed_ic = []
 2222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222222
 #### Class Definitions
 
+# Columns of the source spreadsheet read by InterfaceSpecStructureFromXLS
+sheet_columns = [
+    ('classid', 0),
+    ('classname', 1),
+    ('attrseq', 4),
+    ('propident', 5),
+    ('propname', 6),
+    ('measurecode', 7),
+    ('data_type', 10),
+    ('useinitemdesc', 11)
+]
+
 class InterfaceSpecStructureFromXLS:
     
-    def __init__(self, worksheet, i, c, logger):
+    def __init__(self, row, c, logger):
         
-        self.classid = worksheet.cell(i, 0).value
-        self.classname = worksheet.cell(i, 1).value
-        self.attrseq = worksheet.cell(i, 4).value
-        self.propident = worksheet.cell(i, 5).value
-        self.propname = worksheet.cell(i, 6).value
-        self.measurecode = worksheet.cell(i, 7).value
-        self.data_type = worksheet.cell(i, 10).value
-        self.useinitemdesc = worksheet.cell(i, 11).value
+        self.classid = row.classid
+        self.classname = row.classname
+        self.attrseq = row.attrseq
+        self.propident = row.propident
+        self.propname = row.propname
+        self.measurecode = row.measurecode
+        self.data_type = row.data_type
+        self.useinitemdesc = row.useinitemdesc
         
         logger.debug("Getting classname for classid %s" % (self.classid))
         logger.debug("Can attribute %s be used in item description %s"  % (self.propident, self.useinitemdesc))
@@ -94,7 +108,8 @@ def write_mea_queue(c, txid, logger):
 
 def class_handler(er):
     type_handler = {
-        "XLS": classspec_handler_xls_ora
+        "XLS": classspec_handler_xls_ora,
+        "CSV": classspec_handler_xls_ora
         }
     return type_handler.get(er.source_type)(er)
 
@@ -219,18 +234,14 @@ def classspec_handler_xls_ora(er):
 
     # Open source spreadsheet
 
-    try:
-        ifh = xlrd.open_workbook(er.source_xlsfile)
-    except IOError:
-        print("ERROR: Unable to open %s" % (er.source_xlsfile))
-        er.logger.error("Unable to open %s" % (er.source_xlsfile))
+    rows = open_sheet(er, sheet_columns)
+    if rows is None:
         return False
-    wsh = ifh.sheet_by_index(0)
 
     # Connect to MEA target database
 
     try:
-        conn_target = cx_Oracle.connect("%s/%s@%s" % (er.target_user, er.target_pwd, er.target_db))
+        conn_target = connect_target(er)
     except cx_Oracle.DatabaseError, exc:
         error, = exc.args
         print("ERROR: %s" % (error.message))
@@ -244,9 +255,9 @@ def classspec_handler_xls_ora(er):
     attr_name = []       # Array to store attribute names
     er.logger.debug("Loading attribute names")
 
-    for i in range(2, wsh.ncols):
-        attr_name.append(wsh.cell(0, i).value)
-        er.logger.debug("%d Loaded attribute %s" % (i, wsh.cell(0, i).value))
+    for i in range(2, len(rows.header)):
+        attr_name.append(rows.header[i])
+        er.logger.debug("%d Loaded attribute %s" % (i, rows.header[i]))
 
     er.logger.debug("Loaded a total of %d attributes" % len(attr_name))
 
@@ -268,14 +279,13 @@ def classspec_handler_xls_ora(er):
     #queued_batches = 0 
     total_ct = 0       # Total no. of items
 
-    start_row = 1      # The first row in spreadsheet that contains data (start at 0)
 
     # Iterate through all rows of data in input spreadsheet
 
 
-    for this_row in range(start_row, wsh.nrows):
+    for row in rows:
   
-        ia = InterfaceSpecStructureFromXLS(wsh, this_row, curs_target_seq, er.logger)
+        ia = InterfaceSpecStructureFromXLS(row, curs_target_seq, er.logger)
         er.logger.info("Processing ESPI %s" % (ia.classid))
         
         if (ia.is_valid(curs_target_lookup, er.logger)):
@@ -24,17 +24,26 @@ Created on 23 Jul 2013
 ########################################################################################
 
 import cx_Oracle
-import xlrd
 import sys
 import time
 
+from sheets import open_sheet
+from connpool import connect_target
+
+# Columns of the source spreadsheet read by InterfaceFromXLS
+sheet_columns = [
+    ('itemnum', 0),
+    ('item_desc', 1),
+    ('item_transid', 6)
+]
+
 class InterfaceFromXLS:
     
     
-    def __init__(self, worksheet, i, c, logger):
-        self.itemnum = worksheet.cell(i, 0).value
-        self.item_desc = worksheet.cell(i, 1).value
-        self.item_transid = worksheet.cell(i, 6).value
+    def __init__(self, row, c, logger):
+        self.itemnum = row.itemnum
+        self.item_desc = row.item_desc
+        self.item_transid = row.item_transid
         
     
     def is_valid(self, c, logger):
@@ -83,7 +92,8 @@ def get_queued_batch_ct(c, logger):
 def isp_handler(er):
 
     type_handler = {
-        "XLS": spec_handler_xls_ora
+        "XLS": spec_handler_xls_ora,
+        "CSV": spec_handler_xls_ora
     }
 
     return type_handler.get(er.source_type)(er)   # Call appropriate handler for the source type
@@ -100,18 +110,14 @@ def spec_handler_xls_ora(er):
 
     # Open source spreadsheet
 
-    try:
-        ifh = xlrd.open_workbook(er.source_xlsfile)
-    except IOError:
-        print("ERROR: Unable to open %s" % (er.source_xlsfile))
-        er.logger.error("Unable to open %s" % (er.source_xlsfile))
+    rows = open_sheet(er, sheet_columns)
+    if rows is None:
         return False
-    wsh = ifh.sheet_by_index(0)
 
     # Connect to MEA target database
 
     try:
-        conn_target = cx_Oracle.connect("%s/%s@%s" % (er.target_user, er.target_pwd, er.target_db))
+        conn_target = connect_target(er)
     except cx_Oracle.DatabaseError, exc:
         error, = exc.args
         print("ERROR: %s" % (error.message))
@@ -132,14 +138,13 @@ def spec_handler_xls_ora(er):
                     '0', :transid, '1')"""
     
     total_ct = 0       # Total no. of items
-    start_row = 1      # The first row in spreadsheet that contains data (starting at 0)
     processed_ItemAttr = [] #Values of item+attribute that have already been proceseed  
 
     # Iterate through all rows of data in input spreadsheet
     
-    for this_row in range(start_row, wsh.nrows):
+    for row in rows:
             
-            ic = InterfaceFromXLS(wsh, this_row, curs_target_seq, er.logger)
+            ic = InterfaceFromXLS(row, curs_target_seq, er.logger)
             er.logger.info("Processing for item %s" % (ic.itemnum))
             
             if (ic.is_valid(curs_target_lookup, er.logger)):
@@ -188,6 +193,8 @@ def spec_handler_xls_ora(er):
 
     er.logger.info("Processed %s %s entities" % (total_ct, er.entity_type))
 
+    rows.close()   # The sheet is not needed while MEA loads
+
     # Wait until MEA has flushed the queue
 
     er.logger.info("Wait for MEA to flush its queue")
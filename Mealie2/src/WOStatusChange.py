@@ -29,14 +29,19 @@ Update Work Order status's for COMPLETION
 ########################################################################################
 
 import cx_Oracle
-import xlrd
 import sys
 import time
 import Tkinter
 
 from common import get_unspsc_class
+from sheets import open_sheet
+from meabatch import TxnIdAllocator
+from connpool import connect_target
 #from AttributeSpec import curs_target_lookup
 
+# MEA transaction ids are allocated in blocks from the entity sequence
+txn_ids = TxnIdAllocator('maximo.hul_mealie_isp_seq')
+
 # Values of commodity that have been processed. Only first occurrence in file is processed
 processed_ic = []
 
@@ -45,40 +50,66 @@ processed_ic = []
 #     Class definitions
 #
 ########################################################################################
+
+# Columns of the source spreadsheet read by InterfaceableWorkOrderFromXls
+sheet_columns = [
+    ('wonum', 0),
+    ('descr', 1),
+    ('worktype', 2),
+    ('wostatus', 3),
+    ('reportby', 4),
+    ('glacc', 5),
+    ('craft', 6),
+    ('feedback', 7),
+    ('changeby', 8),
+    ('labcode', 9),
+    ('labcraft', 10),
+    ('labpayrate', 12),
+    ('labreghrs', 13),
+    ('enterby', 14),
+    ('enterdate', 15),
+    ('startdate', 16),
+    ('starttime', 17),
+    ('finishdate', 18),
+    ('finishtime', 19),
+    ('transid', 20),
+    ('transseq', 21)
+]
+
 class InterfaceableWorkOrderFromXls:
 
     """Class representing each work order to be loaded by MEA from a spreadsheet"""
 
-    def __init__(self, worksheet, i, c, logger):
+    def __init__(self, row, c, logger):
         
         # Values are taken from the Work Order Change Template
         try:
-            self.wonum = int(worksheet.cell(i, 0).value)
+            self.wonum = int(row.wonum)
         except ValueError:
-            logger.debug("Wonum %s has non-numeric work order number \"%s\", setting to None" % (self.wonum, worksheet.cell(i, 0).value))
+            logger.debug("Wonum %s has non-numeric work order number \"%s\", setting to None" % (self.wonum, row.wonum))
             self.level = None
             
             
-        self.descr = worksheet.cell(i, 1).value
-        self.worktype = worksheet.cell(i, 2).value
-        self.wostatus = worksheet.cell(i, 3).value
-        self.reportby = worksheet.cell(i, 4).value
-        self.glacc = worksheet.cell(i, 5).value
-        self.craft = worksheet.cell(i, 6).value
-        self.feedback = worksheet.cell(i, 7).value
-        self.changeby = worksheet.cell(i, 8).value
-        self.labcode = worksheet.cell(i, 9).value
-        self.labcraft = worksheet.cell(i, 10).value
-        self.labpayrate = worksheet.cell(i, 12)
-        self.labreghrs = worksheet.cell(i, 13).value
-        self.enterby = worksheet.cell(i, 14).value
-        self.enterdate = worksheet.cell(i, 15).value
-        self.startdate = worksheet.cell(i, 16).value
-        self.starttime = worksheet.cell(i, 17).value
-        self.finishdate = worksheet.cell(i, 18).value
-        self.finishtime = worksheet.cell(i, 19).value
-        self.transid = worksheet.cell(i, 20).value
-        self.transseq = worksheet.cell(i, 21).value
+        self.descr = row.descr
+        self.worktype = row.worktype
+        self.wostatus = row.wostatus
+        self.reportby = row.reportby
+        self.glacc = row.glacc
+        self.craft = row.craft
+        self.feedback = row.feedback
+        self.changeby = row.changeby
+        self.labcode = row.labcode
+        self.labcraft = row.labcraft
+        self.labpayrate = row.labpayrate
+        self.labreghrs = row.labreghrs
+        self.enterby = row.enterby
+        self.enterdate = row.enterdate
+        self.startdate = row.startdate
+        self.starttime = row.starttime
+        self.finishdate = row.finishdate
+        self.finishtime = row.finishtime
+        self.transid = row.transid
+        self.transseq = row.transseq
 
         self.errmsg = None
         self.severity = None
@@ -142,15 +173,7 @@ class InterfaceableWorkOrderFromXls:
 def get_next_txn_id(c, logger):
 
     # Get the next available transaction id for a MEA batch
-    q_get_id = """
-    SELECT maximo.hul_mealie_isp_seq.NEXTVAL
-    FROM DUAL"""
-
-    c.execute(q_get_id)
-    txn_id = c.fetchone()
-    logger.debug("Obtained MEA Txn Id %s" % (txn_id[0]))
-
-    return txn_id[0]
+    return txn_ids.next_id(c, logger)
 
 def get_next_worklog_seq(c, logger):
     
@@ -246,18 +269,14 @@ def spec_handler_xls_ora(er):
 
     # Open source spreadsheet
 
-    try:
-        ifh = xlrd.open_workbook(er.source_xlsfile)
-    except IOError:
-        print("ERROR: Unable to open %s" % (er.source_xlsfile))
-        er.logger.error("Unable to open %s" % (er.source_xlsfile))
+    rows = open_sheet(er, sheet_columns)
+    if rows is None:
         return False
-    wsh = ifh.sheet_by_index(0)
 
     # Connect to MEA target database
 
     try:
-        conn_target = cx_Oracle.connect("%s/%s@%s" % (er.target_user, er.target_pwd, er.target_db))
+        conn_target = connect_target(er)
     except cx_Oracle.DatabaseError, exc:
         error, = exc.args
         print("ERROR: %s" % (error.message))
@@ -281,15 +300,14 @@ def spec_handler_xls_ora(er):
     # Initialise local variables for fetch loop
 
     total_ct = 0       # Total no. of items
-    start_row = 1      # The first row in spreadsheet that contains data (starting at 0)
     processed_ItemAttr = [] #Values of item+attribute that have already been proceseed  
     batch_queue = []   # Batch id queue for queue table
 
     # Iterate through all rows of data in input spreadsheet
     
-    for this_row in range(start_row, wsh.nrows):
+    for row in rows:
 
-            ic = InterfaceableWorkOrderFromXls(wsh, this_row, curs_target_seq, er.logger)
+            ic = InterfaceableWorkOrderFromXls(row, curs_target_seq, er.logger)
             er.logger.info("Processing work order number %s" % (ic.wonum))
 
             if (ic.is_valid(curs_target_lookup, er.logger)):
@@ -345,6 +363,8 @@ def spec_handler_xls_ora(er):
 
     er.logger.info("Processed %s %s entities" % (total_ct, er.entity_type))
 
+    rows.close()   # The sheet is not needed while MEA loads
+
     # Wait until MEA has flushed the queue
 
     er.logger.info("Wait for MEA to flush its queue")
@@ -92,11 +92,16 @@
 ########################################################################################
 
 import cx_Oracle
-import xlrd
 import sys
-import time
 
-from common import read_orgids
+from refcache import get_orgids
+from receipts import ValidationReceipt
+from meabatch import TxnIdAllocator, InterfaceWriter, MeaQueueWriter, HierarchyScheduler, wait_for_mea
+from sheets import open_sheet, NUMBER
+from connpool import connect_target
+
+# MEA transaction ids are allocated in blocks from the entity sequence
+txn_ids = TxnIdAllocator('maximo.hul_mealie_ass_seq')
 
 ########################################################################################
 #
@@ -176,45 +181,62 @@ class InterfaceableAssetFromOra:
 
         return True
 
+# Columns of the source spreadsheet read by InterfaceableAssetFromXls
+sheet_columns = [
+    ('level', 0, NUMBER),
+    ('ancestor', 1),
+    ('parent', 2),
+    ('assetnum', 3),
+    ('location', 4),
+    ('description', 5),
+    ('orgid', 6, NUMBER),
+    ('siteid', 7),
+    ('status', 8),
+    ('disabled', 9, NUMBER),
+    ('isrunning', 10, NUMBER)
+]
+
 class InterfaceableAssetFromXls:
 
     """Class to represent an Asset to be loaded by MEA from a spreadsheet"""
 
-    def __init__(self, worksheet, i, logger):
+    def __init__(self, row, logger):
 
-        self.assetnum = worksheet.cell(i, 3).value
+        self.assetnum = row.assetnum
         # MA00049 If user does not provide an integer value for Level we catch the ValueError 
         #         and set level to None, it will be rejected by the is_valid() method
         try:
-            self.level = int(worksheet.cell(i, 0).value)
+            self.level = int(row.level)
         except ValueError:
-            logger.debug("Asset %s has non-numeric level \"%s\", setting to None" % (self.assetnum, worksheet.cell(i, 0).value))
+            logger.debug("Asset %s has non-numeric level \"%s\", setting to None" % (self.assetnum, row.level))
             self.level = None
       
-        self.ancestor = worksheet.cell(i, 1).value
-        self.parent = worksheet.cell(i, 2).value
-        if (worksheet.cell(i, 4).ctype == xlrd.XL_CELL_NUMBER):
-            self.location = str(int(worksheet.cell(i, 4).value))
+        self.ancestor = row.ancestor
+        self.parent = row.parent
+        if isinstance(row.location, float):
+            self.location = str(int(row.location))
         else:
-            self.location = worksheet.cell(i, 4).value
-        self.description = worksheet.cell(i, 5).value
+            self.location = row.location
+        self.description = row.description
         try: # MA00063 If non-numeric orgid, set to None
-            self.orgid = int(worksheet.cell(i, 6).value) # 6943 should be integer
+            self.orgid = int(row.orgid) # 6943 should be integer
         except ValueError:
-            logger.debug("Asset %s has non-numeric orgid \"%s\", setting to None" % (self.assetnum, worksheet.cell(i, 6).value))
+            logger.debug("Asset %s has non-numeric orgid \"%s\", setting to None" % (self.assetnum, row.orgid))
             self.orgid = None
-        self.siteid = worksheet.cell(i, 7).value
-        self.status = worksheet.cell(i, 8).value
-        self.disabled = worksheet.cell(i, 9).value
-        self.isrunning = worksheet.cell(i, 10).value
+        self.siteid = row.siteid
+        self.status = row.status
+        self.disabled = row.disabled
+        self.isrunning = row.isrunning
 
         self.errmsg = None
         self.severity = None
 
-    def is_valid(self, c, logger):
+    def is_valid(self, c, logger, check_references=True):
 
         # Test for exceptions. An ERROR will cause the whole run to abort,
-        # rolling back the transaction
+        # rolling back the transaction. The checks of the row itself always
+        # run; the lookups of its parent and location are skipped when a
+        # validation receipt vouches for them
 
         # MA00049 The Level must be an integer
 
@@ -235,6 +257,9 @@ class InterfaceableAssetFromXls:
                 (self.assetnum, self.disabled))
             return False
 
+        if (not check_references):
+            return True
+
         # The parent must already be an existing ASSET
 
         logger.debug("Checking parent %s of asset %s exists as an asset" % (self.parent, self.assetnum))
@@ -297,32 +322,7 @@ class InterfaceableAssetFromXls:
 def get_next_txn_id(c, logger):
 
     # Get the next available transaction id for a MEA batch
-    q_get_id = """
-    SELECT maximo.hul_mealie_ass_seq.NEXTVAL
-    FROM DUAL"""
-
-    c.execute(q_get_id)
-    txn_id = c.fetchone()
-    logger.debug("Obtained MEA Txn Id %s" % (txn_id[0]))
-
-    return txn_id[0]
-
-def get_queued_batch_ct(c, logger):
-
-    # Get the number of batches for THIS INTERFACE that 
-    # have yet to be processed by MEA
-    q_get_ct = """
-    SELECT COUNT(*)
-    FROM maximo.mxin_inter_trans 
-    WHERE extsysname = 'EXTSYS1'
-    AND ifacename = 'MXASSETInterface'"""
-
-    time.sleep(5)  # t = seconds
-    c.execute(q_get_ct)
-    wait_ct = c.fetchone()
-    logger.info("MEA has %s unprocessed batches in the queue" % (wait_ct[0]))
-
-    return wait_ct[0]
+    return txn_ids.next_id(c, logger)
 
 def get_entity_ct(c, logger):
 
@@ -339,35 +339,13 @@ def get_entity_ct(c, logger):
 
 
 
-def write_mea_queue(c, q, logger):
-
-    # Insert rows into MEA queue
-
-    q_write_queue = """
-    INSERT INTO maximo.mxin_inter_trans (
-                           extsysname,
-                           ifacename,
-                           transid
-                           )
-    VALUES ('EXTSYS1',
-               'MXASSETInterface',
-               :transid)"""
-
-    # Process each entry in the queue until it is empty
-
-    for _i in range(len(q)):
-        j = q.pop(0)
-        logger.debug("Popped txn id %s. Queue now holds %s" % (j, q))
-        c.execute(q_write_queue, transid = j)
-
-    return True
-
 
 def ass_handler(er):
 
     type_handler = {
         "ORA": ass_handler_ora_ora,
-        "XLS": ass_handler_xls_ora
+        "XLS": ass_handler_xls_ora,
+        "CSV": ass_handler_xls_ora
     }
 
     return type_handler.get(er.source_type)(er) # Call appropriate handler for the source type
@@ -383,50 +361,58 @@ def ass_handler_xls_ora(er):
 
     # Open source spreadsheet
 
-    try:
-        ifh = xlrd.open_workbook(er.source_xlsfile)
-    except IOError:
-        print("ERROR: Unable to open %s" % (er.source_xlsfile))
-        er.logger.error("Unable to open %s" % (er.source_xlsfile))
+    rows = open_sheet(er, sheet_columns)
+    if rows is None:
         return False
-    wsh = ifh.sheet_by_index(0)
 
     # Connect to MEA target database
     # 6924 DJW Moved to before the validation block
 
     try:
-        conn_target = cx_Oracle.connect("%s/%s@%s" % (er.target_user, er.target_pwd, er.target_db))
+        conn_target = connect_target(er)
     except cx_Oracle.DatabaseError, exc:
         error, = exc.args
         print("ERROR: %s" % (error.message))
         er.logger.error("%s" % (error.message))
         return False
     
+    level_rows = {}    # Rows of this spreadsheet bucketed by level
+    sheet_rows = []    # The same rows in sheet order
+    er.logger.debug("Parsing spreadsheet data")
+
+    for row in rows:
+
+        ia = InterfaceableAssetFromXls(row, er.logger)
+        er.logger.debug("Instantiated InterfaceableAssetFromXls for %s" % (ia.assetnum))
+        # MA00049 InterfaceableAssetFromXls.level is supposed to be an integer so no need to cast
+        level_rows.setdefault(ia.level, []).append(ia)
+        sheet_rows.append(ia)
+
+    rows.close()   # Every row has been parsed, the sheet is not needed while MEA loads
+
+    # An update run of a file that a test run has already validated against
+    # unchanged reference data skips the reference lookups. Only the parents
+    # and locations this sheet refers to are fingerprinted
+    receipt = ValidationReceipt(er, ['orgids', 'assets', 'locations'])
+    fingerprints = receipt.fingerprint(conn_target, {'assets': [asset.parent for asset in sheet_rows],
+                                                     'locations': [asset.location for asset in sheet_rows]})
+    validated = (not er.test_mode) and receipt.matches(fingerprints)
+
     # Validation of ORGIDS and GLACCOUNTS
     # 6924 DJW On full debug dump out all valid values
-    orgids = read_orgids(conn_target)
-    er.logger.debug("Valid orgids obtained: These are %s" % ("".join(str(orgids))))
-    er.logger.debug("Declaring levels[] list")
-
-    levels = []        # A list of the levels in this spreadsheet
     invalid_orgids = []
     orgids_err_ct = 0
-    start_row = 1
-
-    er.logger.debug("Validating spreadsheet data")
-
-    for x in range(start_row, wsh.nrows):
 
-        ia = InterfaceableAssetFromXls(wsh, x, er.logger)
-        er.logger.debug("Instantiated InterfaceableAssetFromXls for %s" % (ia.assetnum))
-        # MA00049 InterfaceableAssetFromXls.level is supposed to be an integer so no need to cast
-        if (ia.level not in levels):
-            levels.append(ia.level)
+    if (not validated):
+        orgids = get_orgids(conn_target, er)
+        er.logger.debug("Valid orgids obtained: These are %s" % ("".join(str(orgids))))
+        er.logger.debug("Validating spreadsheet data")
 
-        if (ia.orgid not in orgids):        # Validate ORGIDS
-            if (ia.orgid not in invalid_orgids): # Don't report duplicate error values
-                invalid_orgids.append(ia.orgid)
-            orgids_err_ct += 1
+        for ia in sheet_rows:
+            if (ia.orgid not in orgids):        # Validate ORGIDS
+                if (ia.orgid not in invalid_orgids): # Don't report duplicate error values
+                    invalid_orgids.append(ia.orgid)
+                orgids_err_ct += 1
 
     if orgids_err_ct > 0:
         # 6924 DJW Update for consistency with existing fatal errors
@@ -438,7 +424,11 @@ def ass_handler_xls_ora(er):
 
     er.logger.debug("Spreadsheet data validated")
 
-    levels.sort()
+    # The rows are only parsed once. Parents are written before their children
+    # so order by level, then by parent within each level
+    levels = sorted(level_rows.keys())
+    for level in levels:
+        level_rows[level].sort(key=lambda ia: ia.parent)
     er.logger.info("Levels to be processed: %s" % (levels))
         
     # Open various cursors on target database
@@ -482,139 +472,106 @@ def ass_handler_xls_ora(er):
 
     # Initialise local variables for fetch loop
 
-    queued_batches = 0 
     total_ct = 0       # Total no. of items
-    level_ct = 0       # No. of items in this level
-    last_level = None
     trans_id = None    # Current Batch id
-    batch_queue = []   # Batch id queue for queue table
+    mea_queue = MeaQueueWriter(curs_target_mea, 'MXASSETInterface', er.batch_size, er.logger)
     trans_seq = None   # Sequence within batch
 
-    start_row = 1      # First row in spreadsheet that contains data (first is 0)
-
-    # 6924 DJW Iterate through levels starting with topmost in hierarchy
-
-    for level_to_process in levels:
-
-        # MA00049 Do not assume at this stage that all members of levels list are numeric
-        er.logger.info("Processing hierarchy level %s" % (level_to_process))
-
-        # Iterate through rows in input spreadsheet
-
-        for this_row in range(start_row, wsh.nrows):
-
-            ia = InterfaceableAssetFromXls(wsh, this_row, er.logger)
-
-            # 6924 DJW Ignore unless it is the level we want to process on this iteration
-            er.logger.debug("Current level being processed: %s" % (level_to_process))
-            er.logger.debug("This asset is of level : %s" % (ia.level))
-
-
-            if (ia.level == level_to_process):
-                er.logger.debug("We are processing level %s so process this one" % (level_to_process))
-
-                er.logger.info("Processing assetnum %s" % (ia.assetnum))
-                if (ia.is_valid(curs_target_lookup, er.logger)):
-
-                    if (ia.level != last_level):
-                        er.logger.debug("LEVEL has changed: was %s, now %s" % (last_level, ia.level))
-
-                        if (not er.test_mode):
-                            if (last_level): # Ignore the first change of level since nothing yet written
-
-                                # Write the MEA queue
-                                er.logger.info("Writing MEA queue, stored txn ids are %s" % batch_queue)
-                                write_mea_queue(curs_target_mea, batch_queue, er.logger)
-                                er.logger.info("Wrote MEA queue, stored txn ids are %s" % batch_queue)
-                                er.logger.info("Committing changes to MEA target %s" % er.target_db)
-                                conn_target.commit() 
-
-                                er.logger.debug("Processed %s items in previous LEVEL %s" % (level_ct, last_level))
-                                level_ct = 0
-
-                                # Wait until MEA has flushed the queue
-
-                                er.logger.info("Wait for MEA to flush its queue")
-                                queued_batches = get_queued_batch_ct(curs_target_seq, er.logger)
-                                while (queued_batches):
-                                    er.logger.debug("MEA still has %s items in queue" % (queued_batches))
-                                    queued_batches = get_queued_batch_ct(curs_target_seq, er.logger)
-
-                        else:
-                            er.logger.info("Test Mode: Will not write MEA queue")
-
-                        last_level = ia.level
-
-                    else:
-                        er.logger.debug("LEVEL is still %s" % (ia.level))
-
-                    er.logger.debug("Getting new transaction id for %s" % ia.assetnum)
-
-                    # Obtain new MEA transaction id for next batch 
-                    trans_id = get_next_txn_id(curs_target_seq, er.logger)
-
-                    # Add the MEA transaction id to the queue 
-                    batch_queue.append(trans_id) 
-
-                    # Sequence is reset for new batch
-                    trans_seq = 1
+    # Interface rows are array-bound and written in batches of er.batch_size
+    iface_writer = InterfaceWriter(curs_target_mea, q_write_interface, er.batch_size, er.logger)
+
+    # Assets are released to MEA as soon as MEA has loaded their own parent,
+    # so one slow branch no longer holds back the whole of the next level
+    scheduler = HierarchyScheduler(curs_target_seq, 'MXASSETInterface', er.logger)
+    scheduler.load([asset for level in levels for asset in level_rows[level]], 'assetnum')
+
+    while scheduler:
+
+        released = scheduler.release()
+        if not released:
+            # Nothing more can be written until MEA loads another parent
+            if not scheduler.wait(er.mea_wait_deadline, er.mea_wait_interval):
+                print("ERROR: MEA did not load the assets queued on MXASSETInterface, aborting")
+                conn_target.close()         # Free the connection
+                sys.exit(2)
+            continue
+
+        er.logger.debug("Releasing %d assets" % (len(released)))
+
+        for ia in released:
+
+            er.logger.info("Processing assetnum %s" % (ia.assetnum))
+            if (ia.is_valid(curs_target_lookup, er.logger, not validated)):
+
+                er.logger.debug("Getting new transaction id for %s" % ia.assetnum)
+
+                # Obtain new MEA transaction id for next batch 
+                trans_id = get_next_txn_id(curs_target_seq, er.logger)
+
+                # Add the MEA transaction id to the queue 
+                mea_queue.append(trans_id) 
+
+                # Sequence is reset for new batch
+                trans_seq = 1
+
+                # Write the MEA interface table
+                er.logger.debug("Writing interface: assetnum %s transid %s transseq %s" % (ia.assetnum, trans_id, trans_seq))
+                iface_writer.write(ancestor=ia.ancestor,
+                                   description=ia.description,
+                                   location=ia.location,
+                                   orgid=ia.orgid,
+                                   siteid=ia.siteid,
+                                   status=ia.status,
+                                   assetnum=ia.assetnum,
+                                   disabled=ia.disabled,
+                                   isrunning=ia.isrunning,
+                                   parent=ia.parent,
+                                   transid=trans_id,
+                                   transseq=trans_seq)
+
+                # In test mode nothing reaches MEA, so children are released at once
+                if (er.test_mode):
+                    scheduler.loaded(ia.assetnum)
+                else:
+                    scheduler.sent(ia.assetnum, trans_id)
 
-                    # Write the MEA interface table
+            else:
 
-                    er.logger.debug("Writing interface: assetnum %s transid %s transseq %s" % (ia.assetnum, trans_id, trans_seq))
-                    curs_target_mea.execute(q_write_interface, ancestor=ia.ancestor,
-                                                                              description=ia.description,
-                                                                              location=ia.location,
-                                                                              orgid=ia.orgid,
-                                                                              siteid=ia.siteid,
-                                                                              status=ia.status,
-                                                                              assetnum=ia.assetnum,
-                                                                              disabled=ia.disabled,
-                                                                              isrunning=ia.isrunning,
-                                                                              parent=ia.parent,
-                                                                              transid=trans_id,
-                                                                              transseq=trans_seq)
-                else:
+                er.logger.error("ERROR: %s is not a valid Asset, aborting" % (ia.assetnum))
+                print("ERROR: %s is not a valid Asset, aborting" % (ia.assetnum))
+                conn_target.rollback()
+                conn_target.close() # 6924 DJW Free the connection
+                sys.exit(2)
 
-                    er.logger.error("ERROR: %s is not a valid Asset, aborting" % (ia.assetnum))
-                    print("ERROR: %s is not a valid Asset, aborting" % (ia.assetnum))
-                    conn_target.rollback()
-                    conn_target.close() # 6924 DJW Free the connection
-                    sys.exit(2)  # Will never happen if driving query is correctly ordered
-    
-                total_ct += 1
-                level_ct += 1
+            total_ct += 1
 
-            else:
-                er.logger.debug("We are processing level %s so ignore level %s" % (level_to_process, ia.level))
+            # End of asset processing loop
 
-            # 6924 DJW End of condition that it is the level we want to process on this iteration
+        # Parents must be on the interface table before their children are
+        # validated, and committed before MEA can load them
 
-        # End of asset processing loop
+        iface_writer.flush()
 
-    # 6924 DJW End of level processing loop
+        if (not er.test_mode):
+            # Write the MEA queue
+            mea_queue.flush()
+            er.logger.info("Committing changes to MEA target %s" % er.target_db)
+            conn_target.commit() 
 
-    # The transaction will not be committed if we are in 'test mode'
-    # Otherwise we commit the last level-set of batches
+    # End of scheduling loop. Outside test mode MEA has taken every batch off its queue
 
-    if (not er.test_mode):
-        # Write the MEA queue
-        er.logger.info("Writing MEA queue, stored txn ids are %s" % batch_queue)
-        write_mea_queue(curs_target_mea, batch_queue, er.logger)
-        er.logger.info("Wrote MEA queue, stored txn ids are %s" % batch_queue)
-        er.logger.info("Committing changes to MEA target %s" % er.target_db)
-        conn_target.commit() 
-    else:
+    if (er.test_mode):
         er.logger.info("Test Mode: Rolling back changes to %s" % er.target_db)
         conn_target.rollback() 
+        receipt.issue(fingerprints)
+    elif not wait_for_mea(curs_target_seq, 'MXASSETInterface', er, 'maximo.mxasset_iface', mea_queue.queued):
+        # MA00047 MEA must have loaded the last batches before the entities are counted
+        print("ERROR: MEA did not load the assets on maximo.mxasset_iface, aborting")
+        conn_target.close()         # Free the connection
+        sys.exit(2)
 
     er.logger.info("Processed %s %s entities" % (total_ct, er.entity_type))
 
-    if (not er.test_mode):
-        # MA00047 Tune this value according to your cron configuration
-        er.logger.info("Waiting %d seconds for MEA to finish loading" % (er.mea_wait_interval))
-        time.sleep(er.mea_wait_interval)
-
     print("Processed %s %s entities" % (total_ct, er.entity_type))
     print "See %s for full details of this run" % er.log_file
 
@@ -658,7 +615,7 @@ def ass_handler_ora_ora(er):
 
     # Connect to MEA target database and open various cursors
 
-    conn_target = cx_Oracle.connect("%s/%s@%s" % (er.target_user, er.target_pwd, er.target_db))
+    conn_target = connect_target(er)
     curs_target_mea = conn_target.cursor()
     curs_target_lookup = conn_target.cursor()
     curs_target_seq = conn_target.cursor()
@@ -722,109 +679,108 @@ def ass_handler_ora_ora(er):
 
     curs_source_drv.execute(q_driver, locations = er.entity_key + '%')
 
-    row = curs_source_drv.fetchone()
+    # The whole hierarchy is needed before anything can be scheduled
+    curs_source_drv.arraysize = er.batch_size
+    rows = curs_source_drv.fetchall()
 
     # Initialise local variables for fetch loop
 
-    queued_batches = 0 
     total_ct = 0       # Total no. of items
-    level_ct = 0       # No. of items in this level
-    last_level = None
     trans_id = None    # Current Batch id
-    batch_queue = []   # Batch id queue for queue table
+    mea_queue = MeaQueueWriter(curs_target_mea, 'MXASSETInterface', er.batch_size, er.logger)
     trans_seq = None   # Sequence within batch
 
-    # Process each entity until the cursor is exhausted
-
-    while row:
-        ia = InterfaceableAssetFromOra(row)
-        er.logger.info("Processing asset %s" % (ia.assetnum))
-        if (ia.is_valid(curs_target_lookup, er.logger)):
-
+    # Interface rows are array-bound and written in batches of er.batch_size
+    iface_writer = InterfaceWriter(curs_target_mea, q_write_interface, er.batch_size, er.logger)
+
+    # Assets are released to MEA as soon as MEA has loaded their own parent,
+    # so one slow branch no longer holds back the whole of the next level
+    scheduler = HierarchyScheduler(curs_target_seq, 'MXASSETInterface', er.logger)
+    scheduler.load([InterfaceableAssetFromOra(row) for row in rows], 'assetnum')
+
+    while scheduler:
+
+        released = scheduler.release()
+        if not released:
+            # Nothing more can be written until MEA loads another parent
+            if not scheduler.wait(er.mea_wait_deadline, er.mea_wait_interval):
+                print("ERROR: MEA did not load the assets queued on MXASSETInterface, aborting")
+                conn_target.close()         # Free the connection
+                sys.exit(2)
+            continue
+
+        er.logger.debug("Releasing %d assets" % (len(released)))
+
+        for ia in released:
+
+            er.logger.info("Processing assetnum %s" % (ia.assetnum))
+            if (ia.is_valid(curs_target_lookup, er.logger)):
+
+                er.logger.debug("Getting new transaction id for %s" % ia.assetnum)
+
+                # Obtain new MEA transaction id for next batch 
+                trans_id = get_next_txn_id(curs_target_seq, er.logger)
+
+                # Add the MEA transaction id to the queue 
+                mea_queue.append(trans_id) 
+
+                # Sequence is reset for new batch
+                trans_seq = 1
+
+                # Write the MEA interface table
+                er.logger.debug("Writing interface: assetnum %s transid %s transseq %s" % (ia.assetnum, trans_id, trans_seq))
+                iface_writer.write(ancestor=ia.ancestor,
+                                   description=ia.description,
+                                   location=ia.location,
+                                   orgid=ia.orgid,
+                                   siteid=ia.siteid,
+                                   status=ia.status,
+                                   assetnum=ia.assetnum,
+                                   disabled=ia.disabled,
+                                   isrunning=ia.isrunning,
+                                   parent=ia.parent,
+                                   transid=trans_id,
+                                   transseq=trans_seq)
+
+                # In test mode nothing reaches MEA, so children are released at once
+                if (er.test_mode):
+                    scheduler.loaded(ia.assetnum)
+                else:
+                    scheduler.sent(ia.assetnum, trans_id)
 
-            if (ia.level != last_level):
-                er.logger.debug("LEVEL has changed: was %s, now %s" % (last_level, ia.level))
+            else:
 
-                if (not er.test_mode):
-                    if (last_level): # Ignore the first change of level since nothing yet written
+                er.logger.error("ERROR: %s is not a valid Asset, aborting" % (ia.assetnum))
+                print("ERROR: %s is not a valid Asset, aborting" % (ia.assetnum))
+                conn_target.rollback()
+                conn_target.close() # 6924 DJW Free the connection
+                sys.exit(2)
 
-                        # Write the MEA queue
-                        er.logger.info("Writing MEA queue, stored txn ids are %s" % batch_queue)
-                        write_mea_queue(curs_target_mea, batch_queue, er.logger)
-                        er.logger.info("Wrote MEA queue, stored txn ids are %s" % batch_queue)
-                        er.logger.info("Committing changes to MEA target %s" % er.target_db)
-                        conn_target.commit() 
+            total_ct += 1
 
-                        er.logger.debug("Processed %s items in previous LEVEL %s" % (level_ct, last_level))
-                        level_ct = 0
+            # End of asset processing loop
 
-                        # Wait until MEA has flushed the queue
+        # Parents must be on the interface table before their children are
+        # validated, and committed before MEA can load them
 
-                        er.logger.info("Wait for MEA to flush its queue")
-                        queued_batches = get_queued_batch_ct(curs_target_seq, er.logger)
-                        while (queued_batches):
-                            er.logger.debug("MEA still has %s items in queue" % (queued_batches))
-                            queued_batches = get_queued_batch_ct(curs_target_seq, er.logger)
+        iface_writer.flush()
 
-                else:
-                    er.logger.info("Test Mode: Will not write MEA queue")
+        if (not er.test_mode):
+            # Write the MEA queue
+            mea_queue.flush()
+            er.logger.info("Committing changes to MEA target %s" % er.target_db)
+            conn_target.commit() 
 
-                last_level = ia.level
-
-            else:
-                er.logger.debug("LEVEL is still %s" % (ia.level))
-
-            er.logger.debug("Getting new transaction id for %s" % ia.assetnum)
-
-            # Obtain new MEA transaction id for next batch 
-            trans_id = get_next_txn_id(curs_target_seq, er.logger)
-
-            # Add the MEA transaction id to the queue 
-            batch_queue.append(trans_id) 
-
-            # Sequence is reset for new batch
-            trans_seq = 1
-
-            # Write the MEA interface table
-            er.logger.debug("Writing interface: assetnum %s transid %s transseq %s" % (ia.assetnum, trans_id, trans_seq))
-            curs_target_mea.execute(q_write_interface, ancestor=ia.ancestor,
-                                                                      description=ia.description,
-                                                                      location=ia.location,
-                                                                      orgid=ia.orgid,
-                                                                      siteid=ia.siteid,
-                                                                      status=ia.status,
-                                                                      assetnum=ia.assetnum,
-                                                                      disabled=ia.disabled,
-                                                                      isrunning=ia.isrunning,
-                                                                      parent=ia.parent,
-                                                                      transid=trans_id,
-                                                                      transseq=trans_seq)
+    # End of scheduling loop. Outside test mode MEA has taken every batch off its queue
 
-        else:
-
-            er.logger.error("ERROR: %s is not a valid Asset, aborting" % (ia.assetnum))
-            print("ERROR: %s is not a valid Asset, aborting" % (ia.assetnum))
-            conn_target.rollback()
-            conn_target.close() # 6924 DJW Free the connection
-            sys.exit(2)  # This will never happen if driving query is correctly ordered
-    
-        total_ct += 1
-        level_ct += 1
-        row = curs_source_drv.fetchone()
-
-    # The transaction will not be committed if we are in 'test mode'
-    # Otherwise we commit the last level-set of batches
-
-    if (not er.test_mode):
-        # Write the MEA queue
-        er.logger.info("Writing MEA queue, stored txn ids are %s" % batch_queue)
-        write_mea_queue(curs_target_mea, batch_queue, er.logger)
-        er.logger.info("Wrote MEA queue, stored txn ids are %s" % batch_queue)
-        er.logger.info("Committing changes to MEA target %s" % er.target_db)
-        conn_target.commit() 
-    else:
+    if (er.test_mode):
         er.logger.info("Test Mode: Rolling back changes to %s" % er.target_db)
         conn_target.rollback() 
+    elif not wait_for_mea(curs_target_seq, 'MXASSETInterface', er, 'maximo.mxasset_iface', mea_queue.queued):
+        # MA00047 MEA must have loaded the last batches before the entities are counted
+        print("ERROR: MEA did not load the assets on maximo.mxasset_iface, aborting")
+        conn_target.close()         # Free the connection
+        sys.exit(2)
 
     er.logger.info("Processed %s %s entities" % (total_ct, er.entity_type))
     print("Processed %s %s entities" % (total_ct, er.entity_type))
@@ -89,9 +89,18 @@
 ########################################################################################
 
 import cx_Oracle
-import xlrd
 import sys
-import time
+
+from meabatch import TxnIdAllocator, MeaQueueWriter, wait_for_mea
+from sheets import open_sheet
+from connpool import connect_target
+from common import cell_key
+
+# MEA transaction ids are allocated in blocks from the entity sequence
+txn_ids = TxnIdAllocator('maximo.hul_mealie_asp_seq')
+
+# Oracle allows at most 1000 expressions in an IN list
+key_chunk_size = 1000
 
 #from base.common import read_orgids
 
@@ -101,57 +110,46 @@ import time
 #
 ########################################################################################
 
+# Columns of the source spreadsheet read by InterfaceableAssetspecFromXls. Every
+# column from the third on holds the value of the attribute named in its header
+sheet_columns = [
+    ('assetnum', 0),
+    ('classificationid', 1),
+    ('attr_val', slice(2, None))
+]
+
 class InterfaceableAssetspecFromXls:
 
     """Class representing a set of Asset Specifications to be loaded by MEA from a spreadsheet"""
 
-    def __init__(self, worksheet, i, c, logger):
+    def __init__(self, row, asset_index, class_index, logger):
 
-        self.assetnum = worksheet.cell(i, 0).value
-        self.classificationid = worksheet.cell(i, 1).value
+        # Keys are resolved from the indexes preloaded for the whole sheet.
+        # Both are keyed on text, so numeric cells are looked up as text too
 
-        logger.debug("Getting assetid for asset %s" % (self.assetnum))
-        q_assid="""
-            SELECT assetid
-            FROM maximo.asset a
-            WHERE a.status = 'OPERATING'
-            AND a.assetnum = :assetnum"""
-        c.execute(q_assid, assetnum=self.assetnum)
-        this_assid = c.fetchone()
-        logger.debug("Assetid for asset %s looked up: %s" % (self.assetnum, this_assid))
-        if (this_assid == None):
-            self.assetuid = None
-        else:
-            self.assetuid = this_assid[0]
+        self.assetnum = cell_key(row.assetnum)
+        self.classificationid = cell_key(row.classificationid)
 
-        logger.debug("Getting classstructureid for classificationid %s" % (self.classificationid))
-        q_classid="""
-            SELECT classstructureid, usewithassets
-            FROM maximo.classstructure c
-            WHERE c.classificationid = :classificationid"""
-        c.execute(q_classid, classificationid=self.classificationid)
-        this_classid = c.fetchone()
-        logger.debug("classstructureid for asset %s looked up: %s" % (self.assetnum, this_classid))
-        if (this_classid == None):
-            self.classstructureid = None
-            self.usewithassets = 0
-        else:
-            self.classstructureid = this_classid[0]
-            self.usewithassets = this_classid[1]
+        self.assetuid = asset_index.assetids.get(self.assetnum)
+        logger.debug("Assetid for asset %s looked up: %s" % (self.assetnum, self.assetuid))
+
+        self.classstructureid, self.usewithassets = class_index.structures.get(self.classificationid, (None, 0))
+        self.loadable = self.classificationid in class_index.loadable
+        logger.debug("classstructureid for asset %s looked up: %s" % (self.assetnum, self.classstructureid))
 
         self.attr_val = []
 
-        for j in range(2, worksheet.ncols):
-            if (worksheet.cell(i, j).ctype == xlrd.XL_CELL_NUMBER) and (worksheet.cell(i, j).value == int(worksheet.cell(i, j).value)):
-                self.attr_val.append(int(worksheet.cell(i, j).value)) # 7824 Cast to integer to ensure no trailing '.0'
+        for value in row.attr_val:
+            if isinstance(value, float) and (value == int(value)):
+                self.attr_val.append(int(value)) # 7824 Cast to integer to ensure no trailing '.0'
             else:
-                self.attr_val.append(worksheet.cell(i, j).value)
-            logger.debug("Loaded attribute value %s" % worksheet.cell(i, j).value)
+                self.attr_val.append(value)
+            logger.debug("Loaded attribute value %s" % value)
 
         self.errmsg = None
         self.severity = None
 
-    def is_valid(self, c, logger):
+    def is_valid(self, logger):
 
         # Test for exceptions. An ERROR will cause the whole run to abort,
         # rolling back the transaction
@@ -159,36 +157,17 @@ class InterfaceableAssetspecFromXls:
         # The assetnum must be a valid Asset
 
         logger.debug("Checking asset %s exists" % (self.assetnum))
-
-        q_exists_ass="""
-            SELECT assetnum
-            FROM maximo.asset a
-            WHERE a.status = 'OPERATING'
-            AND a.assetnum = :assetnum"""
-        c.execute(q_exists_ass, assetnum=self.assetnum)
-        this_ass = c.fetchone()
-        logger.debug("Asset %s looked up: %s" % (self.assetnum, this_ass))
-        if (this_ass == None):
+        if (self.assetuid == None):
             logger.error("Asset %s does not exist" % (self.assetnum))
             print("ERROR: Asset %s does not exist" % (self.assetnum))
-
-        if (not this_ass):
             return False
 
         # The classificationid must be a designated loadable classification
         # on the HUL_MEALIE_CLASSIFICATION table
 
         logger.debug("Checking classification %s is legal" % (self.classificationid))
-
-        q_exists_class="""
-            SELECT classificationid
-            FROM maximo.hul_mealie_classification c
-            WHERE c.classificationid = :classificationid"""
-        c.execute(q_exists_class, classificationid=self.classificationid)
-        this_class = c.fetchone()
-        logger.debug("Legal Classification %s looked up: %s" % (self.classificationid, this_class))
-
-        if (not this_class):
+        if (not self.loadable):
+            logger.debug("Classification %s is not on HUL_MEALIE_CLASSIFICATION" % (self.classificationid))
             return False
 
         # 7796 The classificationid must be one that is intended to be used
@@ -202,6 +181,103 @@ class InterfaceableAssetspecFromXls:
 
         return True
 
+class ClassificationIndex:
+
+    """Classspec and HUL_MEALIE_ATTRIBUTE metadata for the classifications of a run"""
+
+    def __init__(self):
+
+        self.structures = {}   # classificationid -> (classstructureid, usewithassets)
+        self.loadable = set()  # classificationids on HUL_MEALIE_CLASSIFICATION
+        self.specs = {}        # (classificationid, assetattrid) -> (domainid, assetrequirevalue)
+        self.datatypes = {}    # (classificationid, assetattrid) -> datatype
+
+    def preload(self, c, classificationids, logger):
+
+        # Read the metadata of every classification in the sheet with one
+        # query of each kind per chunk instead of several queries per row and
+        # cell. Numeric cells arrive as floats, so the binds and the keys are
+        # the text Oracle compares classificationids as
+
+        q_get_structures = """
+            SELECT c.classificationid, c.classstructureid, c.usewithassets
+            FROM maximo.classstructure c
+            WHERE c.classificationid IN (%s)"""
+
+        q_get_loadable = """
+            SELECT c.classificationid
+            FROM maximo.hul_mealie_classification c
+            WHERE c.classificationid IN (%s)"""
+
+        q_get_specs = """
+            SELECT cst.classificationid, csp.assetattrid, csp.domainid, csp.assetrequirevalue
+            FROM maximo.classstructure cst
+            JOIN maximo.classspec csp ON csp.classstructureid = cst.classstructureid
+            WHERE cst.classificationid IN (%s)"""
+
+        q_get_types = """
+            SELECT c.classificationid, a.assetattrid, a.datatype
+            FROM maximo.hul_mealie_attribute a
+            JOIN maximo.hul_mealie_classification c ON c.id = a.hmc_id
+            WHERE entity_type = 'ASP'
+            AND c.classificationid IN (%s)"""
+
+        classificationids = list(set([cell_key(key) for key in classificationids]))
+        c.arraysize = key_chunk_size
+
+        for start in range(0, len(classificationids), key_chunk_size):
+            chunk = classificationids[start:start + key_chunk_size]
+            binds = dict(("k%d" % i, key) for i, key in enumerate(chunk))
+            placeholders = ", ".join([":k%d" % i for i in range(len(chunk))])
+
+            c.execute(q_get_structures % (placeholders), binds)
+            for row in c.fetchall():
+                self.structures.setdefault(cell_key(row[0]), (row[1], row[2]))
+
+            c.execute(q_get_loadable % (placeholders), binds)
+            self.loadable.update([cell_key(row[0]) for row in c.fetchall()])
+
+            c.execute(q_get_specs % (placeholders), binds)
+            for row in c.fetchall():
+                self.specs.setdefault((cell_key(row[0]), row[1]), (row[2], row[3]))
+
+            c.execute(q_get_types % (placeholders), binds)
+            for row in c.fetchall():
+                self.datatypes.setdefault((cell_key(row[0]), row[1]), row[2])
+
+        logger.debug("Loaded %d classspecs and %d attribute types for %d classifications" % (len(self.specs), len(self.datatypes), len(classificationids)))
+
+class AssetIndex:
+
+    """Assetids of the OPERATING assets named in a sheet"""
+
+    def __init__(self):
+
+        self.assetids = {}     # assetnum -> assetid
+
+    def preload(self, c, assetnums, logger):
+
+        # assetnum is a VARCHAR2, so numeric cells are bound and keyed as text
+
+        q_get_assetids = """
+            SELECT a.assetnum, a.assetid
+            FROM maximo.asset a
+            WHERE a.status = 'OPERATING'
+            AND a.assetnum IN (%s)"""
+
+        assetnums = list(set([cell_key(key) for key in assetnums]))
+        c.arraysize = key_chunk_size
+
+        for start in range(0, len(assetnums), key_chunk_size):
+            chunk = assetnums[start:start + key_chunk_size]
+            binds = dict(("k%d" % i, key) for i, key in enumerate(chunk))
+            placeholders = ", ".join([":k%d" % i for i in range(len(chunk))])
+            c.execute(q_get_assetids % (placeholders), binds)
+            for row in c.fetchall():
+                self.assetids.setdefault(cell_key(row[0]), row[1])
+
+        logger.debug("Resolved %d of %d assets" % (len(self.assetids), len(assetnums)))
+
 ########################################################################################
 #
 #     Functions
@@ -211,140 +287,61 @@ class InterfaceableAssetspecFromXls:
 def get_next_txn_id(c, logger):
 
     # Get the next available transaction id for a MEA batch
-    q_get_id = """
-    SELECT maximo.hul_mealie_asp_seq.NEXTVAL
-    FROM DUAL"""
-
-    c.execute(q_get_id)
-    txn_id = c.fetchone()
-    logger.debug("Obtained MEA Txn Id %s" % (txn_id[0]))
-
-    return txn_id[0]
-
-def get_queued_batch_ct(c, logger):
-
-    # Get the number of batches for THIS INTERFACE that 
-    # have yet to be processed by MEA
-    q_get_ct = """
-    SELECT COUNT(*)
-    FROM maximo.mxin_inter_trans 
-    WHERE extsysname = 'EXTSYS1'
-    AND ifacename = 'MXASSETSPECInterface'"""
-
-    time.sleep(5)       # t = seconds
-    c.execute(q_get_ct)
-    wait_ct = c.fetchone()
-    logger.info("MEA has %s unprocessed batches in the queue" % (wait_ct[0]))
+    return txn_ids.next_id(c, logger)
 
-    return wait_ct[0]
-
-def attrid_exists(conn, c, cls, attr, logger):
+def attrid_exists(conn, class_index, cls, attr, logger):
 
     # Verify the existence of attribute attr for classification cls
 
-    q_get_exists = """
-    SELECT 1
-    FROM maximo.classstructure cst
-    JOIN maximo.classspec csp ON csp.classstructureid = cst.classstructureid
-    WHERE cst.classificationid = :classificationid
-    AND csp.assetattrid = :assetattrid"""
-
-    c.execute(q_get_exists, classificationid=cls, assetattrid=attr)
-    result = c.fetchone()
-    if result == None:
-        logger.debug("Lookup q_get_exists failed in attrid_exists(): classificationid %s, assetattrid %s" % (cls, attr))
+    if (cls, attr) not in class_index.specs:
+        logger.debug("Lookup failed in attrid_exists(): classificationid %s, assetattrid %s" % (cls, attr))
         retval = False
     else:
         retval = True
     return retval
 
-def get_attr_domain_type(conn, c, cls, attr, logger):
+def get_attr_domain_type(conn, class_index, cls, attr, logger):
 
     # Determine the domainid of attribute a of classification c
 
-    q_get_type = """
-    SELECT csp.domainid
-    FROM maximo.classstructure cst
-    JOIN maximo.classspec csp ON csp.classstructureid = cst.classstructureid
-    WHERE cst.classificationid = :classificationid
-    AND csp.assetattrid = :assetattrid"""
-
-    c.execute(q_get_type, classificationid=cls, assetattrid=attr)
-    data_type = c.fetchone()
-    if not data_type:
+    spec = class_index.specs.get((cls, attr))
+    if not spec:
         logger.error("Lookup failed in get_attr_domain_type(): classificationid %s, assetattrid %s, aborting" % (cls, attr))
         print("ERROR: Lookup failed in get_attr_domain_type(): classificationid %s, assetattrid %s, aborting" % (cls, attr))
         conn.rollback()
         conn.close()         # Free the connection
         sys.exit(2)
-    return data_type[0]
+    return spec[0]
 
 
-def get_attr_assetrequirevalue(conn, c, cls, attr, logger):
+def get_attr_assetrequirevalue(conn, class_index, cls, attr, logger):
 
     # Get the assetrequirevalue of attribute a of classification c
 
-    q_get_type = """ SELECT csp.assetrequirevalue
-                           FROM maximo.classstructure cst
-                           JOIN maximo.classspec csp ON csp.classstructureid = cst.classstructureid
-                           WHERE cst.classificationid = :classificationid AND csp.assetattrid = :assetattrid"""
-
-    c.execute(q_get_type, classificationid=cls, assetattrid=attr)
-    data_type = c.fetchone()
-    if not data_type:
+    spec = class_index.specs.get((cls, attr))
+    if not spec:
         logger.error("Lookup failed in get_attr_assetrequirevalue(): classificationid %s, assetattrid %s, aborting" % (cls, attr))
         print("ERROR: Lookup failed in get_attr_assetrequirevalue(): classificationid %s, assetattrid %s, aborting" % (cls, attr))
         conn.rollback()
         conn.close()
         sys.exit(2)
-    return data_type[0]
-
-
+    return spec[1]
 
 
-def get_attr_type(c, cls, attr):
 
-    # Determine the datatype of attribute a of classification c
-
-    q_get_type = """
-    SELECT a.datatype
-    FROM maximo.hul_mealie_attribute a
-    JOIN maximo.hul_mealie_classification c ON c.id = a.hmc_id
-    WHERE a.assetattrid = :assetattrid
-    AND c.classificationid = :classificationid
-    AND entity_type = 'ASP'"""
-
-    c.execute(q_get_type, classificationid=cls, assetattrid=attr)
-    data_type = c.fetchone()
-
-    if (data_type == None):   # Not on the MAXIMO.HUL_MEALIE_ATTRIBUTE table
-        return None
-    else:
-        return data_type[0]
 
-def write_mea_queue(c, txid, logger):
+def get_attr_type(class_index, cls, attr):
 
-    # Insert row into MEA queue
-
-    q_write_queue = """
-    INSERT INTO maximo.mxin_inter_trans (
-                           extsysname,
-                           ifacename,
-                           action,
-                           transid
-                           )
-    VALUES ('EXTSYS1', 'MXASSETSPECInterface', 'AddChange', :trans_id)"""
-
-    logger.debug("Writing MEA queue for transid %d" % txid)
-    c.execute(q_write_queue, trans_id=txid)
-
-    return True
+    # Determine the datatype of attribute a of classification c. None if
+    # not on the MAXIMO.HUL_MEALIE_ATTRIBUTE table
 
+    return class_index.datatypes.get((cls, attr))
 
 def asp_handler(er):
 
     type_handler = {
-        "XLS": asp_handler_xls_ora
+        "XLS": asp_handler_xls_ora,
+        "CSV": asp_handler_xls_ora
     }
 
     return type_handler.get(er.source_type)(er)   # Call appropriate handler for the source type
@@ -360,18 +357,14 @@ def asp_handler_xls_ora(er):
 
     # Open source spreadsheet
 
-    try:
-        ifh = xlrd.open_workbook(er.source_xlsfile)
-    except IOError:
-        print("ERROR: Unable to open %s" % (er.source_xlsfile))
-        er.logger.error("Unable to open %s" % (er.source_xlsfile))
+    rows = open_sheet(er, sheet_columns)
+    if rows is None:
         return False
-    wsh = ifh.sheet_by_index(0)
 
     # Connect to MEA target database
 
     try:
-        conn_target = cx_Oracle.connect("%s/%s@%s" % (er.target_user, er.target_pwd, er.target_db))
+        conn_target = connect_target(er)
     except cx_Oracle.DatabaseError, exc:
         error, = exc.args
         print("ERROR: %s" % (error.message))
@@ -385,9 +378,9 @@ def asp_handler_xls_ora(er):
     attr_name = []       # Array to store attribute names
     er.logger.debug("Loading attribute names")
 
-    for i in range(2, wsh.ncols):
-        attr_name.append(wsh.cell(0, i).value)
-        er.logger.debug("%d Loaded attribute %s" % (i, wsh.cell(0, i).value))
+    for i in range(2, len(rows.header)):
+        attr_name.append(rows.header[i])
+        er.logger.debug("%d Loaded attribute %s" % (i, rows.header[i]))
 
     er.logger.debug("Loaded a total of %d attributes" % len(attr_name))
 
@@ -397,6 +390,9 @@ def asp_handler_xls_ora(er):
     curs_target_lookup = conn_target.cursor()
     curs_target_seq = conn_target.cursor()
 
+    # Transids are queued for MEA in array-bound inserts
+    mea_queue = MeaQueueWriter(curs_target_mea, 'MXASSETSPECInterface', er.batch_size, er.logger, 'AddChange')
+
     # Insert a row into MEA interface for entity type ASSET
 
     q_write_interface = """
@@ -438,16 +434,20 @@ def asp_handler_xls_ora(er):
     #queued_batches = 0 
     total_ct = 0       # Total no. of items
 
-    start_row = 1      # The first row in spreadsheet that contains data (start at 0)
+    # Assets and classification metadata are read once for the whole sheet
+    asset_index = AssetIndex()
+    asset_index.preload(curs_target_lookup, [row.assetnum for row in rows], er.logger)
+    class_index = ClassificationIndex()
+    class_index.preload(curs_target_lookup, [row.classificationid for row in rows], er.logger)
 
     # Iterate through all rows of data in input spreadsheet
 
-    for this_row in range(start_row, wsh.nrows):
+    for row in rows:
 
-        ia = InterfaceableAssetspecFromXls(wsh, this_row, curs_target_seq, er.logger)
+        ia = InterfaceableAssetspecFromXls(row, asset_index, class_index, er.logger)
         er.logger.info("Processing assetnum %s" % (ia.assetnum))
 
-        if (ia.is_valid(curs_target_lookup, er.logger)):
+        if (ia.is_valid(er.logger)):
 
             # Obtain new MEA transaction id for next asset 
 
@@ -465,7 +465,7 @@ def asp_handler_xls_ora(er):
 
                 er.logger.debug("Processing interface record for assetnum %s attribute %s" % (ia.assetnum, attr_name[attr]))
 
-                if attrid_exists(conn_target, curs_target_lookup, ia.classificationid, attr_name[attr], er.logger):
+                if attrid_exists(conn_target, class_index, ia.classificationid, attr_name[attr], er.logger):
                     pass
                 else:
                     er.logger.error("Attribute %s for classificationid %s does not exist, aborting" % (attr_name[attr], ia.classificationid))
@@ -489,7 +489,7 @@ def asp_handler_xls_ora(er):
 
                     # 7674 At the present time domain-constrained attributes are not
                     # allowed at all
-                    attr_domain_type = get_attr_domain_type(conn_target, curs_target_lookup, ia.classificationid, attr_name[attr], er.logger)
+                    attr_domain_type = get_attr_domain_type(conn_target, class_index, ia.classificationid, attr_name[attr], er.logger)
                     er.logger.debug("Attribute domain type for attribute %s is %s" % (attr_name[attr], attr_domain_type))
                     if attr_domain_type is None:
                         pass
@@ -501,7 +501,7 @@ def asp_handler_xls_ora(er):
                         sys.exit(2)
 
 
-                    data_type = get_attr_type(curs_target_lookup, ia.classificationid, attr_name[attr])
+                    data_type = get_attr_type(class_index, ia.classificationid, attr_name[attr])
                     er.logger.debug("Attribute %s is type %s" % (attr_name[attr], data_type))
 
                     if (data_type == None):
@@ -556,7 +556,7 @@ def asp_handler_xls_ora(er):
 
                     # 7880 There is no value. Ensure that the attribute is not
                     # mandatory for an asset
-                    attr_assetrequirevalue = get_attr_assetrequirevalue(conn_target, curs_target_lookup, ia.classificationid, attr_name[attr], er.logger)
+                    attr_assetrequirevalue = get_attr_assetrequirevalue(conn_target, class_index, ia.classificationid, attr_name[attr], er.logger)
                     er.logger.debug("Attribute %s is required for assets?: %s" % (attr_name[attr], attr_assetrequirevalue))
                     if attr_assetrequirevalue == 1:
                         er.logger.error("No value supplied for mandatory attribute %s for asset %s, aborting" % (attr_name[attr], ia.assetnum))
@@ -577,8 +577,8 @@ def asp_handler_xls_ora(er):
         # Write the MEA queue
         er.logger.info("Interface %d attributes for %s" % (attr_ct, ia.assetnum))
         if attr_ct:
-            write_mea_queue(curs_target_mea, trans_id, er.logger)
-            er.logger.debug("Wrote MEA queue for transid %d" % trans_id)
+            mea_queue.append(trans_id)
+            er.logger.debug("Queued transid %d" % trans_id)
         else:
             er.logger.debug("Did not write MEA queue for transid %d" % trans_id)
     
@@ -590,6 +590,7 @@ def asp_handler_xls_ora(er):
     # Otherwise we commit the whole transaction
 
     if (not er.test_mode):
+        mea_queue.flush()
         er.logger.info("Committing changes to MEA target %s" % er.target_db)
         conn_target.commit() 
     else:
@@ -598,18 +599,14 @@ def asp_handler_xls_ora(er):
 
     er.logger.info("Processed %s %s entities" % (total_ct, er.entity_type))
 
-    # Wait until MEA has flushed the queue
+    rows.close()   # The sheet is not needed while MEA loads
 
-    er.logger.info("Wait for MEA to flush its queue")
-    queued_batches = get_queued_batch_ct(curs_target_seq, er.logger)
-    while (queued_batches):
-        er.logger.debug("MEA still has %s items in queue" % (queued_batches))
-        queued_batches = get_queued_batch_ct(curs_target_seq, er.logger)
+    # Wait until MEA has flushed the queue and loaded our batches
 
-    if (not er.test_mode):
-        # Tune this value according to your cron configuration
-        er.logger.info("Waiting %d seconds for MEA to finish loading" % (er.mea_wait_interval))
-        time.sleep(er.mea_wait_interval)
+    if not wait_for_mea(curs_target_seq, 'MXASSETSPECInterface', er, 'maximo.mxassetspec_iface', mea_queue.queued):
+        print("ERROR: MEA did not load its MXASSETSPECInterface batches, aborting")
+        conn_target.close()         # Free the connection
+        sys.exit(2)
 
     print("Processed %s %s entities" % (total_ct, er.entity_type))
     print "See %s for full details of this run" % er.log_file
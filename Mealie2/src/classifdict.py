@@ -10,28 +10,41 @@ Created on 14 Jun 2012
 ########################################################################################
 
 import cx_Oracle
-import xlrd
 import sys
 import time
 
+from meabatch import MergeWriter
+from sheets import open_sheet
+from connpool import connect_target
+
 ########################################################################################
 #
 #     Class definitions
 #
 ########################################################################################
+
+# Columns of the source spreadsheet read by InterfaceableEntryFromXls
+sheet_columns = [
+    ('escn', 0),
+    ('esci', 1),
+    ('attr_seq', 2),
+    ('espn', 3),
+    ('espi', 4)
+]
+
 class InterfaceableEntryFromXls:
 
     """Class representing a UNSPSC Dictionary Entity to be inserted from a spreadsheet"""
 
-    def __init__(self, worksheet, i, c, logger):
+    def __init__(self, row, c, logger):
         
         # Values are taken from the UNSPSC Dictionary Template
 
-        self.escn = worksheet.cell(i, 0).value
-        self.esci = worksheet.cell(i, 1).value[:100] # commodities.description is varchar2(100)
-        self.attr_seq = worksheet.cell(i, 2).value
-        self.espn = worksheet.cell(i, 3).value[:100]
-        self.espi = worksheet.cell(i, 4).value
+        self.escn = row.escn
+        self.esci = row.esci[:100] # commodities.description is varchar2(100)
+        self.attr_seq = row.attr_seq
+        self.espn = row.espn[:100]
+        self.espi = row.espi
         
         self.errmsg = None
         self.severity = None
@@ -80,36 +93,41 @@ def get_next_txn_id(c, logger):
     
     return mealie_seq[0]
 
-def write_dict(c, escn, esci, attribute_seq, espn, espi, logger):
-
-    # Insert row into dictionary
-
-    q_insert_dict = """
-    INSERT INTO maximo.hul_classif_dict (
+def get_dict_writer(c, batch_size, logger):
+
+    # Rows are upserted into the dictionary in array-bound chunks. A row that
+    # is already there is left as it is, the MERGE matching on every column
+
+    q_merge_dict = """
+    MERGE INTO maximo.hul_classif_dict d
+    USING (SELECT :escn escn,
+                  :esci esci,
+                  :attribute_seq attribute_seq,
+                  :espn espn,
+                  :espi espi
+           FROM DUAL) s
+    ON (d.escn = s.escn
+        AND d.esci = s.esci
+        AND d.attribute_seq = s.attribute_seq
+        AND d.espn = s.espn
+        AND d.espi = s.espi)
+    WHEN NOT MATCHED THEN INSERT (
                            escn,
                            esci,
                            attribute_seq,
                            espn,    
                            espi
                            )
-    VALUES (:escn, :esci, :attribute_seq, :espn, :espi)"""
-
-    q_update_dict = """
-    UPDATE maximo.hul_classif_dict
-    SET escn = :escn, esci = UPPER(:esci), attribute_seq = :attribute_seq, espn = :espn, espi = :espi
-    WHERE escn = :escn
-    AND esci = :esci
-    AND attribute_seq = :attribute_seq
-    AND espn = :espn
-    AND espi = :espi"""
-
-    logger.debug("Inserting dictionary for %s %s %s %s" % (escn, esci, espi, espn))
-    try:
-        c.execute(q_insert_dict, escn=escn, esci=esci, attribute_seq=attribute_seq, espn=espn, espi=espi)
-    except cx_Oracle.IntegrityError:
-        logger.debug("Row already exists, attempting update")
-        logger.debug("Updating dictionary for %s %s %s %s" % (esci, escn, espi, espn))
-        c.execute(q_update_dict, escn=escn, esci=esci, attribute_seq=attribute_seq, espn=espn, espi=espi)
+        VALUES (s.escn, s.esci, s.attribute_seq, s.espn, s.espi)"""
+
+    return MergeWriter(c, 'maximo.hul_classif_dict', ['escn', 'esci', 'attribute_seq', 'espn', 'espi'], q_merge_dict, batch_size, logger)
+
+def write_dict(dict_writer, escn, esci, attribute_seq, espn, espi, logger):
+
+    # Merge row into dictionary
+
+    logger.debug("Merging dictionary for %s %s %s %s" % (escn, esci, espi, espn))
+    dict_writer.write(escn=escn, esci=esci, attribute_seq=attribute_seq, espn=espn, espi=espi)
 
     return True
 
@@ -117,7 +135,8 @@ def write_dict(c, escn, esci, attribute_seq, espn, espi, logger):
 def classif_handler(er):
 
     type_handler = {
-        "XLS": und_handler_xls_ora
+        "XLS": und_handler_xls_ora,
+        "CSV": und_handler_xls_ora
     }
 
     return type_handler.get(er.source_type)(er)   # Call appropriate handler for the source type
@@ -132,17 +151,13 @@ def und_handler_xls_ora(er):
         er.target_pwd = str(raw_input("Enter password for target %s@%s: " % (er.target_user, er.target_db)))
 
     # Open source spreadsheet
-    try:
-        ifh = xlrd.open_workbook(er.source_xlsfile)
-    except IOError:
-        print("ERROR: Unable to open %s" % (er.source_xlsfile))
-        er.logger.error("Unable to open %s" % (er.source_xlsfile))
+    rows = open_sheet(er, sheet_columns)
+    if rows is None:
         return False
-    wsh = ifh.sheet_by_index(0)
 
     # Connect to target database
     try:
-        conn_target = cx_Oracle.connect("%s/%s@%s" % (er.target_user, er.target_pwd, er.target_db))
+        conn_target = connect_target(er)
     except cx_Oracle.DatabaseError, exc:
         error, = exc.args
         print("ERROR: %s" %  (error.message))
@@ -151,10 +166,10 @@ def und_handler_xls_ora(er):
     
     # Open the necessary cursors on target database
     curs_target = conn_target.cursor()
+    dict_writer = get_dict_writer(curs_target, er.batch_size, er.logger)
 
     # Initialise local variables for fetch loop
     total_ct = 0       # Total no. of items
-    start_row = 1      # The first row in spreadsheet that contains data (starting at 0)
     
     prev_segment = None
     prev_family = None
@@ -162,9 +177,9 @@ def und_handler_xls_ora(er):
 
     # Iterate through all rows of data in input spreadsheet
 
-    for this_row in range(start_row, wsh.nrows):
+    for row in rows:
 
-        ie = InterfaceableEntryFromXls(wsh, this_row, curs_target, er.logger)
+        ie = InterfaceableEntryFromXls(row, curs_target, er.logger)
         er.logger.info("Processing %s %s %s %s %s" % (ie.escn, ie.esci, ie.attr_seq, ie.espn, ie.espi))
 
         if (ie.is_valid(curs_target, er.logger)):
@@ -175,7 +190,7 @@ def und_handler_xls_ora(er):
             
             
             # Code type 4 represents Commodity level
-            write_dict(curs_target, ie.escn, ie.esci, ie.attr_seq, ie.espn, ie.espi, er.logger)
+            write_dict(dict_writer, ie.escn, ie.esci, ie.attr_seq, ie.espn, ie.espi, er.logger)
             er.logger.debug("Processed to Dictionary")
             total_ct += 1
                 
@@ -187,6 +202,9 @@ def und_handler_xls_ora(er):
             #conn_target.close()         # Free the connection
             sys.exit(2)
 
+    dict_writer.flush()
+    er.logger.info("Dictionary rows inserted: %d, already present: %d" % (dict_writer.inserted, dict_writer.updated))
+
     # The transaction will not be committed if we are in 'test mode'
     # Otherwise we commit the whole transaction
 
@@ -81,6 +81,9 @@
 #
 ########################################################################################
 
+import os
+import stat
+
 ########################################################################################
 #
 #     Globals
@@ -89,6 +92,9 @@
 
 glprefixes=['E','R']
 
+# Dictionary entries and commodities are read for this many codes per query
+unspsc_chunk_size = 1000
+
 ########################################################################################
 #
 #     Class definitions
@@ -99,15 +105,17 @@ class UNSPSCDictionaryEntry:
 
     """8112 Class representing a UNSPSC dictionary entry (segment, family, class or commodity"""
 
-    def __init__(self, code, c, logger):
+    def __init__(self, code, c, logger, resultset=None):
         
         q_get_entry = """
         SELECT code, codetype, description, definition
         FROM maximo.hul_unspsc_dict
         WHERE description = :code"""
         
-        c.execute(q_get_entry, code=code)
-        resultset = c.fetchone()
+        # Without a cursor the caller has already fetched the row, if any
+        if c is not None:
+            c.execute(q_get_entry, code=code)
+            resultset = c.fetchone()
         if resultset == None:
             self.code = None
             self.codetype = None
@@ -119,6 +127,56 @@ class UNSPSCDictionaryEntry:
             self.description = resultset[2]
             self.definition = resultset[3]
 
+class UNSPSCIndex:
+
+    """8112 Dictionary entries and existing commodities for the codes of a sheet, read once per run"""
+
+    def __init__(self):
+
+        self.entries = {}          # description -> (code, codetype, description, definition)
+        self.commodities = set()   # commodity codes on maximo.commodities
+
+    def preload(self, c, codes, logger):
+
+        # Read every entry and commodity the sheet can refer to with one query
+        # of each kind per chunk instead of several queries per row. Entries
+        # are matched on description, as UNSPSCDictionaryEntry does
+
+        q_get_entries = """
+            SELECT code, codetype, description, definition
+            FROM maximo.hul_unspsc_dict
+            WHERE description IN (%s)"""
+
+        q_get_commodities = """
+            SELECT commodity
+            FROM maximo.commodities
+            WHERE commodity IN (%s)"""
+
+        codes = list(set([unspsc_key(code) for code in codes]))
+        c.arraysize = unspsc_chunk_size
+
+        for start in range(0, len(codes), unspsc_chunk_size):
+            chunk = codes[start:start + unspsc_chunk_size]
+            binds = dict(("k%d" % i, key) for i, key in enumerate(chunk))
+            placeholders = ", ".join([":k%d" % i for i in range(len(chunk))])
+
+            c.execute(q_get_entries % (placeholders), binds)
+            for row in c.fetchall():
+                self.entries.setdefault(row[2], row)
+
+            c.execute(q_get_commodities % (placeholders), binds)
+            self.commodities.update([row[0] for row in c.fetchall()])
+
+        logger.debug("Loaded %d dictionary entries and %d commodities for %d codes" % (len(self.entries), len(self.commodities), len(codes)))
+
+    def entry(self, code):
+
+        return UNSPSCDictionaryEntry(code, None, None, self.entries.get(unspsc_key(code)))
+
+    def commodity_exists(self, commodity):
+
+        return unspsc_key(commodity) in self.commodities
+
 
 ########################################################################################
 #
@@ -148,12 +206,23 @@ def usage():
 
 def stgusage():
 
-    print "Usage: mealie_stg -s stage -u username -p password -d database [-l severity-level]"
+    print "Usage: mealie_stg -s stage -u username -p password -d database [-l severity-level] [-w workers] [-c min,max] [-b batch-size] [-m stall,deadline]"
     print "       -s stage            Process stage file \"<stage>.stg\""
     print "       -u username         Connect to target database as user <username>"
     print "       -p password         Password for user <username>"
     print "       -d database         Connect to target database instance <database>"
     print "       -l severity-level   Logging severity level. 10=debug, 20=info, 40=error"
+    print "       -w workers          Run at most <workers> independent stage entries at once. Default 4"
+    print "       -c min,max          Keep between <min> and <max> pooled sessions on the target. Default 1,<workers>"
+    print "       -b batch-size       Write <batch-size> interface rows to the target per round trip. Default 500"
+    print "       -m stall,deadline   Give up on MEA after <stall> seconds without progress or <deadline> seconds in all. Default 180,3600"
+
+def daemonusage():
+
+    print "Usage: mealied [-s socket] [-c min,max] | -x"
+    print "       -s socket           Listen on UNIX socket <socket>. Default $MEALIE_SOCKET, else mealie.sock in $XDG_RUNTIME_DIR or ~/.mealie"
+    print "       -c min,max          Keep between <min> and <max> pooled sessions on each target. Default 1,4"
+    print "       -x                  Stop the daemon listening on the socket"
 
 def get_all_segments(seg2):
 
@@ -219,38 +288,65 @@ def get_unspsc_class(commcode):
     classcode = int(commcode/100) * 100  
     return classcode
 
+def cell_key(value):
+
+    # Numbers read from a spreadsheet cell arrive as floats. Compare them as
+    # the text Oracle's TO_CHAR would give, e.g. 1004.0 as '1004'. Text is
+    # returned as it is
+
+    if isinstance(value, float) and value == int(value):
+        value = int(value)
+    if isinstance(value, (int, long)):
+        value = str(value)
+    return value
+
+def unspsc_key(code):
+
+    # A UNSPSC code as the text Maximo keeps it, e.g. 43211500.0 as '43211500'
+
+    return cell_key(code)
+
+def private_dir(path):
+
+    # Create path if needed, readable and writable by this user only, and
+    # check that nobody else can plant files in it. Raises OSError if the
+    # directory belongs to another user or others may write to it
+
+    if not os.path.isdir(path):
+        os.makedirs(path, 0700)
+
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid():
+        raise OSError("%s is not a directory owned by you" % (path))
+    if st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise OSError("%s can be written by other users" % (path))
+
+    return path
+
 
 # Enable validation on xls files off ORGID and GLACCOUNT
 
 # Get orgids from Oracle and use them to populate a list
 # 6924 DJW Remove hard coded connection and pass connection object
 def read_orgids(conn):
-    orgids = []
     curs = conn.cursor()
+    curs.arraysize = 500
     curs.execute('SELECT orgid FROM maximo.organization')
-    row = curs.fetchone()
-    while row:
-        (orgid) = (row[0])
-        orgids.append(int(orgid))
-        row = curs.fetchone()
+    orgids = [int(row[0]) for row in curs.fetchall()]
+    curs.close()
     return orgids
 
-# MA00061 Get systemids f
-r systemid verification
+# MA00061 Get systemids for systemid verification
 def read_systemids(conn):
     systemids = {}
     curs = conn.cursor()
+    curs.arraysize = 500
     query = """SELECT systemid, TO_NUMBER(orgid) orgid
                    FROM maximo.locsystem"""
     curs.execute(query)
-    row = curs.fetchone()
-    while row:
-        (systemid, orgid) = (row[0], row[1])
-        if systemid in systemids:
-            systemids[systemid].append(orgid)
-        else:
-            systemids[systemid] = [int(orgid)]
-        row = curs.fetchone()
+    for (systemid, orgid) in curs.fetchall():
+        systemids.setdefault(systemid, []).append(int(orgid))
+    curs.close()
     return systemids
 
 # Get departments for second segment verification
@@ -258,19 +354,15 @@ def read_systemids(conn):
 def read_depts(conn):
     depts = {}
     curs = conn.cursor()
+    curs.arraysize = 500
     query = """SELECT compvalue, TO_NUMBER(orgid) orgid
                     FROM maximo.glcomponents 
                     WHERE glorder = 1
                     AND LENGTH(compvalue) = 5"""
     curs.execute(query)
-    row = curs.fetchone()
-    while row:
-        (dept, orgid) = (row[0], row[1])
-        if dept in depts:
-            depts[dept].append(orgid)
-        else:
-            depts[dept] = [int(orgid)]
-        row = curs.fetchone()
+    for (dept, orgid) in curs.fetchall():
+        depts.setdefault(dept, []).append(int(orgid))
+    curs.close()
     return depts
 
 def is_systemid_in_org(systemid, orgid, systemids, logger):
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+#
+# MEA Lightweight Integration Environment
+#
+# Target database connection pool. A stage logs in to the target once and its
+# entries borrow sessions from the pool rather than each logging in afresh
+#
+
+########################################################################################
+#
+#     Import required modules
+#
+########################################################################################
+
+import cx_Oracle
+
+########################################################################################
+#
+#     Globals
+#
+########################################################################################
+
+# Sessions found dead when borrowed are dropped and replaced, up to this many times
+acquire_attempts = 3
+
+########################################################################################
+#
+#     Class definitions
+#
+########################################################################################
+
+class ConnectionPool:
+
+    """Pool of sessions on the target database shared by the entries of a stage"""
+
+    def __init__(self, user, pwd, dsn, min_size, max_size, logger):
+
+        self.dsn = dsn
+        self.logger = logger
+        self.pool = cx_Oracle.SessionPool(user, pwd, dsn, min_size, max_size, 1, threaded=True)
+        self.pool.getmode = cx_Oracle.SPOOL_ATTRVAL_WAIT   # Wait for a free session rather than fail
+        logger.info("Opened pool of %d to %d sessions on %s" % (min_size, max_size, dsn))
+
+    def acquire(self, logger):
+
+        # Borrow a session, checking first that it is still usable. A session
+        # may have been killed or timed out while it sat in the pool
+
+        for attempt in range(acquire_attempts):
+            conn = self.pool.acquire()
+            try:
+                conn.ping()
+                logger.debug("Borrowed session from pool on %s, %d busy" % (self.dsn, self.pool.busy))
+                return PooledConnection(self, conn)
+            except cx_Oracle.DatabaseError, exc:
+                error, = exc.args
+                logger.info("Dropping dead pooled session: %s" % (error.message))
+                self.drop(conn)
+
+        # Dropped sessions are replaced by new logins, so a further failure is
+        # left for the handler to report as it would a failed connect
+        return PooledConnection(self, self.pool.acquire())
+
+    def release(self, conn):
+
+        # Anything the entry left uncommitted, including rows of global
+        # temporary tables, is discarded so that the next entry starts clean
+
+        try:
+            conn.rollback()
+            self.pool.release(conn)
+        except cx_Oracle.DatabaseError, exc:
+            error, = exc.args
+            self.logger.info("Dropping pooled session that could not be reset: %s" % (error.message))
+            self.drop(conn)
+
+    def drop(self, conn):
+
+        try:
+            self.pool.drop(conn)
+        except cx_Oracle.DatabaseError:
+            pass   # Already gone
+
+    def close(self):
+
+        self.logger.info("Closing pool of %d sessions on %s" % (self.pool.opened, self.dsn))
+        if hasattr(self.pool, 'close'):
+            self.pool.close(True)   # Also closes sessions an aborted entry never returned
+        self.pool = None
+
+class PooledConnection:
+
+    """A session borrowed from a ConnectionPool. Closing it returns the session to the pool"""
+
+    def __init__(self, pool, conn):
+
+        self.pool = pool
+        self.conn = conn
+
+    def __getattr__(self, name):
+
+        return getattr(self.conn, name)
+
+    def close(self):
+
+        # Handlers close on every exit path, some of them twice
+        if self.conn is not None:
+            self.pool.release(self.conn)
+            self.conn = None
+
+########################################################################################
+#
+#     Functions
+#
+########################################################################################
+
+def connect_target(er):
+
+    # Connection to the target of a run, borrowed from the pool of the stage
+    # if there is one. Failures raise cx_Oracle.DatabaseError as connect() does
+
+    if er.pool is not None:
+        return er.pool.acquire(er.logger)
+    return cx_Oracle.connect("%s/%s@%s" % (er.target_user, er.target_pwd, er.target_db))
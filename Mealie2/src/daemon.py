@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+#
+# MEA Lightweight Integration Environment
+#
+# Warm daemon. A long running process that keeps connection pools to the
+# targets, the reference data snapshots and the imported entity handlers in
+# memory, and runs mealie and mealie_stg jobs sent to it over a local UNIX
+# socket by daemonclient
+#
+
+########################################################################################
+#
+#     Import required modules
+#
+########################################################################################
+
+import os
+import sys
+import json
+import getopt
+import socket
+import logging
+import threading
+import traceback
+import SocketServer
+
+import cx_Oracle
+
+import launcher
+from common import daemonusage, private_dir
+from connpool import ConnectionPool
+from handlers import get_handler, HandlerError
+from stage import stage_handler
+from daemonclient import socket_path, peer_uid, connect_daemon, send_job, exit_marker
+
+########################################################################################
+#
+#     Globals
+#
+########################################################################################
+
+# Default -c option, the size of the pool kept for each target
+default_pool_size = "1,4"
+
+########################################################################################
+#
+#     Class definitions
+#
+########################################################################################
+
+class JobOutput:
+
+    """Stands in for sys.stdout while a job runs, sending what the job prints to the client"""
+
+    def __init__(self, wfile):
+
+        self.wfile = wfile
+        self.lock = threading.Lock()   # Stage entries print from their own threads
+        self.connected = True
+        self.at_line_start = True
+
+    def write(self, text):
+
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        if not text:
+            return
+
+        self.lock.acquire()
+        try:
+            if self.connected:
+                try:
+                    self.wfile.write(text)
+                    self.wfile.flush()
+                except socket.error:
+                    self.connected = False   # A client that goes away does not stop the load
+            self.at_line_start = text.endswith('\n')
+        finally:
+            self.lock.release()
+
+    def flush(self):
+
+        pass
+
+    def finish(self, code):
+
+        if not self.at_line_start:
+            self.write('\n')
+        self.write("%s%d\n" % (exit_marker, code))
+
+class JobHandler(SocketServer.StreamRequestHandler):
+
+    """One job request from a client"""
+
+    def handle(self):
+
+        # The socket is private to the owner, but check anyway: a job may carry
+        # a password and runs with the owner's rights
+        try:
+            uid = peer_uid(self.request)
+        except socket.error:
+            uid = None
+        if uid != os.getuid():
+            self.server.logger.error("Refused job from user id %s" % (uid))
+            return
+
+        output = JobOutput(self.wfile)
+        try:
+            request = client_strings(json.loads(self.rfile.readline()))
+        except ValueError:
+            output.write("ERROR: Unreadable request to the MEALIE daemon\n")
+            output.finish(2)
+            return
+
+        output.finish(self.server.run_job(request, output))
+
+class MealieDaemon(SocketServer.UnixStreamServer):
+
+    """Runs jobs one at a time, in the working directory of the client that sent them. What stays warm between jobs: a ConnectionPool per target, the snapshots of refcache and the handlers loaded through handlers.get_handler"""
+
+    def __init__(self, socket_path, pool_min, pool_max, logger):
+
+        self.pool_min = pool_min
+        self.pool_max = pool_max
+        self.logger = logger
+        self.pools = {}
+        self.stopping = False
+
+        # Jobs carry passwords, so only the owner of the daemon may connect
+        umask = os.umask(077)
+        try:
+            SocketServer.UnixStreamServer.__init__(self, socket_path, JobHandler)
+        finally:
+            os.umask(umask)
+
+    def serve(self):
+
+        self.logger.info("Listening on %s" % (self.server_address))
+        while not self.stopping:
+            self.handle_request()
+
+    def pool(self, user, pwd, db):
+
+        # The pool for a target, opened by the first job that needs it. None if
+        # it cannot be opened, in which case the job connects and reports the
+        # failure as it would outside the daemon
+
+        key = (user.lower(), db.lower(), pwd)
+        if key not in self.pools:
+            try:
+                self.pools[key] = ConnectionPool(user, pwd, db, self.pool_min, self.pool_max, self.logger)
+            except cx_Oracle.DatabaseError, exc:
+                error, = exc.args
+                self.logger.error("Unable to open pool on %s@%s: %s" % (user, db, error.message))
+                return None
+        return self.pools[key]
+
+    def run_job(self, request, output):
+
+        # Run a job as its command would run in the client's shell. Returns
+        # the exit code the command would have had
+
+        command = request.get('command')
+        self.logger.info("Running %s %s in %s" % (command, " ".join(request.get('argv', [])), request.get('cwd')))
+
+        if command == 'stop':
+            self.stopping = True
+            output.write("MEALIE daemon on %s stopping\n" % (self.server_address))
+            return 0
+
+        saved = (sys.stdout, sys.stdin, os.getcwd())
+        mealie_logger = logging.getLogger('MealieLogger')
+        saved_handlers = list(mealie_logger.handlers)
+
+        sys.stdout = output
+        sys.stdin = open(os.devnull)   # Prompts fail rather than wait on the daemon's terminal
+
+        try:
+            try:
+                os.chdir(request['cwd'])
+                if command == 'run':
+                    code = self.run_entity(request)
+                elif command == 'stage':
+                    code = self.run_stage(request)
+                else:
+                    print("ERROR: Unknown MEALIE daemon command %s" % (command))
+                    code = 2
+            except SystemExit, e:
+                if e.code is None:
+                    code = 0
+                elif isinstance(e.code, int):
+                    code = e.code
+                else:
+                    print(e.code)
+                    code = 1
+            except Exception:
+                print("ERROR: %s" % (sys.exc_info()[1]))
+                self.logger.error("Job failed\n%s" % (traceback.format_exc()))
+                code = 1
+        finally:
+            sys.stdin.close()
+            (sys.stdout, sys.stdin, cwd) = saved
+            os.chdir(cwd)
+
+            # Log files opened by the job are closed with it
+            for handler in list(mealie_logger.handlers):
+                if handler not in saved_handlers:
+                    mealie_logger.removeHandler(handler)
+                    handler.close()
+
+        self.logger.info("%s finished with exit code %d" % (command, code))
+        return code
+
+    def run_entity(self, request):
+
+        er = launcher.main(request['argv'])
+        if (not er.target_pwd):
+            er.target_pwd = request.get('target_pwd')
+        if (er.target_pwd):
+            er.pool = self.pool(er.target_user, er.target_pwd, er.target_db)
+
+        try:
+            handler = get_handler(er.entity_type, er.logger)
+        except HandlerError, e:
+            print("ERROR: %s" % (e))
+            er.logger.error("%s" % (e))
+            return 2
+
+        try:
+            handler(er)
+        finally:
+            er.registry.close()
+
+        return 0
+
+    def run_stage(self, request):
+
+        sb = launcher.stage(request['argv'])
+        if (not sb.target_pwd):
+            sb.target_pwd = request.get('target_pwd')
+
+        pool = None
+        if (sb.target_pwd):
+            pool = self.pool(sb.target_user, sb.target_pwd, sb.target_db)
+
+        stage_handler(sb, pool)
+
+        return 0
+
+    def server_close(self):
+
+        SocketServer.UnixStreamServer.server_close(self)
+        for pool in self.pools.values():
+            pool.close()
+        self.pools = {}
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+########################################################################################
+#
+#     Functions
+#
+########################################################################################
+
+def client_strings(value):
+
+    # JSON decodes to unicode. Arguments, paths and passwords are handed on as
+    # the byte strings the client had
+
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [client_strings(item) for item in value]
+    if isinstance(value, dict):
+        return dict([(client_strings(key), client_strings(item)) for (key, item) in value.items()])
+    return value
+
+def daemon_main(argv):
+
+    path = socket_path()
+    pool_size = default_pool_size
+    stop = False
+
+    try:
+        opts, _args = getopt.getopt(argv, "s:c:x")
+    except getopt.GetoptError:
+        daemonusage()
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt == '-s':
+            path = arg
+        elif opt == '-c':
+            pool_size = arg
+        elif opt == '-x':
+            stop = True
+
+    if (stop):
+        sock = connect_daemon(path)
+        if sock is None:
+            print("ERROR: No MEALIE daemon is listening on %s" % (path))
+            sys.exit(2)
+        sys.exit(send_job(sock, 'stop', []))
+
+    try:
+        (pool_min, pool_max) = [int(size) for size in pool_size.split(',')]
+    except ValueError:
+        pool_min = pool_max = -1
+
+    if (pool_min < 1 or pool_max < pool_min):
+        print "ERROR: Invalid connection pool size %s" % (pool_size)
+        daemonusage()
+        sys.exit(2)
+
+    # Jobs carry passwords, so the socket may only live where no other user
+    # can create or replace it
+    try:
+        private_dir(os.path.dirname(os.path.abspath(path)))
+    except OSError, exc:
+        print("ERROR: Cannot listen on %s: %s" % (path, exc))
+        sys.exit(2)
+
+    # A socket file nobody listens on is left over from a daemon that died
+    sock = connect_daemon(path)
+    if sock is not None:
+        sock.close()
+        print("ERROR: A MEALIE daemon is already listening on %s" % (path))
+        sys.exit(2)
+    if os.path.exists(path):
+        os.remove(path)
+
+    daemon_logger = logging.getLogger('MealieDaemon')
+    daemon_logger.setLevel(logging.INFO)
+    sh = logging.StreamHandler(sys.stderr)
+    sh.setFormatter(logging.Formatter("%(asctime)-15s %(levelname)-5s %(message)s"))
+    daemon_logger.addHandler(sh)
+
+    daemon = MealieDaemon(path, pool_min, pool_max, daemon_logger)
+    try:
+        daemon.serve()
+    finally:
+        daemon.server_close()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+#
+# MEA Lightweight Integration Environment
+#
+# Thin client of the warm daemon. mealie and mealie_stg hand their arguments
+# to the daemon when one is listening, and run in process as before when none
+# is. Only standard modules are imported here, so that a job handed to the
+# daemon does not pay for the imports of an in process run.
+#
+# A job carries the target password, so it is only sent to a daemon run by the
+# same user: the socket lives in a directory private to the user, and both its
+# owner and the process listening on it are checked before anything is sent
+#
+
+########################################################################################
+#
+#     Import required modules
+#
+########################################################################################
+
+import os
+import sys
+import stat
+import json
+import struct
+import getopt
+import socket
+import ConfigParser
+
+########################################################################################
+#
+#     Globals
+#
+########################################################################################
+
+# Socket file in the directory given by socket_dir(). Overridden by the
+# MEALIE_SOCKET environment variable or the daemon's -s option
+socket_name = 'mealie.sock'
+
+# Linux value, not exported by the socket module of Python 2
+SO_PEERCRED = getattr(socket, 'SO_PEERCRED', 17)
+
+# Last line sent for a job, followed by its exit code. Job output never contains NUL
+exit_marker = '\0mealie-exit '
+
+########################################################################################
+#
+#     Functions
+#
+########################################################################################
+
+def socket_dir():
+
+    # $XDG_RUNTIME_DIR if the session has one, else ~/.mealie. Never the
+    # shared temporary directory
+
+    return os.environ.get('XDG_RUNTIME_DIR') or os.path.join(os.path.expanduser('~'), '.mealie')
+
+def socket_path():
+
+    return os.environ.get('MEALIE_SOCKET') or os.path.join(socket_dir(), socket_name)
+
+def peer_uid(sock):
+
+    # User id of the process at the other end of a connected UNIX socket
+
+    creds = sock.getsockopt(socket.SOL_SOCKET, SO_PEERCRED, struct.calcsize('3i'))
+    (_pid, uid, _gid) = struct.unpack('3i', creds)
+    return uid
+
+def connect_daemon(path):
+
+    # A socket connected to the daemon listening on path, or None if there is
+    # none or it is not this user's own
+
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return None
+    if not stat.S_ISSOCK(st.st_mode) or st.st_uid != os.getuid():
+        print("WARNING: Ignoring MEALIE daemon socket %s, it is not owned by you" % (path))
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        uid = peer_uid(sock)
+    except socket.error:
+        sock.close()
+        return None
+    if uid != os.getuid():
+        print("WARNING: Ignoring MEALIE daemon on %s, it is run by another user" % (path))
+        sock.close()
+        return None
+
+    return sock
+
+def send_job(sock, command, argv, target_pwd=None):
+
+    # Send a job to the daemon and copy its output to stdout. Returns the
+    # exit code of the job
+
+    request = {'command': command,
+               'argv': argv,
+               'cwd': os.getcwd(),
+               'target_pwd': target_pwd}
+
+    rfile = sock.makefile('rb')
+    sock.sendall(json.dumps(request) + '\n')
+
+    code = None
+    for line in iter(rfile.readline, ''):
+        if line.startswith(exit_marker):
+            code = int(line[len(exit_marker):])
+            break
+        sys.stdout.write(line)
+        sys.stdout.flush()
+
+    rfile.close()
+    sock.close()
+
+    if code is None:
+        print("ERROR: Lost connection to the MEALIE daemon")
+        code = 2
+
+    return code
+
+def run_client(argv):
+
+    # mealie through the daemon. Returns the exit code, or None if no daemon
+    # is listening and the run should go ahead in process
+
+    sock = connect_daemon(socket_path())
+    if sock is None:
+        return None
+
+    # The daemon cannot prompt, so a password missing from the parameter file
+    # is asked for here. Any error in the arguments is left to the daemon
+    target_pwd = None
+    try:
+        opts, _args = getopt.getopt(argv, "e:k:p:l:tufV")
+        param_file = dict(opts).get('-p')
+        if (param_file):
+            config = ConfigParser.ConfigParser()
+            config.read(param_file)
+            try:
+                target_pwd = config.get('target', 'pwd')
+            except ConfigParser.NoOptionError:
+                target_pwd = str(raw_input("Enter password for target %s@%s: " % (config.get('target', 'user'), config.get('target', 'db'))))
+    except (getopt.GetoptError, ConfigParser.Error):
+        pass
+
+    return send_job(sock, 'run', argv, target_pwd)
+
+def stage_client(argv):
+
+    # mealie_stg through the daemon, as run_client
+
+    sock = connect_daemon(socket_path())
+    if sock is None:
+        return None
+
+    target_pwd = None
+    try:
+        opts = dict(getopt.getopt(argv, "s:u:p:d:l:w:c:b:m:")[0])
+        if ('-p' not in opts and '-u' in opts and '-d' in opts):
+            target_pwd = str(raw_input("Enter password for %s@%s: " % (opts['-u'], opts['-d'])))
+    except getopt.GetoptError:
+        pass
+
+    return send_job(sock, 'stage', argv, target_pwd)
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+#
+# MEA Lightweight Integration Environment
+#
+# Entity handler registry. Maps each entity type to the module and function
+# that handle it. A handler module is only imported when a run or stage record
+# needs it, so that a run does not pay for the imports of entities it does not
+# process. Run this module to check how long each handler takes to load:
+#
+#     python handlers.py [entity type ...]
+#
+
+########################################################################################
+#
+#     Import required modules
+#
+########################################################################################
+
+import os
+import sys
+import time
+import subprocess
+
+########################################################################################
+#
+#     Globals
+#
+########################################################################################
+
+entity_handlers = {
+    "ASP": ("entities.assetspecs", "asp_handler"),
+    "ASS": ("entities.assets", "ass_handler"),
+    "COM": ("entities.commodities", "com_handler"),
+    "ICG": ("entities.itemcomm", "icg_handler"),
+    "LOC": ("entities.locations", "loc_handler"),
+    "UND": ("entities.unspscdict", "und_handler"),
+    "UOM": ("entities.measureunits", "uom_handler"),
+    "ISP3": ("entities.ItemSpec3", "isp_handler"),
+    "ISP2": ("entities.ItemSpec3", "isp_handler"),   # ISP2 stage records have been handled by ItemSpec3
+    "ISPS": ("entities.ItemSpec3", "isps_handler"),
+    "CLD": ("entities.classifdict", "classif_handler"),
+    "SPE": ("entities.Specifications", "class_handler"),
+    "ATTR": ("entities.AttributeSpec", "Attribute_handler"),
+    "ITEM": ("entities.item", "item_handler"),
+    "INVB": ("entities.InvBalance", "invbalance_handler"),
+    "INV": ("entities.Inventory", "inventory_handler"),
+    "POF": ("entities.PoFind", "po_handler"),
+    "TOOL": ("entities.Items_Tools", "ToolItem_handler"),
+    "CLCO": ("entities.Specifications_ClassIDComm", "classcomm_handler")
+}
+
+# Seconds a handler module may take to import, including everything it imports
+import_budget = 2.0
+
+loaded_handlers = {}
+
+########################################################################################
+#
+#     Class definitions
+#
+########################################################################################
+
+class HandlerError(Exception):
+
+    """The handler for an entity type cannot be loaded"""
+
+########################################################################################
+#
+#     Functions
+#
+########################################################################################
+
+def is_entity_type(entity_type):
+
+    return entity_type in entity_handlers
+
+def get_handler(entity_type, logger=None):
+
+    # Return the handler function for entity_type, importing its module on
+    # first use. Imports that take longer than the budget are logged
+
+    if entity_type in loaded_handlers:
+        return loaded_handlers[entity_type]
+
+    if entity_type not in entity_handlers:
+        raise HandlerError("Cannot process unknown entity type \'%s\'" % (entity_type))
+    (module_name, function_name) = entity_handlers[entity_type]
+
+    start = time.time()
+    try:
+        __import__(module_name)
+        handler = getattr(sys.modules[module_name], function_name)
+    except (ImportError, AttributeError), e:
+        raise HandlerError("Cannot load handler for entity type %s from %s: %s" % (entity_type, module_name, e))
+    elapsed = time.time() - start
+
+    if logger is not None:
+        if elapsed > import_budget:
+            logger.warning("Loading the %s handler took %.2fs, over the budget of %.2fs" % (entity_type, elapsed, import_budget))
+        else:
+            logger.debug("Loaded the %s handler in %.2fs" % (entity_type, elapsed))
+
+    loaded_handlers[entity_type] = handler
+    return handler
+
+def time_handler_import(entity_type):
+
+    # Seconds taken to load the handler for entity_type in a fresh
+    # interpreter, as a single run would. Raises HandlerError if it cannot load
+
+    code = ("import time, handlers; start = time.time(); "
+            "handlers.get_handler(%r); print time.time() - start" % (entity_type))
+    proc = subprocess.Popen([sys.executable, '-c', code],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    (out, err) = proc.communicate()
+    if proc.returncode != 0:
+        raise HandlerError(err.strip().splitlines()[-1])
+
+    return float(out.split()[-1])
+
+def check_import_budget(entity_types):
+
+    # Report the load time of each handler against the budget. Returns the
+    # number of handlers over budget and the number that could not be loaded
+
+    over_ct = 0
+    failed_ct = 0
+
+    for entity_type in entity_types:
+        try:
+            elapsed = time_handler_import(entity_type)
+        except HandlerError, e:
+            print "%-5s NOT LOADABLE: %s" % (entity_type, e)
+            failed_ct += 1
+            continue
+        if elapsed > import_budget:
+            print "%-5s %6.2fs OVER BUDGET" % (entity_type, elapsed)
+            over_ct += 1
+        else:
+            print "%-5s %6.2fs" % (entity_type, elapsed)
+
+    print "Budget is %.2fs per handler, %d over budget, %d not loadable" % (import_budget, over_ct, failed_ct)
+
+    return (over_ct, failed_ct)
+
+if __name__ == "__main__":
+    entity_types = sys.argv[1:] or sorted(entity_handlers.keys())
+    (over_ct, failed_ct) = check_import_budget(entity_types)
+    if failed_ct:
+        sys.exit(2)   # A handler that cannot load cannot be timed, the check has not passed
+    if over_ct:
+        sys.exit(1)
@@ -22,14 +22,15 @@
 ########################################################################################
 
 import cx_Oracle
-import xlrd
 import sys
-import time
 
 from common import get_unspsc_class
+from sheets import open_sheet, NUMBER
+from meabatch import TxnIdAllocator, wait_for_mea
+from connpool import connect_target
 
-# Values of commodity that have been processed. Only first occurrence in file is processed
-processed_ic = []
+# MEA transaction ids are allocated in blocks from the entity sequence
+txn_ids = TxnIdAllocator('maximo.hul_mealie_icg_seq')
 
 ########################################################################################
 #
@@ -37,12 +38,18 @@ processed_ic = []
 #
 ########################################################################################
 
+# Columns of the source spreadsheet read by InterfaceableItemCommodityFromXls
+sheet_columns = [
+    ('itemnum', 0),
+    ('commodity', 3, NUMBER)
+]
+
 class InterfaceableItemCommodityFromXls:
 
     """Class representing a Commodity Group or Commodity Code to be associated with an Item and 
     loaded by MEA from a spreadsheet"""
 
-    def __init__(self, worksheet, i, c, logger):
+    def __init__(self, row, c, logger):
         
         # Values are taken from the Item Classification Template
 
@@ -50,8 +57,8 @@ class InterfaceableItemCommodityFromXls:
         # Template would have many duplicate Properties. Thus in effect only the first one 
         # encountered is loaded to MEA
 
-        self.itemnum = worksheet.cell(i, 0).value
-        self.commodity = worksheet.cell(i, 3).value
+        self.itemnum = row.itemnum
+        self.commodity = row.commodity
 
         self.errmsg = None
         self.severity = None
@@ -81,33 +88,7 @@ class InterfaceableItemCommodityFromXls:
 def get_next_txn_id(c, logger):
 
     # Get the next available transaction id for a MEA batch
-    q_get_id = """
-    SELECT maximo.hul_mealie_icg_seq.NEXTVAL
-    FROM DUAL"""
-
-    c.execute(q_get_id)
-    txn_id = c.fetchone()
-    logger.debug("Obtained MEA Txn Id %s" % (txn_id[0]))
-
-    return txn_id[0]
-
-def get_queued_batch_ct(c, logger):
-
-    # Get the number of batches for THIS INTERFACE that 
-    # have yet to be processed by MEA
-    q_get_ct = """
-    SELECT COUNT(*)
-    FROM maximo.mxin_inter_trans 
-    WHERE extsysname = 'EXTSYS1'
-    AND ifacename = 'MXITEMCOMMInterface'"""
-
-    time.sleep(5)       # t = seconds
-    c.execute(q_get_ct)
-    wait_ct = c.fetchone()
-    logger.info("MEA has %s unprocessed batches in the queue" % (wait_ct[0]))
-
-    return wait_ct[0]
-
+    return txn_ids.next_id(c, logger)
 
 def write_mea_queue(c, txid, logger):
 
@@ -127,7 +108,7 @@ def write_mea_queue(c, txid, logger):
 
     return True
 
-def process_item(ic, c, logger):
+def process_item(ic, c, processed_ic, logger):
     
     # Insert a row into MEA interface for this entity type 
     q_write_interface = """
@@ -169,7 +150,7 @@ def process_item(ic, c, logger):
                                      transid=trans_id,
                                      transseq=trans_seq)
         logger.debug("Wrote interface")
-        processed_ic.append(ic.itemnum)     # We processed it, remember it
+        processed_ic.add(ic.itemnum)     # We processed it, remember it
 
         # Write the MEA queue
         ##write_mea_queue(c, trans_id, logger)
@@ -187,7 +168,8 @@ def process_item(ic, c, logger):
 def icg_handler(er):
 
     type_handler = {
-        "XLS": icg_handler_xls_ora
+        "XLS": icg_handler_xls_ora,
+        "CSV": icg_handler_xls_ora
     }
 
     return type_handler.get(er.source_type)(er)   # Call appropriate handler for the source type
@@ -203,18 +185,14 @@ def icg_handler_xls_ora(er):
 
     # Open source spreadsheet
 
-    try:
-        ifh = xlrd.open_workbook(er.source_xlsfile)
-    except IOError:
-        print("ERROR: Unable to open %s" % (er.source_xlsfile))
-        er.logger.error("Unable to open %s" % (er.source_xlsfile))
+    rows = open_sheet(er, sheet_columns)
+    if rows is None:
         return False
-    wsh = ifh.sheet_by_index(0)
 
     # Connect to MEA target database
 
     try:
-        conn_target = cx_Oracle.connect("%s/%s@%s" % (er.target_user, er.target_pwd, er.target_db))
+        conn_target = connect_target(er)
     except cx_Oracle.DatabaseError, exc:
         error, = exc.args
         print("ERROR: %s" % (error.message))
@@ -229,13 +207,13 @@ def icg_handler_xls_ora(er):
     # Initialise local variables for fetch loop
 
     total_ct = 0       # Total no. of items
-    start_row = 1      # The first row in spreadsheet that contains data (starting at 0)
+    processed_ic = er.registry.keys('itemcomm')   # Keys already processed in this run. Only the first occurrence is processed
 
     # Iterate through all rows of data in input spreadsheet
 
-    for this_row in range(start_row, wsh.nrows):
+    for row in rows:
 
-        ic = InterfaceableItemCommodityFromXls(wsh, this_row, curs_target_mea, er.logger)
+        ic = InterfaceableItemCommodityFromXls(row, curs_target_mea, er.logger)
         er.logger.info("Processing commodity %s for item %s" % (ic.commodity, ic.itemnum))
 
         if (ic.is_valid(curs_target_lookup, er.logger)):
@@ -258,7 +236,7 @@ def icg_handler_xls_ora(er):
                 er.logger.debug("Commodity %s is a UNSPSC Commodity Code" % (ic.commodity))
                 ic.commoditygroup = get_unspsc_class(ic.commodity)
 
-            total_ct += process_item(ic, curs_target_mea, er.logger)
+            total_ct += process_item(ic, curs_target_mea, processed_ic, er.logger)
                         
         else:
 
@@ -276,24 +254,22 @@ def icg_handler_xls_ora(er):
     if (not er.test_mode):
         er.logger.info("Committing changes to MEA target %s" % er.target_db)
         conn_target.commit() 
+        er.registry.commit()
     else:
         er.logger.info("Test Mode: Rolling back changes to %s" % er.target_db)
         conn_target.rollback() 
+        er.registry.rollback()
 
     er.logger.info("Processed %s %s entities" % (total_ct, er.entity_type))
 
-    # Wait until MEA has flushed the queue
+    rows.close()   # The sheet is not needed while MEA loads
 
-    er.logger.info("Wait for MEA to flush its queue")
-    queued_batches = get_queued_batch_ct(curs_target_mea, er.logger)
-    while (queued_batches):
-        er.logger.debug("MEA still has %s items in queue" % (queued_batches))
-        queued_batches = get_queued_batch_ct(curs_target_mea, er.logger)
+    # Wait until MEA has flushed the queue
 
-    if (not er.test_mode):
-        # Tune this value according to your cron configuration
-        er.logger.info("Waiting %d seconds for MEA to finish loading" % (er.mea_wait_interval))
-        time.sleep(er.mea_wait_interval)
+    if not wait_for_mea(curs_target_mea, 'MXITEMCOMMInterface', er):
+        print("ERROR: MEA did not flush its MXITEMCOMMInterface queue, aborting")
+        conn_target.close()         # Free the connection
+        sys.exit(2)
 
     print("Processed %s %s entities" % (total_ct, er.entity_type))
     print "See %s for full details of this run" % er.log_file
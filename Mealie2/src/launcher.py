@@ -84,6 +84,9 @@ import string
 import os
 
 from common import usage, stgusage
+from registry import KeyRegistry
+from rowcache import RowCache, default_rows_max_mb, default_rows_max_files
+from sheets import file_source_types
 
 ########################################################################################
 #
@@ -100,7 +103,8 @@ class EntityRun:
                       source_type,
                       target_db, target_user, target_pwd,
                       entity_type, entity_key, entity_level,
-                      mea_wait_interval,
+                      mea_wait_interval, mea_wait_deadline, batch_size,
+                      cache_dir, cache_ttl, registry, row_cache, pool,
                       normal_mode, test_mode, full_mode
                     ):
 
@@ -125,6 +129,16 @@ class EntityRun:
         self.entity_level = entity_level
 
         self.mea_wait_interval = mea_wait_interval
+        self.mea_wait_deadline = mea_wait_deadline
+        self.batch_size = batch_size
+
+        self.cache_dir = cache_dir
+        self.cache_ttl = cache_ttl
+
+        self.registry = registry
+        self.row_cache = row_cache   # None if parsed rows are not cached
+
+        self.pool = pool   # Target connection pool of a stage, None to connect directly
 
         self.normal_mode = normal_mode
         self.test_mode = test_mode
@@ -134,11 +148,19 @@ class StageBatch:
     """Class to represent a Stage to be processed"""
 
     def __init__(self, stage_file, log_severity,
-                      target_db, target_user, target_pwd
+                      target_db, target_user, target_pwd,
+                      workers, pool_min, pool_max, batch_size,
+                      mea_wait_interval, mea_wait_deadline
                     ):
 
         self.stage_file = stage_file
         self.log_severity = log_severity
+        self.workers = workers   # Most stage entries run at once
+        self.pool_min = pool_min
+        self.pool_max = pool_max
+        self.batch_size = batch_size   # Interface rows written per round trip
+        self.mea_wait_interval = mea_wait_interval   # Seconds MEA may go without progress
+        self.mea_wait_deadline = mea_wait_deadline   # Seconds MEA may take in all
 
         self.target_db = target_db
         self.target_user = target_user
@@ -305,13 +327,13 @@ def main(argv):
 
     # MA00047 The command line argument -f may only be specified for a spreadsheet source
 
-    if (source_type != 'XLS' and full_mode):
+    if (source_type not in file_source_types and full_mode):
         print "ERROR: -f argument is not valid for source_type %s. Type mealie -h for help" % source_type
         sys.exit(2)
 
     # The command line argument -k should only be, and must be, specified for a database source
 
-    if (source_type == 'XLS' and entity_key):
+    if (source_type in file_source_types and entity_key):
         print "ERROR: -k argument should not be supplied if source_type is %s" % source_type
         sys.exit(2)
 
@@ -345,7 +367,7 @@ def main(argv):
     try:
         source_xlsfile = config.get('source', 'xlsfile')
     except ConfigParser.NoOptionError:
-        if (source_type != 'XLS'):
+        if (source_type not in file_source_types):
             source_xlsfile = None
         else:
             print "ERROR: No source xlsfile defined in %s" % param_file
@@ -372,6 +394,72 @@ def main(argv):
     except ConfigParser.NoOptionError:
         target_pwd = None
 
+    # Number of interface rows written to the target per round trip
+    try:
+        batch_size = config.getint('target', 'batch_size')
+    except ConfigParser.NoOptionError:
+        batch_size = 500   # Default batch size
+    except ValueError:
+        print("ERROR: Invalid value \"%s\" for batch_size in %s" % (config.get('target', 'batch_size'), param_file))
+        sys.exit(2)
+
+    if (batch_size < 1):
+        print("ERROR: batch_size in %s must be at least 1" % (param_file))
+        sys.exit(2)
+
+    # The wait for MEA gives up after mea_wait_interval seconds without progress
+    # or after mea_wait_deadline seconds in all, whichever comes first
+
+    try:
+        mea_wait_deadline = config.getint('target', 'mea_wait_deadline')
+    except ConfigParser.NoOptionError:
+        mea_wait_deadline = 3600   # Default wait deadline
+    except ValueError:
+        print("ERROR: Invalid value \"%s\" for mea_wait_deadline in %s" % (config.get('target', 'mea_wait_deadline'), param_file))
+        sys.exit(2)
+
+    # Reference data snapshots. The [cache] section is optional
+
+    try:
+        cache_dir = config.get('cache', 'dir')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        cache_dir = None   # Use the default cache directory
+
+    try:
+        cache_ttl = config.getint('cache', 'ttl')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        cache_ttl = 3600   # Default snapshot lifetime in seconds
+    except ValueError:
+        print("ERROR: Invalid value \"%s\" for ttl in %s" % (config.get('cache', 'ttl'), param_file))
+        sys.exit(2)
+
+    # Parsed source rows. A rows_max_mb of 0 turns the row cache off
+
+    try:
+        rows_max_mb = config.getint('cache', 'rows_max_mb')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        rows_max_mb = default_rows_max_mb
+    except ValueError:
+        print("ERROR: Invalid value \"%s\" for rows_max_mb in %s" % (config.get('cache', 'rows_max_mb'), param_file))
+        sys.exit(2)
+
+    try:
+        rows_max_files = config.getint('cache', 'rows_max_files')
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        rows_max_files = default_rows_max_files
+    except ValueError:
+        print("ERROR: Invalid value \"%s\" for rows_max_files in %s" % (config.get('cache', 'rows_max_files'), param_file))
+        sys.exit(2)
+
+    if (rows_max_mb < 0 or rows_max_files < 1):
+        print("ERROR: rows_max_mb in %s must not be negative and rows_max_files must be at least 1" % (param_file))
+        sys.exit(2)
+
+    if (rows_max_mb):
+        row_cache = RowCache(cache_dir, rows_max_mb, rows_max_files)
+    else:
+        row_cache = None
+
 
     if (source_type == 'ORA'):
         if (test_mode):
@@ -380,7 +468,7 @@ def main(argv):
         else:
             mealie_logger.info("Data sourced from %s will be loaded into %s" % (source_db, target_db))
             print "Data sourced from %s will be loaded into %s" % (source_db, target_db)
-    elif (source_type == 'XLS'):
+    elif (source_type in file_source_types):
         if (test_mode):
             mealie_logger.info("Test Mode: Data sourced from %s will NOT be loaded" % (source_xlsfile))
             print "Test Mode: Data sourced from %s will NOT be loaded" % (source_xlsfile)
@@ -397,7 +485,7 @@ def main(argv):
         normal_mode = True
 
     if (full_mode):
-        mealie_logger.info("Full Load: All entities processed must be loaded by MEA after %d seconds" % mea_wait_interval)
+        mealie_logger.info("Full Load: All entities processed must be loaded by MEA within %d seconds" % mea_wait_deadline)
 
     mealie_logger.info("Logging level set to %s" % log_severity)
 
@@ -414,7 +502,8 @@ def main(argv):
                         source_type,
                         target_db, target_user, target_pwd,
                         entity_type, entity_key, entity_level,
-                        mea_wait_interval,
+                        mea_wait_interval, mea_wait_deadline, batch_size,
+                        cache_dir, cache_ttl, KeyRegistry(cache_dir), row_cache, None,
                         normal_mode, test_mode, full_mode)
 
     return er
@@ -427,9 +516,13 @@ def stage(argv):
     target_pwd = None
     target_db = None
     log_severity = None
+    workers = None
+    pool_size = None
+    batch_size = None
+    mea_wait = None
 
     try:
-        opts, _args = getopt.getopt(argv, "s:u:p:d:l:")
+        opts, _args = getopt.getopt(argv, "s:u:p:d:l:w:c:b:m:")
     except getopt.GetoptError:
         stgusage()
         sys.exit(2)
@@ -446,6 +539,14 @@ def stage(argv):
             target_db = arg
         elif opt == '-l':
             log_severity = arg
+        elif opt == '-w':
+            workers = arg
+        elif opt == '-c':
+            pool_size = arg
+        elif opt == '-b':
+            batch_size = arg
+        elif opt == '-m':
+            mea_wait = arg
 
     # Mandatory args must be supplied
     if not (stage_file and target_user and target_db):
@@ -468,7 +569,56 @@ def stage(argv):
         stgusage()
         sys.exit(2)
 
-    sb = StageBatch(stage_file, int(log_severity), target_db, target_user, target_pwd)
+    # Default to 4 entries at once. Entries that declare no dependencies still
+    # run one after another
+    if not (workers):
+        workers = '4'
+
+    if not (workers.isdigit() and int(workers) >= 1):
+        print "ERROR: Invalid number of workers %s" % (workers)
+        stgusage()
+        sys.exit(2)
+
+    # Default to a pool of one session, growing to one per worker
+    if not (pool_size):
+        pool_size = "1,%s" % (workers)
+
+    try:
+        (pool_min, pool_max) = [int(size) for size in pool_size.split(',')]
+    except ValueError:
+        pool_min = pool_max = -1
+
+    if (pool_min < 1 or pool_max < pool_min):
+        print "ERROR: Invalid connection pool size %s" % (pool_size)
+        stgusage()
+        sys.exit(2)
+
+    # Default to the batch size of a single run
+    if not (batch_size):
+        batch_size = '500'
+
+    if not (batch_size.isdigit() and int(batch_size) >= 1):
+        print "ERROR: Invalid batch size %s" % (batch_size)
+        stgusage()
+        sys.exit(2)
+
+    # Default to the MEA waits of a single run
+    if not (mea_wait):
+        mea_wait = "180,3600"
+
+    try:
+        (mea_wait_interval, mea_wait_deadline) = [int(wait) for wait in mea_wait.split(',')]
+    except ValueError:
+        mea_wait_interval = mea_wait_deadline = -1
+
+    if (mea_wait_interval < 1 or mea_wait_deadline < 1):
+        print "ERROR: Invalid MEA wait %s" % (mea_wait)
+        stgusage()
+        sys.exit(2)
+
+    sb = StageBatch(stage_file, int(log_severity), target_db, target_user, target_pwd,
+                    int(workers), pool_min, pool_max, int(batch_size),
+                    mea_wait_interval, mea_wait_deadline)
 
     return sb
 
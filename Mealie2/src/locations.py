@@ -98,13 +98,22 @@
 ########################################################################################
 
 import cx_Oracle
-import xlrd
 import sys
-import time
 
 from common import get_all_segments
 # Import for validation purposes
-from common import read_orgids, read_depts, read_systemids, is_seg_in_org, is_systemid_in_org, get_glaccount_five_dg
+from common import is_seg_in_org, is_systemid_in_org, get_glaccount_five_dg
+from refcache import get_orgids, get_depts, get_systemids
+from receipts import ValidationReceipt
+from meabatch import TxnIdAllocator, InterfaceWriter, MeaQueueWriter, HierarchyScheduler, wait_for_mea
+from sheets import open_sheet, NUMBER
+from connpool import connect_target
+
+# MEA transaction ids are allocated in blocks from the entity sequence
+txn_ids = TxnIdAllocator('maximo.hul_mealie_loc_seq')
+
+# Oracle allows at most 1000 expressions in an IN list
+location_chunk_size = 1000
 
 
 ########################################################################################
@@ -133,78 +142,70 @@ class InterfaceableLocationFromOra:
         self.errmsg = None
         self.severity = None
 
-    def is_valid(self, c, logger):
+    def is_valid(self, known_locations, logger):
 
         # Test for exceptions. An ERROR will cause the whole run to abort,
         # rolling back the transaction
 
         # The parent must already be an existing LOCATION, or have just been
-        # written to the interface table
+        # written to the interface table. Both are resolved in bulk by
+        # LocationIndex before the first row is processed
 
         logger.debug("Checking parent %s of location %s exists as a location" % (self.parent, self.location))
 
-        q_exists_loc="""
-            SELECT location
-            FROM maximo.locations l
-            WHERE l.status = 'OPERATING'
-            AND l.location = :location"""
-        c.execute(q_exists_loc, location=self.parent)
-        parent_loc = c.fetchone()
-        logger.debug("Location %s looked up: %s" % (self.parent, parent_loc))
-
-        if (not parent_loc):
-            logger.debug("%s is not a valid existing Location, will check interface table" % (self.parent))
-
-            logger.debug("Checking parent %s of location %s exists on interface table" % (self.parent, self.location))
-
-            q_exists_interface="""
-                SELECT location
-                FROM maximo.mxoperloc_iface i
-                WHERE i.location = :location"""
-            c.execute(q_exists_interface, location=self.parent)
-            iface_loc = c.fetchone()
-            logger.debug("Location %s looked up: %s" % (self.parent, iface_loc))
-
-            if (not iface_loc):
-                logger.debug("%s is not a Location previously written to interface table" % (self.parent))
-                return True
+        if (self.parent not in known_locations):
+            logger.debug("%s is not an existing Location or a Location previously written to interface table" % (self.parent))
 
         return True
 
+# Columns of the source spreadsheet read by InterfaceableLocationFromXls
+sheet_columns = [
+    ('level', 0, NUMBER),
+    ('parent', 1),
+    ('location', 2),
+    ('description', 3),
+    ('type', 4),
+    ('glaccount', 5),
+    ('siteid', 6),
+    ('orgid', 7, NUMBER),
+    ('status', 8),
+    ('systemid', 9)
+]
+
 class InterfaceableLocationFromXls:
 
     """Class to represent a Location to be loaded by MEA from a spreadsheet"""
 
-    def __init__(self, worksheet, i, logger):
+    def __init__(self, row, logger):
 
-        self.location = str(worksheet.cell(i, 2).value)
+        self.location = str(row.location)
         # MA00049 If user does not provide an integer value for Level we catch the ValueError
         #         and set level to None, it will be rejected by the is_valid() method
         try:
-            self.level = int(worksheet.cell(i, 0).value)
+            self.level = int(row.level)
         except ValueError:
-            logger.debug("Location %s has non-numeric level \"%s\", setting to None" % (self.location, worksheet.cell(i, 0).value))
+            logger.debug("Location %s has non-numeric level \"%s\", setting to None" % (self.location, row.level))
             self.level = None
 
-        self.parent = str(worksheet.cell(i, 1).value)
-        self.description = worksheet.cell(i, 3).value
-        self.type = worksheet.cell(i, 4).value
-        self.glaccount = get_all_segments(worksheet.cell(i, 5).value)
-        self.segment2 =  get_glaccount_five_dg(worksheet.cell(i, 5).value)   # Added for SEG2 validation purposes.
-        self.siteid = worksheet.cell(i, 6).value
+        self.parent = str(row.parent)
+        self.description = row.description
+        self.type = row.type
+        self.glaccount = get_all_segments(row.glaccount)
+        self.segment2 =  get_glaccount_five_dg(row.glaccount)   # Added for SEG2 validation purposes.
+        self.siteid = row.siteid
         try: # MA00063 If non-numeric orgid, set to None
-            self.orgid = int(worksheet.cell(i, 7).value) # 6943 should be integer
+            self.orgid = int(row.orgid) # 6943 should be integer
         except ValueError:
-            logger.debug("Location %s has non-numeric orgid \"%s\", setting to None" % (self.location, worksheet.cell(i, 7).value))
+            logger.debug("Location %s has non-numeric orgid \"%s\", setting to None" % (self.location, row.orgid))
             self.orgid = None
 
-        self.status = worksheet.cell(i, 8).value
-        self.systemid = str(worksheet.cell(i, 9).value) # MA00061 cast to str
+        self.status = row.status
+        self.systemid = str(row.systemid) # MA00061 cast to str
 
         self.errmsg = None
         self.severity = None
 
-    def is_valid(self, c, logger):
+    def is_valid(self, known_locations, logger):
 
         # Test for exceptions. An ERROR will cause the whole run to abort,
         # rolling back the transaction
@@ -217,37 +218,59 @@ class InterfaceableLocationFromXls:
             return False
 
         # The parent must already be an existing LOCATION, or have just been
-        # written to the interface table
+        # written to the interface table. Both are resolved in bulk by
+        # LocationIndex before the first row is processed
 
         logger.debug("Checking parent %s of location %s exists as a location" % (self.parent, self.location))
 
-        q_exists_loc="""
-            SELECT location
-            FROM maximo.locations l
-            WHERE l.status = 'OPERATING'
-            AND l.location = :location"""
-        c.execute(q_exists_loc, location=self.parent)
-        parent_loc = c.fetchone()
-        logger.debug("Location %s looked up: %s" % (self.parent, parent_loc))
+        if (self.parent not in known_locations):
+            logger.debug("%s is not an existing Location or a Location previously written to interface table" % (self.parent))
 
-        if (not parent_loc):
-            logger.debug("%s is not a valid existing Location, will check interface table" % (self.parent))
+        return True
 
-            logger.debug("Checking parent %s of location %s exists on interface table" % (self.parent, self.location))
+class LocationIndex:
 
-            q_exists_interface="""
-                SELECT location
-                FROM maximo.mxoperloc_iface i
-                WHERE i.location = :location"""
-            c.execute(q_exists_interface, location=self.parent)
-            iface_loc = c.fetchone()
-            logger.debug("Location %s looked up: %s" % (self.parent, iface_loc))
+    """Set of locations known to exist for a run, either in Maximo or on the interface table"""
 
-            if (not iface_loc):
-                logger.debug("%s is not a Location previously written to interface table" % (self.parent))
-            return True
+    def __init__(self):
 
-        return True
+        self.locations = set()
+
+    def __contains__(self, location):
+
+        return location in self.locations
+
+    def add(self, location):
+
+        # Locations written during this run can parent later rows
+        self.locations.add(location)
+
+    def preload(self, c, candidates, logger):
+
+        # Resolve all candidate locations with one query per chunk of keys
+        # rather than up to two queries per row
+
+        q_exists = """
+            SELECT l.location
+            FROM maximo.locations l
+            WHERE l.status = 'OPERATING'
+            AND l.location IN (%s)
+            UNION
+            SELECT i.location
+            FROM maximo.mxoperloc_iface i
+            WHERE i.location IN (%s)"""
+
+        candidates = [key for key in set(candidates) if key not in self.locations]
+        c.arraysize = location_chunk_size
+
+        for start in range(0, len(candidates), location_chunk_size):
+            chunk = candidates[start:start + location_chunk_size]
+            binds = dict(("k%d" % i, key) for i, key in enumerate(chunk))
+            placeholders = ", ".join([":k%d" % i for i in range(len(chunk))])
+            c.execute(q_exists % (placeholders, placeholders), binds)
+            self.locations.update([row[0] for row in c.fetchall()])
+
+        logger.debug("Resolved %d candidate parents, %d locations known" % (len(candidates), len(self.locations)))
 
 ########################################################################################
 #
@@ -258,32 +281,7 @@ class InterfaceableLocationFromXls:
 def get_next_txn_id(c, logger):
 
     # Get the next available transaction id for a MEA batch
-    q_get_id = """
-    SELECT maximo.hul_mealie_loc_seq.NEXTVAL
-    FROM DUAL"""
-
-    c.execute(q_get_id)
-    txn_id = c.fetchone()
-    logger.debug("Obtained MEA Txn Id %s" % (txn_id[0]))
-
-    return txn_id[0]
-
-def get_queued_batch_ct(c, logger):
-
-    # Get the number of batches for THIS INTERFACE that 
-    # have yet to be processed by MEA
-    q_get_ct = """
-    SELECT COUNT(*)
-    FROM maximo.mxin_inter_trans 
-    WHERE extsysname = 'EXTSYS1'
-    AND ifacename = 'MXOPERLOCInterface'"""
-
-    time.sleep(5)  # t = seconds
-    c.execute(q_get_ct)
-    wait_ct = c.fetchone()
-    logger.info("MEA has %s unprocessed batches in the queue" % (wait_ct[0]))
-
-    return wait_ct[0]
+    return txn_ids.next_id(c, logger)
 
 def get_entity_ct(c, logger):
 
@@ -298,35 +296,13 @@ def get_entity_ct(c, logger):
 
     return entity_ct
 
-def write_mea_queue(c, q, logger):
-
-    # Insert rows into MEA queue
-
-    q_write_queue = """
-    INSERT INTO maximo.mxin_inter_trans (
-                           extsysname,
-                           ifacename,
-                           transid
-                           )
-    VALUES ('EXTSYS1',
-               'MXOPERLOCInterface',
-               :transid)"""
-
-    # Process each entry in the queue until it is empty
-
-    for _i in range(len(q)):
-        j = q.pop(0)
-        logger.debug("Popped txn id %s. Queue now holds %s" % (j, q))
-        c.execute(q_write_queue, transid = j)
-
-    return True
-
 
 def loc_handler(er):
 
     type_handler = {
         "ORA": loc_handler_ora_ora,
-        "XLS": loc_handler_xls_ora
+        "XLS": loc_handler_xls_ora,
+        "CSV": loc_handler_xls_ora
     }
 
     return type_handler.get(er.source_type)(er) # Call appropriate handler for the source type
@@ -341,36 +317,39 @@ def loc_handler_xls_ora(er):
 
     # Open source spreadsheet
 
-    try:
-        ifh = xlrd.open_workbook(er.source_xlsfile)
-    except IOError:
-        print("ERROR: Unable to open %s" % (er.source_xlsfile))
-        er.logger.error("Unable to open %s" % (er.source_xlsfile))
+    rows = open_sheet(er, sheet_columns)
+    if rows is None:
         return False
-    wsh = ifh.sheet_by_index(0)
 
     # Connect to MEA target database 
     # 6924 DJW Moved to before the validation block
 
     try:
-        conn_target = cx_Oracle.connect("%s/%s@%s" % (er.target_user, er.target_pwd, er.target_db))
+        conn_target = connect_target(er)
     except cx_Oracle.DatabaseError, exc:
         error, = exc.args
         print("ERROR: %s" % (error.message))
         er.logger.error("%s" % (error.message))
         return False
 
+    # An update run of a file that a test run has already validated against
+    # unchanged reference data goes straight to writing
+    receipt = ValidationReceipt(er, ['orgids', 'depts', 'systemids'])
+    fingerprints = receipt.fingerprint(conn_target)
+    validated = (not er.test_mode) and receipt.matches(fingerprints)
+
     # Validation of ORGIDS and GLACCOUNTS
     # 6924 DJW On full debug dump out all valid values
-    orgids = read_orgids(conn_target)
-    er.logger.debug("Valid orgids obtained: These are %s" % ("".join(str(orgids))))
-    depts = read_depts(conn_target)
-    er.logger.debug("Valid segment 2 values obtained: These are %s" % (depts))
-    # MA00061 Now validate systemid against orgid (table locsystem)
-    systemids = read_systemids(conn_target)
-    er.logger.debug("Valid systemid values obtained: These are %s" % (systemids))
+    if (not validated):
+        orgids = get_orgids(conn_target, er)
+        er.logger.debug("Valid orgids obtained: These are %s" % ("".join(str(orgids))))
+        depts = get_depts(conn_target, er)
+        er.logger.debug("Valid segment 2 values obtained: These are %s" % (depts))
+        # MA00061 Now validate systemid against orgid (table locsystem)
+        systemids = get_systemids(conn_target, er)
+        er.logger.debug("Valid systemid values obtained: These are %s" % (systemids))
 
-    levels = []        # A list of the levels in this spreadsheet
+    level_rows = {}    # Rows of this spreadsheet bucketed by level
 
     invalid_orgids = []
     invalid_seg2 = []
@@ -380,17 +359,17 @@ def loc_handler_xls_ora(er):
     orgids_err_ct = 0
     systemids_err_ct = 0
 
-    start_row = 1      # First row in spreadsheet that contains data (first is 0)
-
     er.logger.debug("Validating spreadsheet data")
-    for x in range(start_row, wsh.nrows):
+    for row in rows:
 
-        il = InterfaceableLocationFromXls(wsh, x, er.logger)
+        il = InterfaceableLocationFromXls(row, er.logger)
         er.logger.debug("Instantiated InterfaceableLocationFromXls for %s" % (il.location))
 
         # MA00049 InterfaceableLocationFromXls.level is supposed to be an integer so no need to cast
-        if (il.level not in levels):
-            levels.append(il.level)
+        level_rows.setdefault(il.level, []).append(il)
+
+        if (validated):
+            continue
 
         if (il.orgid not in orgids):        # Validate ORGIDS
             if (il.orgid not in invalid_orgids): # Don't report duplicate error values
@@ -406,6 +385,8 @@ def loc_handler_xls_ora(er):
                 invalid_systemid.append(il.systemid)
             systemids_err_ct += 1
 
+    rows.close()   # Every row has been parsed, the sheet is not needed while MEA loads
+
     if orgids_err_ct > 0:
         # 6924 DJW Update for consistency with existing fatal errors
         er.logger.error("ERROR: The following ORGIDS are incorrect: %s, aborting" % invalid_orgids)
@@ -431,7 +412,11 @@ def loc_handler_xls_ora(er):
 
     er.logger.debug("Spreadsheet data validated")
 
-    levels.sort()
+    # The rows are only parsed once. Parents are written before their children
+    # so order by level, then by parent within each level
+    levels = sorted(level_rows.keys())
+    for level in levels:
+        level_rows[level].sort(key=lambda il: il.parent)
     er.logger.info("Levels to be processed: %s" % (levels))
   
     # Open various cursors on target database 
@@ -443,6 +428,10 @@ def loc_handler_xls_ora(er):
     # MA00047 Determine how many locations exist before we start
     start_entity_ct = get_entity_ct(curs_target_lookup, er.logger)
 
+    # Resolve every parent in the spreadsheet up front
+    known_locations = LocationIndex()
+    known_locations.preload(curs_target_lookup, [location.parent for level in levels for location in level_rows[level]], er.logger)
+
     # Insert a row into MEA interface for entity type LOCATION
     # 8093 Set new column status date to current date
 
@@ -478,129 +467,106 @@ def loc_handler_xls_ora(er):
 
     # Initialise local variables for fetch loop
 
-    queued_batches = 0 
     total_ct = 0       # Total no. of items
-    level_ct = 0       # No. of items in this level
-    last_level = None
     trans_id = None    # Current Batch id
-    batch_queue = []   # Batch id queue for queue table
+    mea_queue = MeaQueueWriter(curs_target_mea, 'MXOPERLOCInterface', er.batch_size, er.logger)
     trans_seq = None   # Sequence within batch
 
-    start_row = 1      # First row in spreadsheet that contains data (first is 0)
-
-    # 6924 DJW Iterate through levels starting with topmost in hierarchy
-
-    for level_to_process in levels:
-
-        # MA00049 Do not assume at this stage that all members of levels list are numeric
-        er.logger.info("Processing hierarchy level %s" % (level_to_process))
-
-        # Iterate through rows in input spreadsheet
-        for this_row in range(start_row, wsh.nrows):
-
-            il = InterfaceableLocationFromXls(wsh, this_row, er.logger)
-
-            # 6924 DJW Ignore unless it is the level we want to process on this iteration
-            er.logger.debug("We are processing level %s, level is %s" % (level_to_process, il.level))
-            if (il.level == level_to_process):
-                er.logger.info("Processing location %s" % (il.location))
-                if (il.is_valid(curs_target_lookup, er.logger)):
-                    if (il.level != last_level):
-                        er.logger.debug("LEVEL has changed: was %s, now %s" % (last_level, il.level))
-
-                        if (not er.test_mode):
-                            if (last_level): # Ignore the first change of level since nothing yet written
-
-                                # Write the MEA queue
-                                er.logger.info("Writing MEA queue, stored txn ids are %s" % batch_queue)
-                                write_mea_queue(curs_target_mea, batch_queue, er.logger)
-                                er.logger.info("Wrote MEA queue, stored txn ids are %s" % batch_queue)
-                                er.logger.info("Committing changes to MEA target %s" % er.target_db)
-                                conn_target.commit() 
-
-                            er.logger.debug("Processed %s items in previous LEVEL %s" % (level_ct, last_level))
-                            level_ct = 0
-    
-                            # Wait until MEA has flushed the queue
-    
-                            er.logger.info("Wait for MEA to flush its queue")
-                            queued_batches = get_queued_batch_ct(curs_target_seq, er.logger)
-                            while (queued_batches):
-                                er.logger.debug("MEA still has %s items in queue" % (queued_batches))
-                                queued_batches = get_queued_batch_ct(curs_target_seq, er.logger)
-
-                        else:
-                            er.logger.info("Test Mode: Will not write MEA queue")
-    
-                        last_level = il.level
-    
-                    else:
-                        er.logger.debug("LEVEL is still %s" % (il.level))
-    
-                    er.logger.debug("Getting new transaction id for %s" % il.location)
-
-                    # Obtain new MEA transaction id for next batch 
-                    trans_id = get_next_txn_id(curs_target_seq, er.logger) 
-
-                    # Add the MEA transaction id to the queue 
-                    batch_queue.append(trans_id) 
-
-                    # Sequence is reset for new batch
-                    trans_seq = 1
-
-                    # Write the MEA interface table
-                    er.logger.debug("Writing interface: location %s transid %s transseq %s" % (il.location, trans_id, trans_seq))
-                    curs_target_mea.execute(q_write_interface, location=il.location,
-                                                                            description=il.description,
-                                                                            type=il.type,
-                                                                            glaccount=il.glaccount,
-                                                                            siteid=il.siteid,
-                                                                            orgid=il.orgid,
-                                                                            parent=il.parent,
-                                                                            status=il.status,
-                                                                            systemid=il.systemid,
-                                                                            transid=trans_id,
-                                                                            transseq=trans_seq)
-    
+    # Interface rows are array-bound and written in batches of er.batch_size
+    iface_writer = InterfaceWriter(curs_target_mea, q_write_interface, er.batch_size, er.logger)
+
+    # Locations are released to MEA as soon as MEA has loaded their own parent,
+    # so one slow branch no longer holds back the whole of the next level
+    scheduler = HierarchyScheduler(curs_target_seq, 'MXOPERLOCInterface', er.logger)
+    scheduler.load([location for level in levels for location in level_rows[level]], 'location')
+
+    while scheduler:
+
+        released = scheduler.release()
+        if not released:
+            # Nothing more can be written until MEA loads another parent
+            if not scheduler.wait(er.mea_wait_deadline, er.mea_wait_interval):
+                print("ERROR: MEA did not load the locations queued on MXOPERLOCInterface, aborting")
+                conn_target.close()         # Free the connection
+                sys.exit(2)
+            continue
+
+        er.logger.debug("Releasing %d locations" % (len(released)))
+
+        for il in released:
+
+            er.logger.info("Processing location %s" % (il.location))
+            if (il.is_valid(known_locations, er.logger)):
+
+                er.logger.debug("Getting new transaction id for %s" % il.location)
+
+                # Obtain new MEA transaction id for next batch 
+                trans_id = get_next_txn_id(curs_target_seq, er.logger)
+
+                # Add the MEA transaction id to the queue 
+                mea_queue.append(trans_id) 
+
+                # Sequence is reset for new batch
+                trans_seq = 1
+
+                # Write the MEA interface table
+                er.logger.debug("Writing interface: location %s transid %s transseq %s" % (il.location, trans_id, trans_seq))
+                iface_writer.write(location=il.location,
+                                   description=il.description,
+                                   type=il.type,
+                                   glaccount=il.glaccount,
+                                   siteid=il.siteid,
+                                   orgid=il.orgid,
+                                   parent=il.parent,
+                                   status=il.status,
+                                   systemid=il.systemid,
+                                   transid=trans_id,
+                                   transseq=trans_seq)
+                known_locations.add(il.location)
+
+                # In test mode nothing reaches MEA, so children are released at once
+                if (er.test_mode):
+                    scheduler.loaded(il.location)
                 else:
-    
-                    er.logger.error("ERROR: %s is not a valid Location, aborting" % (il.parent))
-                    print("ERROR: %s is not a valid Location, aborting" % (il.parent))
-                    conn_target.rollback()
-                    conn_target.close() # 6924 DJW Free the connection
-                    sys.exit(2)         # Will never happen if driving query is correctly ordered
-   
-                total_ct += 1
-                level_ct += 1
-
-            
-                # 6924 DJW End of condition that it is the level we want to process on this iteration
+                    scheduler.sent(il.location, trans_id)
+
+            else:
+
+                er.logger.error("ERROR: %s is not a valid Location, aborting" % (il.parent))
+                print("ERROR: %s is not a valid Location, aborting" % (il.parent))
+                conn_target.rollback()
+                conn_target.close() # 6924 DJW Free the connection
+                sys.exit(2)
+
+            total_ct += 1
 
             # End of location processing loop
 
-        # 6924 DJW End of level processing loop
-    
-    # The transaction will not be committed if we are in 'test mode'
-    # Otherwise we commit the last level-set of batches
-
-    if (not er.test_mode):
-        # Write the MEA queue
-        er.logger.info("Writing MEA queue, stored txn ids are %s" % batch_queue)
-        write_mea_queue(curs_target_mea, batch_queue, er.logger)
-        er.logger.info("Wrote MEA queue, stored txn ids are %s" % batch_queue)
-        er.logger.info("Committing changes to MEA target %s" % er.target_db)
-        conn_target.commit() 
-    else:
+        # Parents must be on the interface table before their children are
+        # validated, and committed before MEA can load them
+
+        iface_writer.flush()
+
+        if (not er.test_mode):
+            # Write the MEA queue
+            mea_queue.flush()
+            er.logger.info("Committing changes to MEA target %s" % er.target_db)
+            conn_target.commit() 
+
+    # End of scheduling loop. Outside test mode MEA has taken every batch off its queue
+
+    if (er.test_mode):
         er.logger.info("Test Mode: Rolling back changes to %s" % er.target_db)
         conn_target.rollback() 
+        receipt.issue(fingerprints)
+    elif not wait_for_mea(curs_target_seq, 'MXOPERLOCInterface', er, 'maximo.mxoperloc_iface', mea_queue.queued):
+        # MA00047 MEA must have loaded the last batches before the entities are counted
+        print("ERROR: MEA did not load the locations on maximo.mxoperloc_iface, aborting")
+        conn_target.close()         # Free the connection
+        sys.exit(2)
 
     er.logger.info("Processed %s %s entities" % (total_ct, er.entity_type))
 
-    if (not er.test_mode):
-        # MA00047 Tune this value according to your cron configuration
-        er.logger.info("Waiting %d seconds for MEA to finish loading" % (er.mea_wait_interval))
-        time.sleep(er.mea_wait_interval)
-
     print("Processed %s %s entities" % (total_ct, er.entity_type))
     print "See %s for full details of this run" % er.log_file
 
@@ -645,7 +611,7 @@ def loc_handler_ora_ora(er):
 
     # Connect to MEA target database and open various cursors
 
-    conn_target = cx_Oracle.connect("%s/%s@%s" % (er.target_user, er.target_pwd, er.target_db))
+    conn_target = connect_target(er)
     curs_target_mea = conn_target.cursor()
     curs_target_lookup = conn_target.cursor()
     curs_target_seq = conn_target.cursor()
@@ -736,108 +702,111 @@ def loc_handler_ora_ora(er):
     else:
         curs_source_drv.execute (q_driver_all, locations = er.entity_key + '%')
 
-    row = curs_source_drv.fetchone() 
+    curs_source_drv.arraysize = location_chunk_size
+    rows = curs_source_drv.fetchall()
+
+    # Resolve every parent returned by the driving query up front
+    known_locations = LocationIndex()
+    known_locations.preload(curs_target_lookup, [row[1] for row in rows], er.logger)
 
     # Initialise local variables for fetch loop
 
-    queued_batches = 0 
     total_ct = 0       # Total no. of items
-    level_ct = 0       # No. of items in this level
-    last_level = None
     trans_id = None    # Current Batch id
-    batch_queue = []   # Batch id queue for queue table
+    mea_queue = MeaQueueWriter(curs_target_mea, 'MXOPERLOCInterface', er.batch_size, er.logger)
     trans_seq = None   # Sequence within batch
 
-    # Process each entity until the cursor is exhausted
-
-    while row:
-        il = InterfaceableLocationFromOra(row)
-        er.logger.info("Processing location %s" % (il.location))
-        if (il.is_valid(curs_target_lookup, er.logger)):
-
-
-            if (il.level != last_level):
-                er.logger.debug("LEVEL has changed: was %s, now %s" % (last_level, il.level))
-
-                if (not er.test_mode):
-                    if (last_level): # Ignore the first change of level since nothing yet written
-
-                        # Write the MEA queue
-                        er.logger.info("Writing MEA queue, stored txn ids are %s" % batch_queue)
-                        write_mea_queue(curs_target_mea, batch_queue, er.logger)
-                        er.logger.info("Wrote MEA queue, stored txn ids are %s" % batch_queue)
-                        er.logger.info("Committing changes to MEA target %s" % er.target_db)
-                        conn_target.commit() 
-
-                        er.logger.debug("Processed %s items in previous LEVEL %s" % (level_ct, last_level))
-                        level_ct = 0
-
-                        # Wait until MEA has flushed the queue
-
-                        er.logger.info("Wait for MEA to flush its queue")
-                        queued_batches = get_queued_batch_ct(curs_target_seq, er.logger)
-                        while (queued_batches):
-                            er.logger.debug("MEA still has %s items in queue" % (queued_batches))
-                            queued_batches = get_queued_batch_ct(curs_target_seq, er.logger)
-
+    # Interface rows are array-bound and written in batches of er.batch_size
+    iface_writer = InterfaceWriter(curs_target_mea, q_write_interface, er.batch_size, er.logger)
+
+    # Locations are released to MEA as soon as MEA has loaded their own parent,
+    # so one slow branch no longer holds back the whole of the next level
+    scheduler = HierarchyScheduler(curs_target_seq, 'MXOPERLOCInterface', er.logger)
+    scheduler.load([InterfaceableLocationFromOra(row) for row in rows], 'location')
+
+    while scheduler:
+
+        released = scheduler.release()
+        if not released:
+            # Nothing more can be written until MEA loads another parent
+            if not scheduler.wait(er.mea_wait_deadline, er.mea_wait_interval):
+                print("ERROR: MEA did not load the locations queued on MXOPERLOCInterface, aborting")
+                conn_target.close()         # Free the connection
+                sys.exit(2)
+            continue
+
+        er.logger.debug("Releasing %d locations" % (len(released)))
+
+        for il in released:
+
+            er.logger.info("Processing location %s" % (il.location))
+            if (il.is_valid(known_locations, er.logger)):
+
+                er.logger.debug("Getting new transaction id for %s" % il.location)
+
+                # Obtain new MEA transaction id for next batch 
+                trans_id = get_next_txn_id(curs_target_seq, er.logger)
+
+                # Add the MEA transaction id to the queue 
+                mea_queue.append(trans_id) 
+
+                # Sequence is reset for new batch
+                trans_seq = 1
+
+                # Write the MEA interface table
+                er.logger.debug("Writing interface: location %s transid %s transseq %s" % (il.location, trans_id, trans_seq))
+                iface_writer.write(location=il.location,
+                                   description=il.description,
+                                   type=il.type,
+                                   glaccount=il.glaccount,
+                                   siteid=il.siteid,
+                                   orgid=il.orgid,
+                                   parent=il.parent,
+                                   status=il.status,
+                                   systemid=il.systemid,
+                                   transid=trans_id,
+                                   transseq=trans_seq)
+                known_locations.add(il.location)
+
+                # In test mode nothing reaches MEA, so children are released at once
+                if (er.test_mode):
+                    scheduler.loaded(il.location)
                 else:
-                    er.logger.info("Test Mode: Will not write MEA queue")
-
-                last_level = il.level
+                    scheduler.sent(il.location, trans_id)
 
             else:
-                er.logger.debug("LEVEL is still %s" % (il.level))
 
-            er.logger.debug("Getting new transaction id for %s" % il.location)
+                er.logger.error("ERROR: %s is not a valid Location, aborting" % (il.parent))
+                print("ERROR: %s is not a valid Location, aborting" % (il.parent))
+                conn_target.rollback()
+                conn_target.close() # 6924 DJW Free the connection
+                sys.exit(2)
 
-            # Obtain new MEA transaction id for next batch 
-            trans_id = get_next_txn_id(curs_target_seq, er.logger)
+            total_ct += 1
 
-            # Add the MEA transaction id to the queue 
-            batch_queue.append(trans_id) 
+            # End of location processing loop
 
-            # Sequence is reset for new batch
-            trans_seq = 1
+        # Parents must be on the interface table before their children are
+        # validated, and committed before MEA can load them
 
-            # Write the MEA interface table
-            er.logger.debug("Writing interface: location %s transid %s transseq %s" % (il.location, trans_id, trans_seq))
-            curs_target_mea.execute(q_write_interface, location=il.location,
-                                                                      description=il.description,
-                                                                      type=il.type,
-                                                                      glaccount=il.glaccount,
-                                                                      siteid=il.siteid,
-                                                                      orgid=il.orgid,
-                                                                      parent=il.parent,
-                                                                      status=il.status,
-                                                                      systemid=il.systemid,
-                                                                      transid=trans_id,
-                                                                      transseq=trans_seq)
+        iface_writer.flush()
 
-        else:
+        if (not er.test_mode):
+            # Write the MEA queue
+            mea_queue.flush()
+            er.logger.info("Committing changes to MEA target %s" % er.target_db)
+            conn_target.commit() 
 
-            er.logger.error("ERROR: %s is not a valid Location, aborting" % (il.parent))
-            print("ERROR: %s is not a valid Location, aborting" % (il.parent))
-            conn_target.rollback()
-            conn_target.close() # 6924 DJW Free the connection
-            sys.exit(2)         # This ugliness will never happen if driving query is correctly ordered
-    
-        total_ct += 1
-        level_ct += 1
-        row = curs_source_drv.fetchone()
-
-    # The transaction will not be committed if we are in 'test mode'
-    # Otherwise we commit the last level-set of batches
-
-    if (not er.test_mode):
-        # Write the MEA queue
-        er.logger.info("Writing MEA queue, stored txn ids are %s" % batch_queue)
-        write_mea_queue(curs_target_mea, batch_queue, er.logger)
-        er.logger.info("Wrote MEA queue, stored txn ids are %s" % batch_queue)
-        er.logger.info("Committing changes to MEA target %s" % er.target_db)
-        conn_target.commit() 
-    else:
+    # End of scheduling loop. Outside test mode MEA has taken every batch off its queue
+
+    if (er.test_mode):
         er.logger.info("Test Mode: Rolling back changes to %s" % er.target_db)
         conn_target.rollback() 
+    elif not wait_for_mea(curs_target_seq, 'MXOPERLOCInterface', er, 'maximo.mxoperloc_iface', mea_queue.queued):
+        # MA00047 MEA must have loaded the last batches before the entities are counted
+        print("ERROR: MEA did not load the locations on maximo.mxoperloc_iface, aborting")
+        conn_target.close()         # Free the connection
+        sys.exit(2)
 
     er.logger.info("Processed %s %s entities" % (total_ct, er.entity_type))
     print("Processed %s %s entities" % (total_ct, er.entity_type))
@@ -0,0 +1,511 @@
+#!/usr/bin/env python
+#
+# MEA Lightweight Integration Environment
+#
+# Batching helpers shared by the entity handlers
+#
+
+########################################################################################
+#
+#     Import required modules
+#
+########################################################################################
+
+import cx_Oracle
+import random
+import threading
+import time
+
+from collections import deque
+
+########################################################################################
+#
+#     Globals
+#
+########################################################################################
+
+# Transaction ids are drawn from the entity sequences in blocks. The first block
+# is small so that short runs do not burn sequence values, and each refill
+# doubles the block up to the maximum
+
+txn_block_initial = 10
+txn_block_max = 500
+
+# Polling of the MEA queue starts quickly, so that a small load returns as soon
+# as MEA has picked it up, and backs off exponentially to the maximum interval
+
+poll_initial = 1.0
+poll_max = 30.0
+
+# Rows already in a dictionary table are looked up for this many keys per query
+
+merge_key_chunk_size = 1000
+
+# Interface rows MEA has still to load are looked up for this many transids per query
+
+transid_chunk_size = 1000
+
+########################################################################################
+#
+#     Class definitions
+#
+########################################################################################
+
+class TxnIdAllocator:
+
+    """Hands out MEA transaction ids from a sequence, fetching a block of ids per round trip"""
+
+    def __init__(self, sequence, block_initial=txn_block_initial, block_max=txn_block_max):
+
+        self.sequence = sequence
+        self.block_size = block_initial
+        self.block_max = block_max
+        self.ids = deque()
+        self.owner = None      # (user, dsn) of the connection the ids were drawn on
+        self.lock = threading.Lock()   # Stage entries of one entity type may run at once
+
+        self.q_get_ids = """
+        SELECT %s.NEXTVAL
+        FROM DUAL
+        CONNECT BY LEVEL <= :block_size""" % (sequence)
+
+    def next_id(self, c, logger):
+
+        # Ids held from a different database or schema are no use to this cursor
+
+        owner = (c.connection.username, c.connection.dsn)
+
+        self.lock.acquire()
+        try:
+            if owner != self.owner:
+                self.ids.clear()
+                self.owner = owner
+
+            if not self.ids:
+                self.refill(c, logger)
+
+            txn_id = self.ids.popleft()
+        finally:
+            self.lock.release()
+        logger.debug("Obtained MEA Txn Id %s" % (txn_id))
+
+        return txn_id
+
+    def refill(self, c, logger):
+
+        c.arraysize = self.block_size
+        c.execute(self.q_get_ids, block_size=self.block_size)
+        self.ids.extend([row[0] for row in c.fetchall()])
+        logger.debug("Allocated %d ids from %s" % (len(self.ids), self.sequence))
+
+        self.block_size = min(self.block_size * 2, self.block_max)
+
+class InterfaceWriter:
+
+    """Buffers rows for a MEA interface table and writes them with executemany"""
+
+    def __init__(self, c, statement, batch_size, logger):
+
+        self.c = c
+        self.statement = statement
+        self.batch_size = batch_size
+        self.logger = logger
+        self.rows = []
+
+    def write(self, **binds):
+
+        self.rows.append(binds)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+
+        # Write all buffered rows in a single round trip
+
+        if self.rows:
+            self.c.executemany(self.statement, self.rows)
+            self.logger.debug("Wrote %d interface rows" % (len(self.rows)))
+            self.rows = []
+
+class MergeWriter:
+
+    """Buffers rows for a dictionary table and upserts them with an array-bound MERGE"""
+
+    def __init__(self, c, table, keys, statement, batch_size, logger):
+
+        self.c = c
+        self.table = table
+        self.keys = keys       # Columns the MERGE matches on, bound under their own names
+        self.statement = statement
+        self.batch_size = batch_size
+        self.logger = logger
+        self.rows = []
+        self.inserted = 0
+        self.updated = 0
+
+    def write(self, **binds):
+
+        self.rows.append(binds)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+
+        # Merge all buffered rows in a single round trip. The rows already in
+        # the table are read first so that the chunk can report how many rows
+        # it inserted and how many it updated
+
+        if not self.rows:
+            return
+
+        existing = self.get_existing()
+
+        try:
+            self.c.executemany(self.statement, self.rows)
+            merged = self.rows
+        except cx_Oracle.IntegrityError:
+            # A row clashed with a constraint other than the MERGE condition.
+            # Merge the chunk row by row, skipping such rows as the single row
+            # loads always have
+            self.logger.debug("Chunk for %s clashed with an existing row, merging row by row" % (self.table))
+            merged = []
+            for row in self.rows:
+                try:
+                    self.c.execute(self.statement, row)
+                    merged.append(row)
+                except cx_Oracle.IntegrityError:
+                    self.logger.debug("Row already exists, skipping %s" % (row))
+
+        inserted = 0
+        updated = 0
+        for row in merged:
+            key = tuple([row[k] for k in self.keys])
+            if key in existing:
+                updated += 1
+            else:
+                inserted += 1
+                existing.add(key)
+
+        self.logger.info("Merged %d rows into %s, %d inserted and %d updated" % (len(merged), self.table, inserted, updated))
+        self.inserted += inserted
+        self.updated += updated
+        self.rows = []
+
+    def get_existing(self):
+
+        # Keys of the buffered rows that are already in the table
+
+        q_get_existing = """
+        SELECT %s
+        FROM %s
+        WHERE (%s) IN (%%s)""" % (", ".join(self.keys), self.table, ", ".join(self.keys))
+
+        keys = list(set([tuple([row[k] for k in self.keys]) for row in self.rows]))
+        existing = set()
+        self.c.arraysize = merge_key_chunk_size
+
+        for start in range(0, len(keys), merge_key_chunk_size):
+            binds = {}
+            tuples = []
+            for i, key in enumerate(keys[start:start + merge_key_chunk_size]):
+                names = []
+                for j, value in enumerate(key):
+                    binds["k%d_%d" % (i, j)] = value
+                    names.append(":k%d_%d" % (i, j))
+                tuples.append("(%s)" % (", ".join(names)))
+
+            self.c.execute(q_get_existing % (", ".join(tuples)), binds)
+            existing.update([tuple(row) for row in self.c.fetchall()])
+
+        return existing
+
+class MeaQueueWriter:
+
+    """Collects MEA transaction ids for an interface and queues them in mxin_inter_trans"""
+
+    def __init__(self, c, ifacename, batch_size, logger, action=None):
+
+        self.c = c
+        self.ifacename = ifacename
+        self.batch_size = batch_size
+        self.logger = logger
+        self.action = action
+        self.transids = deque()
+        self.queued = []     # Transids queued so far, for MeaQueueWaiter to follow into the interface table
+
+        if action:
+            self.q_write_queue = """
+            INSERT INTO maximo.mxin_inter_trans (
+                                   extsysname,
+                                   ifacename,
+                                   action,
+                                   transid
+                                   )
+            VALUES ('EXTSYS1', :ifacename, :action, :transid)"""
+        else:
+            self.q_write_queue = """
+            INSERT INTO maximo.mxin_inter_trans (
+                                   extsysname,
+                                   ifacename,
+                                   transid
+                                   )
+            VALUES ('EXTSYS1', :ifacename, :transid)"""
+
+    def __len__(self):
+
+        return len(self.transids)
+
+    def append(self, transid):
+
+        self.transids.append(transid)
+        if len(self.transids) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+
+        # Queue every held transid in a single round trip. MEA does not see
+        # the rows until the caller commits
+
+        if not self.transids:
+            return 0
+
+        rows = []
+        while self.transids:
+            transid = self.transids.popleft()
+            self.queued.append(transid)
+            row = {'ifacename': self.ifacename, 'transid': transid}
+            if self.action:
+                row['action'] = self.action
+            rows.append(row)
+
+        self.c.executemany(self.q_write_queue, rows)
+        self.logger.info("Queued %d batches for %s" % (len(rows), self.ifacename))
+
+        return len(rows)
+
+class MeaQueueWaiter:
+
+    """Waits for MEA to drain the queue of an interface, and optionally to load the interface rows of the transids queued, backing off between polls"""
+
+    def __init__(self, c, ifacename, logger, iface_table=None, transids=None, initial=poll_initial, maximum=poll_max):
+
+        self.c = c
+        self.ifacename = ifacename
+        self.logger = logger
+        self.iface_table = iface_table
+        self.transids = list(transids or [])   # Transids whose rows MEA may not have loaded yet
+        self.initial = initial
+        self.maximum = maximum
+
+        self.q_get_ct = """
+        SELECT COUNT(*)
+        FROM maximo.mxin_inter_trans
+        WHERE extsysname = 'EXTSYS1'
+        AND ifacename = :ifacename"""
+
+    def queued_batch_ct(self):
+
+        # Get the number of batches for THIS INTERFACE that
+        # have yet to be processed by MEA
+        self.c.execute(self.q_get_ct, ifacename=self.ifacename)
+        return self.c.fetchone()[0]
+
+    def unloaded_row_ct(self):
+
+        # Get the number of our transids that still have rows in the interface
+        # table. A transid MEA has loaded is not looked up again
+
+        q_get_unloaded = """
+        SELECT DISTINCT transid
+        FROM %s
+        WHERE transid IN (%%s)""" % (self.iface_table)
+
+        unloaded = []
+        for start in range(0, len(self.transids), transid_chunk_size):
+            chunk = self.transids[start:start + transid_chunk_size]
+            binds = dict([("t%d" % (i), transid) for (i, transid) in enumerate(chunk)])
+            self.c.execute(q_get_unloaded % (", ".join([":t%d" % (i) for i in range(len(chunk))])), binds)
+            unloaded.extend([row[0] for row in self.c.fetchall()])
+
+        self.transids = unloaded
+        return len(unloaded)
+
+    def wait(self, deadline, stall_timeout):
+
+        # Return True once the queue is empty and, if the waiter was given an
+        # interface table, MEA has loaded the rows of every transid given. Give
+        # up, returning False, once deadline seconds have passed in all or MEA
+        # has made no progress for stall_timeout seconds
+
+        start = time.time()
+
+        if not self.drain(self.queued_batch_ct, "batches in the queue", start, deadline, stall_timeout):
+            return False
+        self.logger.info("MEA has flushed its queue after %d seconds" % (time.time() - start))
+
+        # A batch leaves the queue when MEA picks it up, not when it has loaded
+        # the rows of the batch
+        if not (self.iface_table and self.transids):
+            return True
+
+        if not self.drain(self.unloaded_row_ct, "batches in %s" % (self.iface_table), start, deadline, stall_timeout):
+            return False
+        self.logger.info("MEA has loaded its batches from %s after %d seconds" % (self.iface_table, time.time() - start))
+
+        return True
+
+    def drain(self, get_ct, what, start, deadline, stall_timeout):
+
+        # Poll get_ct until it returns 0. The deadline counts from start, the
+        # stall timeout and the drain rate from the first poll
+
+        begin = time.time()
+        interval = self.initial
+        first_ct = None
+        last_ct = None
+        last_progress = begin
+
+        while True:
+            wait_ct = get_ct()
+            now = time.time()
+
+            if wait_ct == 0:
+                return True
+
+            if first_ct is None:
+                first_ct = wait_ct
+            if last_ct is None or wait_ct < last_ct:
+                last_progress = now
+            last_ct = wait_ct
+
+            # Estimate the drain rate over the whole wait so far
+            rate = (first_ct - wait_ct) / (now - begin) if now > begin else 0.0
+            if rate > 0:
+                eta = wait_ct / rate
+                self.logger.info("MEA has %s unprocessed %s, draining %.1f per second, about %d seconds to go" % (wait_ct, what, rate, eta))
+            else:
+                eta = None
+                self.logger.info("MEA has %s unprocessed %s" % (wait_ct, what))
+
+            if now - start >= deadline:
+                self.logger.error("MEA did not process its %s within %d seconds" % (what, deadline))
+                return False
+            if now - last_progress >= stall_timeout:
+                self.logger.error("MEA has not processed any %s for %d seconds" % (what, now - last_progress))
+                return False
+
+            # Jitter keeps concurrent waiters from polling in step. Never sleep
+            # much past the expected finish or at all past the deadline
+            pause = interval * random.uniform(0.8, 1.2)
+            if eta is not None:
+                pause = min(pause, max(self.initial, eta))
+            pause = min(pause, start + deadline - now)
+            time.sleep(pause)
+
+            interval = min(interval * 2, self.maximum)
+
+class HierarchyScheduler:
+
+    """Releases each node of a hierarchy to MEA as soon as MEA has loaded its own parent"""
+
+    def __init__(self, c, ifacename, logger, initial=poll_initial, maximum=poll_max):
+
+        self.c = c
+        self.ifacename = ifacename
+        self.logger = logger
+        self.initial = initial
+        self.maximum = maximum
+
+        self.children = {}     # Key of a parent -> nodes waiting for MEA to load it
+        self.ready = deque()   # Nodes that may be written now
+        self.inflight = {}     # Transid -> key of a node queued for MEA
+        self.unreleased = 0    # Nodes not yet handed to the caller
+
+        self.q_get_queued = """
+        SELECT transid
+        FROM maximo.mxin_inter_trans
+        WHERE extsysname = 'EXTSYS1'
+        AND ifacename = :ifacename"""
+
+    def __len__(self):
+
+        # Nodes that MEA has still to load
+        return self.unreleased + len(self.inflight)
+
+    def load(self, nodes, key):
+
+        # A node waits only if its parent is part of the same load. Nodes are
+        # released in the order given, so pass them in level order
+
+        keys = set([getattr(node, key) for node in nodes])
+        for node in nodes:
+            if node.parent in keys and node.parent != getattr(node, key):
+                self.children.setdefault(node.parent, []).append(node)
+            else:
+                self.ready.append(node)
+        self.unreleased += len(nodes)
+
+        self.logger.info("%d of %d nodes have no parent in this load" % (len(self.ready), len(nodes)))
+
+    def release(self):
+
+        nodes = list(self.ready)
+        self.ready.clear()
+        self.unreleased -= len(nodes)
+        return nodes
+
+    def sent(self, key, transid):
+
+        self.inflight[transid] = key
+
+    def loaded(self, key):
+
+        # The children of a loaded node may now be written
+        self.ready.extend(self.children.pop(key, []))
+
+    def wait(self, deadline, stall_timeout):
+
+        # Poll, backing off, until MEA has taken at least one of our transids
+        # off its queue. Give up after stall_timeout or deadline seconds,
+        # whichever is shorter
+
+        if not self.inflight:
+            self.logger.error("%d nodes wait on parents that will never be loaded" % (self.unreleased))
+            return False
+
+        limit = min(deadline, stall_timeout)
+        start = time.time()
+        interval = self.initial
+
+        while True:
+            self.c.execute(self.q_get_queued, ifacename=self.ifacename)
+            queued = set([row[0] for row in self.c.fetchall()])
+            consumed = [transid for transid in self.inflight if transid not in queued]
+
+            if consumed:
+                for transid in consumed:
+                    self.loaded(self.inflight.pop(transid))
+                self.logger.info("MEA has loaded %d batches, %d still queued, %d nodes ready" % (len(consumed), len(self.inflight), len(self.ready)))
+                return True
+
+            elapsed = time.time() - start
+            if elapsed >= limit:
+                self.logger.error("MEA has not processed any of %d batches for %d seconds" % (len(self.inflight), elapsed))
+                return False
+
+            time.sleep(min(interval * random.uniform(0.8, 1.2), limit - elapsed))
+            interval = min(interval * 2, self.maximum)
+
+########################################################################################
+#
+#     Functions
+#
+########################################################################################
+
+def wait_for_mea(c, ifacename, er, iface_table=None, transids=None):
+
+    # Wait for MEA to drain the queue for ifacename within the limits of the
+    # run and, given the interface table, to load the rows of transids from it
+
+    er.logger.info("Wait for MEA to flush its %s queue" % (ifacename))
+    return MeaQueueWaiter(c, ifacename, er.logger, iface_table, transids).wait(er.mea_wait_deadline, er.mea_wait_interval)
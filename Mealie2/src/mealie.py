@@ -72,6 +72,15 @@
 import sys
 # import os
 
+from daemonclient import run_client
+
+# Hand the run to the warm daemon if one is listening, before any of the
+# imports an in process run needs
+if __name__ == "__main__":
+    code = run_client(sys.argv[1:])
+    if code is not None:
+        sys.exit(code)
+
 # The usual setting at Hulamin is "/usr/local/lib/python" but YMMV
 # mealie_path = os.environ.get("MEALIE_PATH")
 
@@ -87,20 +96,15 @@ except ImportError:
     print("ERROR: Cannot import base.launcher. Is your \"MEALIE_PATH\" set correctly?")
     sys.exit(2)
 
-from entities.assetspecs import asp_handler
-from entities.assets import ass_handler
-from entities.locations import loc_handler
-
-action_handler = {
-    "ASP": asp_handler,
-    "ASS": ass_handler,
-    "COM": com_handler,
-    "ICG": icg_handler,
-    "LOC": loc_handler,
-    "UND": und_handler,
-    "UOM": uom_handler
-}
+from handlers import get_handler, HandlerError
 
 if __name__ == "__main__":
     er = main(sys.argv[1:])                # Pass all args except name of program
-    action_handler.get(er.entity_type)(er) # Call the appropriate handler for the entity
+    try:
+        handler = get_handler(er.entity_type, er.logger)   # Only the handler for the entity is imported
+    except HandlerError, e:
+        print("ERROR: %s" % (e))
+        er.logger.error("%s" % (e))
+        sys.exit(2)
+    handler(er)                            # Call the appropriate handler for the entity
+    er.registry.close()
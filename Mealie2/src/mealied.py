@@ -0,0 +1,19 @@
+#!/usr/bin/env python
+#
+# MEA Lightweight Integration Environment
+#
+# Initialisation procedure for the warm daemon
+#
+
+########################################################################################
+#
+#     Import required modules
+#
+########################################################################################
+
+import sys
+
+from daemon import daemon_main
+
+if __name__ == "__main__":
+    daemon_main(sys.argv[1:])      # Pass all args except name of program
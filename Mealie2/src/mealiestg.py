@@ -28,6 +28,15 @@
 import sys
 import os
 
+from daemonclient import stage_client
+
+# Hand the stage to the warm daemon if one is listening, before any of the
+# imports an in process stage needs
+if __name__ == "__main__":
+    code = stage_client(sys.argv[1:])
+    if code is not None:
+        sys.exit(code)
+
 from launcher import stage
 from stage import stage_handler
 
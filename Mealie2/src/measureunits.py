@@ -21,9 +21,14 @@
 ########################################################################################
 
 import cx_Oracle
-import xlrd
 import sys
-import time
+
+from meabatch import TxnIdAllocator, MeaQueueWriter, wait_for_mea
+from sheets import open_sheet
+from connpool import connect_target
+
+# MEA transaction ids are allocated in blocks from the entity sequence
+txn_ids = TxnIdAllocator('maximo.hul_mealie_uom_seq')
 
 ########################################################################################
 #
@@ -31,11 +36,18 @@ import time
 #
 ########################################################################################
 
+# Columns of the source spreadsheet read by InterfaceableMeasureunitFromXls
+sheet_columns = [
+    ('measureunitid', 7),
+    ('description', 8),
+    ('abbreviation', 9)
+]
+
 class InterfaceableMeasureunitFromXls:
 
     """Class representing a Unit of Measure to be loaded by MEA from a spreadsheet"""
 
-    def __init__(self, worksheet, i, c, logger):
+    def __init__(self, row, c, logger):
         
         # Values are taken from the Classification Template
 
@@ -45,9 +57,9 @@ class InterfaceableMeasureunitFromXls:
         # Template would have many duplicate Properties and even different Properties may have
         # the same Measure Unit. Thus in effect only the first one encountered is loaded to MEA
 
-        self.measureunitid = worksheet.cell(i, 7).value
-        self.description = worksheet.cell(i, 8).value
-        self.abbreviation = worksheet.cell(i, 9).value
+        self.measureunitid = row.measureunitid
+        self.description = row.description
+        self.abbreviation = row.abbreviation
 
         self.errmsg = None
         self.severity = None
@@ -78,57 +90,13 @@ class InterfaceableMeasureunitFromXls:
 def get_next_txn_id(c, logger):
 
     # Get the next available transaction id for a MEA batch
-    q_get_id = """
-    SELECT maximo.hul_mealie_uom_seq.NEXTVAL
-    FROM DUAL"""
-
-    c.execute(q_get_id)
-    txn_id = c.fetchone()
-    logger.debug("Obtained MEA Txn Id %s" % (txn_id[0]))
-
-    return txn_id[0]
-
-def get_queued_batch_ct(c, logger):
-
-    # Get the number of batches for THIS INTERFACE that 
-    # have yet to be processed by MEA
-    q_get_ct = """
-    SELECT COUNT(*)
-    FROM maximo.mxin_inter_trans 
-    WHERE extsysname = 'EXTSYS1'
-    AND ifacename = 'mxmeasure_iface'"""
-
-    time.sleep(5)       # t = seconds
-    c.execute(q_get_ct)
-    wait_ct = c.fetchone()
-    logger.info("MEA has %s unprocessed batches in the queue" % (wait_ct[0]))
-
-    return wait_ct[0]
-
-
-def write_mea_queue(c, txid, logger):
-
-    # Insert row into MEA queue
-
-    q_write_queue = """
-    INSERT INTO maximo.mxin_inter_trans (
-                           extsysname,
-                           ifacename,
-                           action,
-                           transid
-                           )
-    VALUES ('EXTSYS1', 'mxmeasure_iface', 'AddChange', :trans_id)"""
-
-    logger.debug("Writing MEA queue for transid %d" % txid)
-    c.execute(q_write_queue, trans_id=txid)
-
-    return True
-
+    return txn_ids.next_id(c, logger)
 
 def uom_handler(er):
 
     type_handler = {
-        "XLS": uom_handler_xls_ora
+        "XLS": uom_handler_xls_ora,
+        "CSV": uom_handler_xls_ora
     }
 
     return type_handler.get(er.source_type)(er)   # Call appropriate handler for the source type
@@ -144,18 +112,14 @@ def uom_handler_xls_ora(er):
 
     # Open source spreadsheet
 
-    try:
-        ifh = xlrd.open_workbook(er.source_xlsfile)
-    except IOError:
-        print("ERROR: Unable to open %s" % (er.source_xlsfile))
-        er.logger.error("Unable to open %s" % (er.source_xlsfile))
+    rows = open_sheet(er, sheet_columns)
+    if rows is None:
         return False
-    wsh = ifh.sheet_by_index(0)
 
     # Connect to MEA target database
 
     try:
-        conn_target = cx_Oracle.connect("%s/%s@%s" % (er.target_user, er.target_pwd, er.target_db))
+        conn_target = connect_target(er)
     except cx_Oracle.DatabaseError, exc:
         error, = exc.args
         print("ERROR: %s" % (error.message))
@@ -168,6 +132,9 @@ def uom_handler_xls_ora(er):
     curs_target_lookup = conn_target.cursor()
     curs_target_seq = conn_target.cursor()
 
+    # Transids are queued for MEA in array-bound inserts
+    mea_queue = MeaQueueWriter(curs_target_mea, 'mxmeasure_iface', er.batch_size, er.logger, 'AddChange')
+
     # Insert a row into MEA interface for entity type ASSET
 
     q_write_interface = """
@@ -187,14 +154,13 @@ def uom_handler_xls_ora(er):
     # Initialise local variables for fetch loop
 
     total_ct = 0       # Total no. of items
-    start_row = 1      # The first row in spreadsheet that contains data (starting at 0)
-    processed_mu = []  # Values of measureunitid that have been processed. Only first occurrence in file is processed
+    processed_mu = er.registry.keys('measureunitid')  # Values of measureunitid already processed in this run. Only the first occurrence is processed
 
     # Iterate through all rows of data in input spreadsheet
 
-    for this_row in range(start_row, wsh.nrows):
+    for row in rows:
 
-        mu = InterfaceableMeasureunitFromXls(wsh, this_row, curs_target_seq, er.logger)
+        mu = InterfaceableMeasureunitFromXls(row, curs_target_seq, er.logger)
         if mu.measureunitid == "":
         
             er.logger.info("Skipping specification with no UOM")
@@ -229,11 +195,11 @@ def uom_handler_xls_ora(er):
                                                                transid=trans_id,
                                                                transseq=trans_seq)
                     er.logger.debug("Wrote interface")
-                    processed_mu.append(mu.measureunitid)     # We processed it, remember it
+                    processed_mu.add(mu.measureunitid)     # We processed it, remember it
 
                     # Write the MEA queue
-                    write_mea_queue(curs_target_mea, trans_id, er.logger)
-                    er.logger.debug("Wrote MEA queue for transid %d" % trans_id)
+                    mea_queue.append(trans_id)
+                    er.logger.debug("Queued transid %d" % trans_id)
     
                     total_ct += 1
                 
@@ -256,26 +222,25 @@ def uom_handler_xls_ora(er):
     # Otherwise we commit the whole transaction
 
     if (not er.test_mode):
+        mea_queue.flush()
         er.logger.info("Committing changes to MEA target %s" % er.target_db)
         conn_target.commit() 
+        er.registry.commit()
     else:
         er.logger.info("Test Mode: Rolling back changes to %s" % er.target_db)
         conn_target.rollback() 
+        er.registry.rollback()
 
     er.logger.info("Processed %s %s entities" % (total_ct, er.entity_type))
 
-    # Wait until MEA has flushed the queue
+    rows.close()   # The sheet is not needed while MEA loads
 
-    er.logger.info("Wait for MEA to flush its queue")
-    queued_batches = get_queued_batch_ct(curs_target_seq, er.logger)
-    while (queued_batches):
-        er.logger.debug("MEA still has %s items in queue" % (queued_batches))
-        queued_batches = get_queued_batch_ct(curs_target_seq, er.logger)
+    # Wait until MEA has flushed the queue and loaded our batches
 
-    if (not er.test_mode):
-        # Tune this value according to your cron configuration
-        er.logger.info("Waiting %d seconds for MEA to finish loading" % (er.mea_wait_interval))
-        time.sleep(er.mea_wait_interval)
+    if not wait_for_mea(curs_target_seq, 'mxmeasure_iface', er, 'maximo.mxmeasure_iface', mea_queue.queued):
+        print("ERROR: MEA did not load its mxmeasure_iface batches, aborting")
+        conn_target.close()         # Free the connection
+        sys.exit(2)
 
     print("Processed %s %s entities" % (total_ct, er.entity_type))
     print "See %s for full details of this run" % er.log_file
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+#
+# MEA Lightweight Integration Environment
+#
+# Validation receipts. A clean test run of a source file leaves a receipt
+# recording the file it validated and fingerprints of the reference data it
+# validated against. An update run of the same file against the same target
+# skips validation if the reference data has not changed since
+#
+
+########################################################################################
+#
+#     Import required modules
+#
+########################################################################################
+
+import os
+import time
+import marshal
+
+from common import cell_key
+from refcache import default_cache_dir, read_cache_file, write_cache_file
+from rowcache import file_digest
+
+########################################################################################
+#
+#     Globals
+#
+########################################################################################
+
+# Bump whenever the layout of a receipt changes so that stale files are ignored
+receipt_version = 3
+
+# One cheap aggregate per reference set. Any row added, removed or changed
+# alters the count or the hash total, and so invalidates the receipt
+fingerprint_queries = {
+    "orgids": """
+        SELECT COUNT(*), SUM(ORA_HASH(orgid))
+        FROM maximo.organization""",
+    "depts": """
+        SELECT COUNT(*), SUM(ORA_HASH(compvalue || '/' || orgid))
+        FROM maximo.glcomponents
+        WHERE glorder = 1
+        AND LENGTH(compvalue) = 5""",
+    "systemids": """
+        SELECT COUNT(*), SUM(ORA_HASH(systemid || '/' || orgid))
+        FROM maximo.locsystem"""
+}
+
+# Assets and locations are too many to aggregate whole on every run, so only
+# the rows a sheet refers to are fingerprinted, a chunk of keys at a time
+keyed_fingerprint_queries = {
+    "assets": """
+        SELECT COUNT(*), SUM(ORA_HASH(assetnum))
+        FROM maximo.asset
+        WHERE status = 'OPERATING'
+        AND assetnum IN (%s)""",
+    "locations": """
+        SELECT COUNT(*), SUM(ORA_HASH(location))
+        FROM maximo.locations
+        WHERE status = 'OPERATING'
+        AND location IN (%s)"""
+}
+
+# Oracle allows at most 1000 expressions in an IN list
+key_chunk_size = 1000
+
+########################################################################################
+#
+#     Class definitions
+#
+########################################################################################
+
+class ValidationReceipt:
+
+    """Receipt for the validation of one source file of an entity type against one target"""
+
+    def __init__(self, er, references):
+
+        # references names the fingerprint_queries or keyed_fingerprint_queries
+        # whose tables the handler validates against
+
+        self.er = er
+        self.references = references
+        self.source_digest = file_digest(er.source_xlsfile)
+        self.path = os.path.join(er.cache_dir or default_cache_dir, "receipt_%s_%s_%s_%s.rcpt" %
+                                 (er.entity_type, er.target_user.lower(), er.target_db.lower(), self.source_digest))
+
+    def fingerprint(self, conn, keys=None):
+
+        # Taken before validation starts, so that a change made while the test
+        # run validates is caught by the update run. keys gives the keys the
+        # sheet refers to for each of keyed_fingerprint_queries
+
+        fingerprints = {}
+        curs = conn.cursor()
+        for name in self.references:
+            if name in keyed_fingerprint_queries:
+                fingerprints[name] = keyed_fingerprint(curs, keyed_fingerprint_queries[name], keys[name])
+            else:
+                curs.execute(fingerprint_queries[name])
+                fingerprints[name] = tuple(curs.fetchone())
+        curs.close()
+        return fingerprints
+
+    def matches(self, fingerprints):
+
+        # True if a clean test run validated this file against reference data
+        # that still has the given fingerprints
+
+        receipt = self.load()
+        if receipt is None:
+            self.er.logger.info("No validation receipt for %s, validating" % (self.er.source_xlsfile))
+            return False
+
+        for name in self.references:
+            if receipt['fingerprints'].get(name) != fingerprints[name]:
+                self.er.logger.info("%s changed since the test run of %s, validating" % (name, self.er.source_xlsfile))
+                return False
+
+        self.er.logger.info("Validation receipt of %s matches, issued %s" %
+                            (self.er.source_xlsfile, time.ctime(receipt['created'])))
+        return True
+
+    def issue(self, fingerprints):
+
+        # Record a clean test run
+
+        receipt = {'version': receipt_version,
+                   'created': time.time(),
+                   'entity_type': self.er.entity_type,
+                   'source_xlsfile': self.er.source_xlsfile,
+                   'source_digest': self.source_digest,
+                   'fingerprints': fingerprints,
+                   'outcome': 'VALID'}
+
+        if not write_cache_file(self.path, marshal.dumps(receipt), self.er.logger):
+            return
+
+        self.er.logger.info("Issued validation receipt %s" % (self.path))
+
+    def load(self):
+
+        data = read_cache_file(self.path, self.er.logger)
+        if data is None:
+            return None
+        try:
+            receipt = marshal.loads(data)
+        except (EOFError, ValueError, TypeError):
+            self.er.logger.debug("Ignoring unreadable receipt %s" % (self.path))
+            return None
+
+        if not isinstance(receipt, dict) or receipt.get('version') != receipt_version or receipt.get('outcome') != 'VALID':
+            return None
+        return receipt
+
+########################################################################################
+#
+#     Functions
+#
+########################################################################################
+
+def keyed_fingerprint(curs, query, keys):
+
+    # Count and hash total of the rows of query matching any of keys. Cells
+    # that are empty refer to nothing, numeric ones are compared as text
+
+    keys = sorted(set([cell_key(key) for key in keys if key]))
+    (row_ct, hash_total) = (0, 0)
+
+    for start in range(0, len(keys), key_chunk_size):
+        chunk = keys[start:start + key_chunk_size]
+        binds = dict(("k%d" % i, key) for i, key in enumerate(chunk))
+        placeholders = ", ".join([":k%d" % i for i in range(len(chunk))])
+        curs.execute(query % (placeholders), binds)
+        (chunk_ct, chunk_total) = curs.fetchone()
+        row_ct += chunk_ct
+        hash_total += chunk_total or 0   # SUM of no rows is NULL
+
+    return (row_ct, hash_total)
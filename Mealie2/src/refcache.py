@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+#
+# MEA Lightweight Integration Environment
+#
+# Reference data cache. Snapshots of the orgids, GL departments and systemids
+# used for validation are shared by every handler in the process and kept on
+# local disk so that the next run can start validating straight away.
+#
+# Cache files are marshalled rather than pickled, and are only read from and
+# written to a directory that belongs to the user and that no one else can
+# write to, so nobody else can plant data in a run
+#
+
+########################################################################################
+#
+#     Import required modules
+#
+########################################################################################
+
+import os
+import thread
+import time
+import marshal
+
+from common import read_orgids, read_depts, read_systemids, private_dir
+
+########################################################################################
+#
+#     Globals
+#
+########################################################################################
+
+# Bump whenever the layout of a snapshot changes so that stale files are ignored
+snapshot_version = 2
+
+# Per-user, never the shared temporary directory. Overridden by the dir option
+# of the [cache] section
+default_cache_dir = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'mealie')
+
+reference_readers = {
+    "orgids": read_orgids,
+    "depts": read_depts,
+    "systemids": read_systemids
+}
+
+########################################################################################
+#
+#     Class definitions
+#
+########################################################################################
+
+class RefDataCache:
+
+    """Versioned reference data snapshots held in memory and on local disk"""
+
+    def __init__(self):
+
+        self.snapshots = {}
+
+    def get(self, name, conn, er):
+
+        # Return the named reference data for the target of this run, reading
+        # it from the database only if no snapshot younger than the TTL exists
+
+        key = (er.target_user.lower(), er.target_db.lower(), name)
+
+        snapshot = self.snapshots.get(key)
+        if not self.is_fresh(snapshot, er.cache_ttl):
+            snapshot = self.load(key, er)
+        if not self.is_fresh(snapshot, er.cache_ttl):
+            er.logger.debug("Reading %s reference data from %s" % (name, er.target_db))
+            snapshot = {'version': snapshot_version,
+                        'created': time.time(),
+                        'data': reference_readers[name](conn)}
+            self.save(key, snapshot, er)
+        self.snapshots[key] = snapshot
+
+        return snapshot['data']
+
+    def invalidate(self):
+
+        self.snapshots.clear()
+
+    def is_fresh(self, snapshot, ttl):
+
+        if not isinstance(snapshot, dict) or snapshot.get('version') != snapshot_version:
+            return False
+        return (time.time() - snapshot['created']) < ttl
+
+    def path(self, key, er):
+
+        return os.path.join(er.cache_dir or default_cache_dir, "%s_%s_%s.snap" % key)
+
+    def load(self, key, er):
+
+        data = read_cache_file(self.path(key, er), er.logger)
+        if data is None:
+            return None
+        try:
+            return marshal.loads(data)
+        except (EOFError, ValueError, TypeError):
+            er.logger.debug("Ignoring unreadable snapshot %s" % (self.path(key, er)))
+            return None
+
+    def save(self, key, snapshot, er):
+
+        try:
+            data = marshal.dumps(snapshot)
+        except ValueError, exc:
+            er.logger.debug("Unable to cache %s reference data: %s" % (key[2], exc))
+            return
+        write_cache_file(self.path(key, er), data, er.logger)
+
+# The one cache shared by every handler in this process
+reference_cache = RefDataCache()
+
+########################################################################################
+#
+#     Functions
+#
+########################################################################################
+
+def get_orgids(conn, er):
+
+    return reference_cache.get("orgids", conn, er)
+
+def get_depts(conn, er):
+
+    return reference_cache.get("depts", conn, er)
+
+def get_systemids(conn, er):
+
+    return reference_cache.get("systemids", conn, er)
+
+def read_cache_file(path, logger):
+
+    # Content of a cache file, or None if there is none or its directory is
+    # not private to this user
+
+    try:
+        private_dir(os.path.dirname(path))
+    except OSError, exc:
+        logger.warning("Ignoring cache directory: %s" % (exc))
+        return None
+
+    try:
+        fh = open(path, 'rb')
+    except IOError:
+        return None
+    try:
+        return fh.read()
+    finally:
+        fh.close()
+
+def write_cache_file(path, data, logger):
+
+    # Written to a temporary file first so that a concurrent reader never
+    # sees a partial file. A cache that cannot be written is not fatal.
+    # Returns True if the file was written
+
+    try:
+        private_dir(os.path.dirname(path))
+        tmp_path = "%s.%d.%d" % (path, os.getpid(), thread.get_ident())
+        fh = open(tmp_path, 'wb')
+        fh.write(data)
+        fh.close()
+        os.rename(tmp_path, path)
+    except (IOError, OSError), exc:
+        logger.debug("Unable to write cache file %s: %s" % (path, exc))
+        return False
+
+    return True
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+#
+# MEA Lightweight Integration Environment
+#
+# Run-scoped registry of the keys the entity handlers have already loaded, so
+# that each key is only interfaced once. A stage shares one registry between its
+# entries, so later entries also skip keys loaded by earlier ones. Entries that
+# run concurrently each see the registry through their own view
+#
+
+########################################################################################
+#
+#     Import required modules
+#
+########################################################################################
+
+import os
+import shutil
+import tempfile
+import threading
+import anydbm
+
+########################################################################################
+#
+#     Globals
+#
+########################################################################################
+
+# Committed keys of a namespace are moved from memory to a dbm file on local
+# disk once there are more than this many of them
+spill_threshold = 500000
+
+########################################################################################
+#
+#     Class definitions
+#
+########################################################################################
+
+class KeySet:
+
+    """Keys of one namespace. Keys added since the last commit are held apart so that a rollback can drop them"""
+
+    def __init__(self, name, spill_dir, threshold):
+
+        self.name = name
+        self.spill_dir = spill_dir
+        self.threshold = threshold
+        self.loaded = set()    # Keys committed by this or an earlier entry
+        self.pending = set()   # Keys added by the current entry
+        self.db = None         # dbm file holding the committed keys once spilled
+        self.tmp_dir = None
+
+    def __contains__(self, key):
+
+        if key in self.pending or key in self.loaded:
+            return True
+        return self.db is not None and spill_key(key) in self.db
+
+    def __len__(self):
+
+        spilled = 0
+        if self.db is not None:
+            spilled = len(self.db)
+        return len(self.pending) + len(self.loaded) + spilled
+
+    def add(self, key):
+
+        self.pending.add(key)
+
+    def commit(self):
+
+        self.merge(self.pending)
+        self.pending = set()
+
+    def merge(self, keys):
+
+        # Count keys as loaded, e.g. the committed keys of an entry's view
+        self.loaded.update(keys)
+        if len(self.loaded) > self.threshold:
+            self.spill()
+
+    def rollback(self):
+
+        self.pending = set()
+
+    def spill(self):
+
+        if self.db is None:
+            self.tmp_dir = tempfile.mkdtemp(prefix='mealie_keys_', dir=self.spill_dir)
+            self.db = anydbm.open(os.path.join(self.tmp_dir, "%s.db" % (self.name)), 'n')
+        for key in self.loaded:
+            self.db[spill_key(key)] = ''
+        self.loaded = set()
+
+    def close(self):
+
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+            shutil.rmtree(self.tmp_dir, True)
+            self.tmp_dir = None
+
+class EntryKeys:
+
+    """Keys of one namespace as seen by one stage entry. Keys the entry adds stay private to it until it commits"""
+
+    def __init__(self, keyset, lock):
+
+        self.keyset = keyset
+        self.lock = lock
+        self.pending = set()
+
+    def __contains__(self, key):
+
+        if key in self.pending:
+            return True
+        self.lock.acquire()
+        try:
+            return key in self.keyset
+        finally:
+            self.lock.release()
+
+    def __len__(self):
+
+        return len(self.pending) + len(self.keyset)
+
+    def add(self, key):
+
+        self.pending.add(key)
+
+    def commit(self):
+
+        self.lock.acquire()
+        try:
+            self.keyset.merge(self.pending)
+        finally:
+            self.lock.release()
+        self.pending = set()
+
+    def rollback(self):
+
+        self.pending = set()
+
+class EntryRegistry:
+
+    """View of a KeyRegistry for one stage entry, so that entries running at the same time commit and roll back apart"""
+
+    def __init__(self, registry):
+
+        self.registry = registry
+        self.namespaces = {}
+
+    def keys(self, namespace):
+
+        if namespace not in self.namespaces:
+            self.namespaces[namespace] = EntryKeys(self.registry.keys(namespace), self.registry.lock)
+        return self.namespaces[namespace]
+
+    def commit(self):
+
+        for entry_keys in self.namespaces.values():
+            entry_keys.commit()
+
+    def rollback(self):
+
+        for entry_keys in self.namespaces.values():
+            entry_keys.rollback()
+
+    def close(self):
+
+        # The shared registry is closed by its owner
+        self.namespaces = {}
+
+class KeyRegistry:
+
+    """Namespaced sets of keys loaded during a run"""
+
+    def __init__(self, spill_dir=None, threshold=spill_threshold):
+
+        self.spill_dir = spill_dir
+        self.threshold = threshold
+        self.namespaces = {}
+        self.lock = threading.Lock()   # Held by entry views while they read or commit
+
+    def keys(self, namespace):
+
+        # Return the set for namespace, creating it on first use
+
+        self.lock.acquire()
+        try:
+            if namespace not in self.namespaces:
+                self.namespaces[namespace] = KeySet(namespace, self.spill_dir, self.threshold)
+            return self.namespaces[namespace]
+        finally:
+            self.lock.release()
+
+    def entry(self):
+
+        # A view for one stage entry
+        return EntryRegistry(self)
+
+    def commit(self):
+
+        # Keys of a committed entry count as loaded for the rest of the run
+        for keyset in self.namespaces.values():
+            keyset.commit()
+
+    def rollback(self):
+
+        for keyset in self.namespaces.values():
+            keyset.rollback()
+
+    def close(self):
+
+        for keyset in self.namespaces.values():
+            keyset.close()
+        self.namespaces = {}
+
+########################################################################################
+#
+#     Functions
+#
+########################################################################################
+
+def spill_key(key):
+
+    # Keys that compare equal in a set must map to the same dbm key, e.g. the
+    # str and unicode forms of a code, or 1.0 and 1 from a spreadsheet cell
+
+    if isinstance(key, str):
+        key = key.decode('utf-8')
+    if isinstance(key, float) and key == int(key):
+        key = int(key)
+    return repr(key)
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+#
+# MEA Lightweight Integration Environment
+#
+# Parsed source row cache. The records read from a source file are kept on
+# local disk, keyed by a hash of the file content and the entity type, so that
+# a later run over the same file does not parse it again
+#
+# Records are cached as read, before any handler has normalised them. GL
+# account expansion and the int and str coercions still run on every run, as
+# they log and reject rows through the run's own logger
+#
+
+########################################################################################
+#
+#     Import required modules
+#
+########################################################################################
+
+import os
+import zlib
+import hashlib
+import marshal
+
+from refcache import default_cache_dir, read_cache_file, write_cache_file
+
+########################################################################################
+#
+#     Globals
+#
+########################################################################################
+
+# Bump whenever the layout of a cached file changes so that stale files are ignored
+rows_version = 4
+
+rows_suffix = '.rows'
+
+# Defaults for the rows_max_mb and rows_max_files options of the [cache] section
+default_rows_max_mb = 256
+default_rows_max_files = 100
+
+# Source files are hashed this many bytes at a time
+hash_block_size = 1024 * 1024
+
+########################################################################################
+#
+#     Class definitions
+#
+########################################################################################
+
+class RowCache:
+
+    """Parsed source rows on local disk, evicted least recently used first once the cache outgrows its limits"""
+
+    def __init__(self, cache_dir, max_mb, max_files):
+
+        self.cache_dir = cache_dir or default_cache_dir
+        self.max_bytes = max_mb * 1024 * 1024
+        self.max_files = max_files
+
+    def path(self, filename, entity_type, columns, start_row):
+
+        # The column layout is part of the key, so a handler that reads other
+        # columns of the same file does not get the rows of another handler
+
+        digest = hashlib.sha1("%d|%s|%r|%d|%s" % (rows_version, entity_type, columns, start_row, file_digest(filename)))
+        return os.path.join(self.cache_dir, "rows_%s_%s%s" % (entity_type, digest.hexdigest(), rows_suffix))
+
+    def has(self, path):
+
+        return os.path.exists(path)
+
+    def load(self, path, logger):
+
+        # Return the (header, rows) cached at path, or None
+
+        data = read_cache_file(path, logger)
+        if data is None:
+            return None
+        try:
+            (version, header, rows) = marshal.loads(zlib.decompress(data))
+        except (zlib.error, EOFError, ValueError, TypeError):
+            logger.debug("Ignoring unreadable row cache %s" % (path))
+            return None
+
+        if version != rows_version:
+            return None
+
+        try:
+            os.utime(path, None)   # Eviction goes by last use
+        except OSError:
+            pass
+        return (header, rows)
+
+    def row_size(self, values):
+
+        # Bytes the values of a row add to a cached file before compression,
+        # or None if they cannot be cached
+
+        try:
+            return len(marshal.dumps(values))
+        except ValueError:
+            return None
+
+    def store(self, path, header, rows, logger):
+
+        try:
+            data = zlib.compress(marshal.dumps((rows_version, header, rows)))
+        except ValueError, exc:
+            logger.debug("Rows cannot be cached: %s" % (exc))
+            return
+        if len(data) > self.max_bytes:
+            logger.debug("%d rows are too large for the row cache" % (len(rows)))
+            return
+
+        if not write_cache_file(path, data, logger):
+            return
+
+        logger.debug("Cached %d rows in %s" % (len(rows), path))
+        self.evict(logger)
+
+    def evict(self, logger):
+
+        # Remove the least recently used files until the cache is within both limits
+
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(rows_suffix):
+                try:
+                    st = os.stat(os.path.join(self.cache_dir, name))
+                except OSError:
+                    continue   # Removed by another run
+                entries.append((st.st_mtime, st.st_size, name))
+        entries.sort()
+
+        total = sum([size for (mtime, size, name) in entries])
+        while entries and (len(entries) > self.max_files or total > self.max_bytes):
+            (mtime, size, name) = entries.pop(0)
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+                logger.debug("Evicted %s from the row cache" % (name))
+            except OSError:
+                pass
+            total -= size
+
+########################################################################################
+#
+#     Functions
+#
+########################################################################################
+
+def file_digest(filename):
+
+    # SHA-1 of the content of a file, read a block at a time
+
+    digest = hashlib.sha1()
+    fh = open(filename, 'rb')
+    try:
+        block = fh.read(hash_block_size)
+        while block:
+            digest.update(block)
+            block = fh.read(hash_block_size)
+    finally:
+        fh.close()
+
+    return digest.hexdigest()
@@ -0,0 +1,449 @@
+#!/usr/bin/env python
+#
+# MEA Lightweight Integration Environment
+#
+# Source file readers shared by the entity handlers
+#
+
+########################################################################################
+#
+#     Import required modules
+#
+########################################################################################
+
+import csv
+import datetime
+import os
+import re
+
+import xlrd
+
+# .xlsx workbooks are streamed with openpyxl, which is only needed for them
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+########################################################################################
+#
+#     Globals
+#
+########################################################################################
+
+# Source types read from a file named by source_xlsfile rather than a database
+file_source_types = ['XLS', 'CSV']
+
+# Delimited text files are read as CSV. Files with one of these extensions are
+# split on tabs, any other on commas
+tsv_extensions = ['.tsv', '.tab']
+csv_extensions = ['.csv'] + tsv_extensions
+
+csv_encoding = 'utf-8'
+
+# Workbooks with one of these extensions are streamed in read-only mode
+xlsx_extensions = ['.xlsx', '.xlsm']
+
+# Day 0 of Excel's 1900 date system, as xlrd counts it
+excel_epoch = datetime.datetime(1899, 12, 30)
+
+# Fields of delimited text are kept as text, as codes such as 00123 must be.
+# A handler declares the columns it reads as numbers with a third element,
+# e.g. ('level', 0, NUMBER), and those fields are read as floats as xlrd
+# reads a number cell. Workbook cells carry their own type
+NUMBER = 'number'
+
+# Text that Excel would turn into a number cell when opening a CSV
+csv_number = re.compile(r"^\s*[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?\s*$")
+
+########################################################################################
+#
+#     Class definitions
+#
+########################################################################################
+
+class SheetError(Exception):
+
+    """The source sheet does not have the columns a handler reads"""
+
+class RowReader:
+
+    """Turns the values of a source row into a compact record of the declared columns"""
+
+    def __init__(self, filename, columns, start_row):
+
+        # columns is a list of (name, offset) pairs, or (name, offset, NUMBER)
+        # for a numeric column. An offset is the column number, or a slice for
+        # a run of columns such as the attribute columns of a specification
+        # template
+
+        self.filename = filename
+        self.columns = [(column[0], column[1]) for column in columns]
+        self.numeric = [column[1] for column in columns if column[2:] == (NUMBER,)]
+        self.start_row = start_row
+        self.record = record_type([name for (name, offset) in self.columns])
+        self.width = max([offset + 1 for (name, offset) in self.columns if isinstance(offset, int)] + [0])
+        self.header = []
+
+    def check_width(self, ncols):
+
+        # Offsets are checked once here rather than on every cell access
+        if ncols < self.width:
+            raise SheetError("%s has %d columns, at least %d are required" % (self.filename, ncols, self.width))
+
+    def make_record(self, values):
+
+        record = self.record()
+        for (name, offset) in self.columns:
+            setattr(record, name, values[offset])
+        return record
+
+    def record_values(self, record):
+
+        # The values of a record in column order, as they are kept in the row cache
+        return tuple([getattr(record, name) for (name, offset) in self.columns])
+
+    def load_record(self, values):
+
+        record = self.record()
+        for ((name, offset), value) in zip(self.columns, values):
+            setattr(record, name, value)
+        return record
+
+class SheetReader(RowReader):
+
+    """Data rows of the first sheet of a workbook, read a whole row at a time into compact records"""
+
+    def __init__(self, filename, columns, start_row=1):
+
+        RowReader.__init__(self, filename, columns, start_row)
+
+        # Only the first sheet is loaded. The workbook image is released as soon
+        # as it has been parsed, the loaded sheet remains usable
+        self.book = xlrd.open_workbook(filename, on_demand=True)
+        self.sheet = self.book.sheet_by_index(0)
+        self.book.release_resources()
+
+        if self.sheet.nrows:
+            self.header = self.sheet.row_values(0)
+
+        if len(self):
+            self.check_width(self.sheet.ncols)
+
+    def __len__(self):
+
+        if self.sheet is None:
+            return 0
+        return max(self.sheet.nrows - self.start_row, 0)
+
+    def __iter__(self):
+
+        for i in range(self.start_row, self.start_row + len(self)):
+            yield self.make_record(self.sheet.row_values(i))
+
+    def close(self):
+
+        # Drop the sheet, e.g. before waiting on MEA
+        self.sheet = None
+        self.book = None
+
+class XlsxReader(RowReader):
+
+    """Data rows of the first sheet of an .xlsx workbook, streamed in read-only mode so that memory use does not grow with the sheet"""
+
+    def __init__(self, filename, columns, start_row=1):
+
+        RowReader.__init__(self, filename, columns, start_row)
+
+        if openpyxl is None:
+            raise SheetError("%s is an .xlsx workbook, reading it needs the openpyxl module" % (filename))
+
+        # As for CSV, the workbook is opened afresh on every pass over the rows
+        for (i, values, ncols) in self.read_rows():
+            if values:
+                self.check_width(ncols)
+            self.header = values
+            break
+
+    def __iter__(self):
+
+        for (i, values, ncols) in self.read_rows():
+            if i < self.start_row:
+                continue
+            if len(values) < ncols:
+                values.extend([u''] * (ncols - len(values)))   # Short rows are padded, as xlrd pads them
+            yield self.make_record(values)
+
+    def read_rows(self):
+
+        # Yield (row number, values, sheet width) for each row up to the last
+        # that has a value. Empty rows within the sheet are yielded as empty
+        # values, as xlrd gives them, and trailing ones are dropped, as xlrd
+        # drops them. Only the row being read and the number of empty rows
+        # since the last value are held in memory
+
+        if not os.path.exists(self.filename):
+            raise IOError("No such file: %s" % (self.filename))
+
+        book = openpyxl.load_workbook(self.filename, read_only=True, data_only=True)
+        try:
+            sheet = book.worksheets[0]
+            ncols = None
+            blank = 0   # Empty rows not yet yielded
+            for (i, row) in enumerate(sheet.iter_rows()):
+                raw = [cell.value for cell in row]
+                if ncols is None:
+                    ncols = max(sheet.max_column or 0, len(raw), self.width)
+                if not [value for value in raw if value is not None]:
+                    blank += 1
+                    continue
+                for j in range(i - blank, i):
+                    yield (j, [], ncols)
+                blank = 0
+                yield (i, [xlsx_value(value) for value in raw], ncols)
+        finally:
+            if hasattr(book, 'close'):
+                book.close()
+
+    def close(self):
+
+        # Nothing is held between passes
+        pass
+
+class CsvReader(RowReader):
+
+    """Data rows of a delimited text file, parsed a line at a time so that memory use does not grow with the file"""
+
+    def __init__(self, filename, columns, start_row=1, delimiter=','):
+
+        RowReader.__init__(self, filename, columns, start_row)
+        self.delimiter = delimiter
+
+        # The header is read on its own, and the file is parsed afresh on
+        # every pass over the rows
+        fh = open(filename, 'rb')
+        try:
+            for values in csv.reader(fh, delimiter=delimiter):
+                self.header = [csv_value(value) for value in values]
+                break
+        finally:
+            fh.close()
+
+        if self.header:
+            self.check_width(len(self.header))
+
+    def __iter__(self):
+
+        ncols = max(self.width, len(self.header))
+        fh = open(self.filename, 'rb')
+        try:
+            for (i, values) in enumerate(csv.reader(fh, delimiter=self.delimiter)):
+                if i < self.start_row or not values:   # Skip the header and blank lines
+                    continue
+                values = [csv_value(value) for value in values]
+                if len(values) < ncols:
+                    values.extend([u''] * (ncols - len(values)))   # Short rows are padded, as xlrd pads them
+                for offset in self.numeric:
+                    if isinstance(offset, slice):
+                        values[offset] = [csv_number_value(value) for value in values[offset]]
+                    else:
+                        values[offset] = csv_number_value(values[offset])
+                yield self.make_record(values)
+        finally:
+            fh.close()
+
+    def close(self):
+
+        # Nothing is held between passes
+        pass
+
+class CachedReader(RowReader):
+
+    """Records of a source file served from the row cache, without parsing the file"""
+
+    def __init__(self, filename, columns, start_row, header, rows):
+
+        RowReader.__init__(self, filename, columns, start_row)
+        self.header = header
+        self.rows = rows
+
+    def __len__(self):
+
+        if self.rows is None:
+            return 0
+        return len(self.rows)
+
+    def __iter__(self):
+
+        for values in self.rows:
+            yield self.load_record(values)
+
+    def close(self):
+
+        self.rows = None
+
+class CachingReader:
+
+    """Passes the records of a reader through, and caches them once a pass has read the whole file"""
+
+    def __init__(self, reader, row_cache, path, logger):
+
+        self.reader = reader
+        self.row_cache = row_cache
+        self.path = path
+        self.logger = logger
+        self.header = reader.header
+        self.cached = False     # A whole pass has been read, whether or not its rows were cached
+
+    def __iter__(self):
+
+        if self.cached:
+            for record in self.reader:
+                yield record
+            return
+
+        # The rows are only held while they fit in the cache. A file that
+        # outgrows it is streamed on, with memory use as flat as uncached
+        rows = []
+        size = 0
+        for record in self.reader:
+            if rows is not None:
+                values = self.reader.record_values(record)
+                row_size = self.row_cache.row_size(values)
+                if row_size is None:
+                    self.logger.debug("Rows of %s cannot be cached" % (self.reader.filename))
+                    rows = None
+                elif size + row_size > self.row_cache.max_bytes:
+                    self.logger.debug("%s is too large for the row cache" % (self.reader.filename))
+                    rows = None
+                else:
+                    rows.append(values)
+                    size += row_size
+            yield record
+        if rows is not None:
+            self.row_cache.store(self.path, self.header, rows, self.logger)
+        self.cached = True
+
+    def close(self):
+
+        self.reader.close()
+
+########################################################################################
+#
+#     Functions
+#
+########################################################################################
+
+def record_type(names):
+
+    # A record class with one slot per column, so that rows carry no per-instance dict
+
+    return type('SheetRecord', (object,), {'__slots__': tuple(names)})
+
+def csv_value(text):
+
+    # A CSV field as unicode text
+
+    if text.startswith('\xef\xbb\xbf'):   # Byte order mark on the first field
+        text = text[3:]
+    return text.decode(csv_encoding)
+
+def csv_number_value(text):
+
+    # A field of a numeric column as the float xlrd gives a number cell. Text
+    # that is not a number is left for the handler to reject
+
+    if csv_number.match(text):
+        return float(text)
+    return text
+
+def xlsx_value(value):
+
+    # Give a cell the value xlrd gives the same cell of an .xls, so that the
+    # handlers' number checks work alike: numbers and dates as floats, booleans
+    # as 0 or 1, empty cells as empty text
+
+    if value is None:
+        return u''
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (int, long)):
+        return float(value)
+    if isinstance(value, datetime.datetime):
+        delta = value - excel_epoch
+        return delta.days + delta.seconds / 86400.0
+    if isinstance(value, datetime.date):
+        return float((value - excel_epoch.date()).days)
+    if isinstance(value, datetime.time):
+        return (value.hour * 3600 + value.minute * 60 + value.second) / 86400.0
+    return value
+
+def file_source_type(filename):
+
+    # The source type of a file named in a stage file, by its extension
+
+    if os.path.splitext(filename)[1].lower() in csv_extensions:
+        return 'CSV'
+    return 'XLS'
+
+def open_reader(er, columns, start_row):
+
+    # A reader for the type of the source file
+
+    if er.source_type == 'CSV':
+        if os.path.splitext(er.source_xlsfile)[1].lower() in tsv_extensions:
+            delimiter = '\t'
+        else:
+            delimiter = ','
+        return CsvReader(er.source_xlsfile, columns, start_row, delimiter)
+    if os.path.splitext(er.source_xlsfile)[1].lower() in xlsx_extensions:
+        return XlsxReader(er.source_xlsfile, columns, start_row)
+    return SheetReader(er.source_xlsfile, columns, start_row)
+
+def open_sheet(er, columns, start_row=1):
+
+    # Open the source file of a run, from the row cache if the same file has
+    # been read for this entity type before. Failures are reported the way the
+    # handlers always have, and None is returned
+
+    try:
+        if er.row_cache is None:
+            return open_reader(er, columns, start_row)
+
+        path = er.row_cache.path(er.source_xlsfile, er.entity_type, columns, start_row)
+        cached = er.row_cache.load(path, er.logger)
+        if cached is not None:
+            (header, rows) = cached
+            er.logger.info("Read %d rows of %s from the row cache" % (len(rows), er.source_xlsfile))
+            return CachedReader(er.source_xlsfile, columns, start_row, header, rows)
+
+        return CachingReader(open_reader(er, columns, start_row), er.row_cache, path, er.logger)
+    except IOError:
+        print("ERROR: Unable to open %s" % (er.source_xlsfile))
+        er.logger.error("Unable to open %s" % (er.source_xlsfile))
+    except SheetError, e:
+        print("ERROR: %s" % (e))
+        er.logger.error("%s" % (e))
+
+    return None
+
+def prefetch_sheet(er, columns, start_row=1):
+
+    # Parse the source file of a run into the row cache ahead of the run, so
+    # that its open_sheet is served from the cache. A file too large for the
+    # cache is read through without holding its rows. Errors are raised
+    # rather than reported, the run itself reports them when it opens the
+    # file. Returns False if there was nothing to do
+
+    if er.row_cache is None:
+        return False
+
+    path = er.row_cache.path(er.source_xlsfile, er.entity_type, columns, start_row)
+    if er.row_cache.has(path):
+        return False
+
+    rows = CachingReader(open_reader(er, columns, start_row), er.row_cache, path, er.logger)
+    for row in rows:
+        pass
+    rows.close()
+
+    return True
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+#
+# MEA Lightweight Integration Environment
+#
+# Classspec metadata cache for the item specification handlers. A classification
+# template repeats the same (classstructureid, assetattrid) pairs on thousands of
+# rows, so their datatype, sequences and measure unit are read once per run
+#
+
+########################################################################################
+#
+#     Import required modules
+#
+########################################################################################
+
+from common import cell_key
+
+########################################################################################
+#
+#     Globals
+#
+########################################################################################
+
+# Oracle allows at most 1000 expressions in an IN list
+classid_chunk_size = 1000
+
+# Positions within a cached classspec entry
+SPEC_DATATYPE = 0
+SPEC_ASSETSEQUENCE = 1
+SPEC_ITEMSEQUENCE = 2
+SPEC_MEASUREUNITID = 3
+
+########################################################################################
+#
+#     Class definitions
+#
+########################################################################################
+
+class ClassSpecCache:
+
+    """Datatype, sequences and measure unit of the classspecs used by a run"""
+
+    def __init__(self, c, logger):
+
+        self.c = c
+        self.logger = logger
+        self.specs = {}        # (classstructureid, assetattrid) -> entry, None if no classspec
+
+        self.q_get_specs = """
+        SELECT c.classstructureid, c.assetattrid, a.datatype, c.assetsequence, c.itemsequence, c.measureunitid
+        FROM classspec c
+        LEFT JOIN assetattribute a ON a.assetattrid = c.assetattrid
+        WHERE c.classstructureid IN (%s)"""
+
+        self.q_get_spec = """
+        SELECT c.classstructureid, c.assetattrid, a.datatype, c.assetsequence, c.itemsequence, c.measureunitid
+        FROM classspec c
+        LEFT JOIN assetattribute a ON a.assetattrid = c.assetattrid
+        WHERE c.classstructureid = :classstructureid
+        AND c.assetattrid = :assetattrid"""
+
+    def preload(self, classids):
+
+        # Read every classspec of the classifications in the sheet, one
+        # query per chunk of classstructureids. Numeric cells arrive as floats,
+        # so the binds and the keys are the text Oracle gives
+
+        classids = list(set([cell_key(classid) for classid in classids if classid != ""]))
+        self.c.arraysize = classid_chunk_size
+
+        for start in range(0, len(classids), classid_chunk_size):
+            chunk = classids[start:start + classid_chunk_size]
+            binds = dict(("k%d" % i, key) for i, key in enumerate(chunk))
+            placeholders = ", ".join([":k%d" % i for i in range(len(chunk))])
+            self.c.execute(self.q_get_specs % (placeholders), binds)
+            for row in self.c.fetchall():
+                self.specs.setdefault((cell_key(row[0]), row[1]), row[2:])
+
+        self.logger.debug("Loaded %d classspecs for %d classifications" % (len(self.specs), len(classids)))
+
+    def get(self, cls, attr):
+
+        # A pair missed by the preload is read on its own and remembered,
+        # including the fact that it does not exist
+
+        key = (cell_key(cls), attr)
+        if key not in self.specs:
+            self.c.execute(self.q_get_spec, classstructureid=key[0], assetattrid=attr)
+            row = self.c.fetchone()
+            if row == None:
+                self.specs[key] = None
+            else:
+                self.specs[key] = row[2:]
+            self.logger.debug("Classspec %s %s looked up: %s" % (cls, attr, self.specs[key]))
+
+        return self.specs[key]
+
+    def set_datatype(self, attr, datatype):
+
+        # Keep the cache in step when a handler changes an attribute's datatype
+        for key, spec in self.specs.items():
+            if key[1] == attr and spec != None:
+                self.specs[key] = (datatype,) + tuple(spec[1:])
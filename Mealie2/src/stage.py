@@ -45,155 +45,406 @@
 #
 ########################################################################################
 
+import os
 import re
+import sys
 import logging
+import threading
+import Queue
+
+import cx_Oracle
 
 import launcher
-from entities.assetspecs import asp_handler
-from entities.assets import ass_handler
-from entities.commodities import com_handler
-from entities.itemcomm import icg_handler
-from entities.locations import loc_handler
-from entities.measureunits import uom_handler
-from entities.unspscdict import und_handler
-from entities.classifdict import classif_handler
-from entities.Specifications import class_handler
-from entities.AttributeSpec import Attribute_handler
-from entities.ItemSpec2 import isp_handler
-from entities.item import item_handler
-from entities.InvBalance import invbalance_handler
-from entities.Inventory import inventory_handler
-from entities.ItemSpec3 import isp_handler
-from entities.PoFind import po_handler
-from entities.Items_Tools import ToolItem_handler
-from entities.Specifications_ClassIDComm import classcomm_handler
-from entities.Commodities_ClassIDComm import CommComm_handler
+from connpool import ConnectionPool
+from registry import KeyRegistry
+from rowcache import RowCache, default_rows_max_mb, default_rows_max_files
+from sheets import file_source_type, prefetch_sheet
+from refcache import reference_cache
+from handlers import is_entity_type, get_handler, HandlerError
 
 ########################################################################################
 #
-#     Class definitions
+#     Globals
 #
 ########################################################################################
 
+# A stage record is ENTITY:mode:file, optionally followed by :declarations, e.g.
+#
+#     LOC:u:locations.xls
+#     UOM:u:units.xls:after=
+#     ASP:u:pumps.xls:after=LOC group=specs
+#     ASP:u:motors.xls:after=LOC group=specs
+#     ASS:u:assets.xls:after=LOC,specs
+#
+# after= lists the entity types or groups of earlier records that must have
+# completed before this one starts. An empty after= lets a record start at once.
+# A record without after= follows the record before it, so a stage file without
+# declarations runs strictly in sequence as it always has
+stage_declarations = ['after', 'group']
+
+LOG_FORMAT = "%(asctime)-15s %(module)-10s %(levelname)-5s %(message)s"
+
+# While entries run, the source files of this many of the entries due next are
+# parsed into the row cache in the background
+prefetch_depth = 2
+
+# Seconds the stage waits for an entry to complete before waiting again. The
+# wait is repeated rather than unbounded so that it stays interruptible
+result_wait = 60
+
+# Reference data each entity type validates against, warmed by the prefetcher
+prefetch_references = {
+    "LOC": ['orgids', 'depts', 'systemids'],
+    "ASS": ['orgids']
+}
 
 ########################################################################################
 #
-#     Functions
+#     Class definitions
 #
 ########################################################################################
 
-def stage_handler(sb):
-
-    action_handler = {
-        "ASP": asp_handler,
-        "ASS": ass_handler,
-        "COM": com_handler,
-        "ICG": icg_handler,
-        "LOC": loc_handler,
-        "UND": und_handler,
-        "UOM": uom_handler,
-        "ISP3": isp_handler,
-        "ISP2": isp_handler,
-        "CLD": classif_handler,
-        "SPE": class_handler,
-        "ATTR": Attribute_handler,
-        "ITEM": item_handler,
-        "INVB": invbalance_handler,
-        "INV": inventory_handler,
-        "POF": po_handler,
-        "TOOL": ToolItem_handler,
-        "CLCO": classcomm_handler
-    }
+class StageError(Exception):
 
-    # Prompt user for target password, if specified
+    """A stage file record that cannot be processed"""
 
-    if (not sb.target_pwd):
-        sb.target_pwd = str(raw_input("Enter password for %s@%s: " % (sb.target_user, sb.target_db)))
+class StageEntry:
 
-    mealie_logger = logging.getLogger('MealieLogger')
-    mealie_logger.setLevel(sb.log_severity)
+    """Class to represent one record of a stage file"""
 
-    # Fixed values for batches
-    source_type = 'XLS'
-    mea_wait_interval = 180 
+    def __init__(self, line_no, entity_type, mode, source_xlsfile, after, group):
 
-    # Open stage file
+        self.line_no = line_no
+        self.entity_type = entity_type
+        self.mode = mode
+        self.source_xlsfile = source_xlsfile
+        self.after = after      # Names this entry waits for, None to follow the previous entry
+        self.group = group
+        self.depends = set()    # Line numbers of the entries this one waits for
+        self.log_file = None
+        self.started = False
+        self.prefetched = False
 
-    stg_fh = open(sb.stage_file, 'r')
+    def is_named(self, name):
 
-    regexp = re.compile(r"^#")
+        return name == self.entity_type or name == self.group
+
+class StagePrefetcher:
+
+    """Background worker that reads ahead of the stage. It parses the source files of entries due next into the row cache and warms the reference data they validate against, while the running entries wait on MEA"""
+
+    def __init__(self, entry_run, pool, logger):
+
+        self.entry_run = entry_run   # Builds the EntityRun of an entry
+        self.pool = pool
+        self.logger = logger
+        self.requests = Queue.Queue()
+        self.closed = False
 
-    for stg_rec in stg_fh:
+        self.thread = threading.Thread(target=self.work)
+        self.thread.daemon = True
+        self.thread.start()
 
-        if not regexp.search(stg_rec): # Ignore comment
+    def request(self, entry):
 
-            if len(stg_rec.rstrip()):   # Ignore blank line
+        entry.prefetched = True
+        self.requests.put(entry)
 
-                # print stg_rec.rstrip().split(':') # Chomp and parse single stage record
-                (entity_type, mode, source_xlsfile) = stg_rec.rstrip().split(':')
+    def close(self):
 
-                # Construct log filename from data filename
-                log_file = source_xlsfile.split('.')[0] + '.log'
+        # Requests not yet started are dropped. One under way is allowed to
+        # finish, as it may be using a session of the pool
+        self.closed = True
+        self.requests.put(None)
+        self.thread.join()
 
+    def work(self):
 
-                fh = logging.FileHandler(log_file)
-                fh.setLevel(sb.log_severity)
+        while True:
+            entry = self.requests.get()
+            if entry is None:
+                return
+            if self.closed or entry.started:   # No point once the entry is reading the file itself
+                continue
 
-                LOG_FORMAT = "%(asctime)-15s %(module)-10s %(levelname)-5s %(message)s"
-                formatter = logging.Formatter(LOG_FORMAT)
-                fh.setFormatter(formatter)
+            # Anything that goes wrong here is reported by the entry when it runs
+            try:
+                self.prefetch(entry)
+            except Exception, e:
+                self.logger.debug("Unable to prefetch %s file %s: %s" % (entry.entity_type, entry.source_xlsfile, e))
 
-                mealie_logger.addHandler(fh)
+    def prefetch(self, entry):
 
-                # Set mode
-                if (mode == 'f'):
-                    full_mode = True
-                else:
-                    full_mode = False
-                if (mode == 'u'):
-                    normal_mode = True
-                else:
-                    normal_mode = False
-                if (mode == 't'):
-                    test_mode = True
-                else:
-                    test_mode = False
+        er = self.entry_run(entry, self.logger, None)
 
-                if not (full_mode or test_mode or normal_mode):
-                    print("ERROR: Cannot process unknown mode \'%s\' for %s file %s" % (mode, entity_type, source_xlsfile))
-                    mealie_logger.error("Cannot process unknown mode \'%s\' for %s file %s" % (mode, entity_type, source_xlsfile))
-                    return False
+        handler = get_handler(entry.entity_type, self.logger)   # The handler is imported here rather than by the entry
+        columns = getattr(sys.modules[handler.__module__], 'sheet_columns', None)   # The layout the handler will open the file with
+        if columns is not None and prefetch_sheet(er, columns):
+            self.logger.info("Prefetched %s file %s" % (entry.entity_type, entry.source_xlsfile))
 
-                er = launcher.EntityRun(log_file, sb.log_severity, mealie_logger,
-                                                       None, None, None,
-                                                       source_xlsfile,
-                                                       source_type,
-                                                       sb.target_db, sb.target_user, sb.target_pwd,
-                                                       entity_type, None, None,
-                                                       mea_wait_interval,
-                                                       normal_mode, test_mode, full_mode)
+        references = prefetch_references.get(entry.entity_type, [])
+        if references:
+            conn = self.pool.acquire(self.logger)
+            try:
+                for name in references:
+                    reference_cache.get(name, conn, er)
+            finally:
+                conn.close()
+            self.logger.debug("Warmed %s reference data for %s" % (", ".join(references), entry.source_xlsfile))
 
-                print("Processing %s file %s" % (er.entity_type, er.source_xlsfile))
-                mealie_logger.info("Processing %s file %s" % (er.entity_type, er.source_xlsfile))
+########################################################################################
+#
+#     Functions
+#
+########################################################################################
+
+def read_stage_file(stage_file):
+
+    # Parse and check every record before any entry is run, so that a bad
+    # record aborts the stage before anything is loaded
+
+    entries = []
+    regexp = re.compile(r"^#")
+
+    stg_fh = open(stage_file, 'r')
+
+    for (line_no, stg_rec) in enumerate(stg_fh):
 
-                # Call appropriate handler for the entity
-                handler = action_handler.get(er.entity_type)
-                if (handler == None):
-                    print("ERROR: Cannot process unknown entity type \'%s\' for file %s" % (entity_type, source_xlsfile))
-                    mealie_logger.error("Cannot process unknown entity type \'%s\' for file %s" % (entity_type, source_xlsfile))
-                    return False
-                else:
-                    rs = handler(er)
+        if regexp.search(stg_rec) or not len(stg_rec.rstrip()):   # Ignore comment and blank line
+            continue
 
-                mealie_logger.removeHandler(fh)
+        fields = stg_rec.rstrip().split(':')
+        if len(fields) == 3:
+            fields.append('')
+        if len(fields) != 4:
+            stg_fh.close()
+            raise StageError("Cannot process stage record \'%s\'" % (stg_rec.rstrip()))
+        (entity_type, mode, source_xlsfile, declarations) = fields
 
-                if not (rs):
-                    return False  # Abort the stage if an error occurs
+        if mode not in ['f', 'u', 't']:
+            stg_fh.close()
+            raise StageError("Cannot process unknown mode \'%s\' for %s file %s" % (mode, entity_type, source_xlsfile))
 
-                # Record processing ends
+        if not is_entity_type(entity_type):
+            stg_fh.close()
+            raise StageError("Cannot process unknown entity type \'%s\' for file %s" % (entity_type, source_xlsfile))
+
+        after = None
+        group = None
+        for declaration in declarations.split():
+            (name, _sep, value) = declaration.partition('=')
+            if name not in stage_declarations:
+                stg_fh.close()
+                raise StageError("Cannot process unknown declaration \'%s\' for %s file %s" % (declaration, entity_type, source_xlsfile))
+            if name == 'after':
+                after = [dep for dep in value.split(',') if dep]
+            else:
+                group = value
+
+        entries.append(StageEntry(line_no + 1, entity_type, mode, source_xlsfile, after, group))
 
     stg_fh.close()
 
-    return True
+    # Dependencies can only name earlier entries, so the stage is always acyclic
+
+    for (i, entry) in enumerate(entries):
+        if entry.after is None:
+            if i > 0:
+                entry.depends.add(entries[i - 1].line_no)
+            continue
+        for name in entry.after:
+            named = [earlier.line_no for earlier in entries[:i] if earlier.is_named(name)]
+            if not named:
+                raise StageError("after=%s for %s file %s does not name an earlier stage record" % (name, entry.entity_type, entry.source_xlsfile))
+            entry.depends.update(named)
+
+    # Each entry logs to its data filename with a .log extension. Entries whose
+    # data files would share a log add their line number and mode to the name
+
+    log_bases = {}
+    for entry in entries:
+        base = os.path.splitext(entry.source_xlsfile)[0]
+        log_bases[base] = log_bases.get(base, 0) + 1
+
+    for entry in entries:
+        base = os.path.splitext(entry.source_xlsfile)[0]
+        if log_bases[base] > 1:
+            entry.log_file = "%s.%d.%s.log" % (base, entry.line_no, entry.mode)
+        else:
+            entry.log_file = base + '.log'
+
+    return entries
+
+def run_entries(entries, workers, run_entry, logger, prefetcher=None):
+
+    # Run each entry once everything it depends on has completed, at most
+    # workers at a time. After a failure no further entry is started, the
+    # entries already running are allowed to finish. The prefetcher, if any,
+    # reads ahead for the entries due next
+
+    results = Queue.Queue()
+    pending = list(entries)
+    running = 0
+    completed = set()
+    failed = False
+
+    def worker(entry):
+
+        # An entry that raises has failed. Its result is still posted, as the
+        # stage waits for every entry it started
+        rs = False
+        try:
+            rs = run_entry(entry)
+        finally:
+            results.put((entry, rs))
+
+    while pending or running:
+
+        if not failed:
+            for entry in list(pending):
+                if running >= workers:
+                    break
+                if entry.depends <= completed:
+                    pending.remove(entry)
+                    running += 1
+                    entry.started = True
+                    thread = threading.Thread(target=worker, args=(entry,))
+                    thread.daemon = True
+                    thread.start()
+
+            if prefetcher is not None:
+                for entry in pending[:prefetch_depth]:
+                    if not entry.prefetched:
+                        prefetcher.request(entry)
+
+        if not running:
+            break
+
+        # Entries may run for longer than any one wait
+        while True:
+            try:
+                (entry, rs) = results.get(True, result_wait)
+                break
+            except Queue.Empty:
+                pass
+        running -= 1
+
+        if rs:
+            completed.add(entry.line_no)
+        else:
+            failed = True
+
+    if failed and pending:
+        print("ERROR: Stage aborted, %d entries were not run" % (len(pending)))
+        logger.error("Stage aborted, %d entries were not run" % (len(pending)))
+
+    return not failed
+
+def stage_handler(sb, pool=None):
+
+    # pool is a ConnectionPool to the target owned by the caller, e.g. the
+    # daemon. Without one the stage opens and closes a pool of its own
+
+    # Prompt user for target password, if specified
+
+    if (not sb.target_pwd):
+        sb.target_pwd = str(raw_input("Enter password for %s@%s: " % (sb.target_user, sb.target_db)))
 
+    mealie_logger = logging.getLogger('MealieLogger')
+    mealie_logger.setLevel(sb.log_severity)
 
+    # Fixed values for batches
+    cache_dir = None
+    cache_ttl = 3600
+    row_cache = RowCache(cache_dir, default_rows_max_mb, default_rows_max_files)
+
+    # Keys loaded by one entry are skipped by the later entries of the stage
+    registry = KeyRegistry(cache_dir)
+
+    # Read stage file
+
+    try:
+        entries = read_stage_file(sb.stage_file)
+    except StageError, e:
+        print("ERROR: %s" % (e))
+        mealie_logger.error("%s" % (e))
+        registry.close()
+        return False
+
+    # The stage logs in once. Entries borrow a session from the pool and
+    # return it when they close their connection
+
+    own_pool = pool is None
+    if (own_pool):
+        try:
+            pool = ConnectionPool(sb.target_user, sb.target_pwd, sb.target_db, sb.pool_min, sb.pool_max, mealie_logger)
+        except cx_Oracle.DatabaseError, exc:
+            error, = exc.args
+            print("ERROR: %s" % (error.message))
+            mealie_logger.error("%s" % (error.message))
+            registry.close()
+            return False
+
+    def entry_run(entry, logger, entry_registry):
+
+        source_type = file_source_type(entry.source_xlsfile)   # A .csv or .tsv file is read as CSV, anything else as a spreadsheet
+
+        return launcher.EntityRun(entry.log_file, sb.log_severity, logger,
+                                  None, None, None,
+                                  entry.source_xlsfile,
+                                  source_type,
+                                  sb.target_db, sb.target_user, sb.target_pwd,
+                                  entry.entity_type, None, None,
+                                  sb.mea_wait_interval, sb.mea_wait_deadline, sb.batch_size,
+                                  cache_dir, cache_ttl, entry_registry, row_cache, pool,
+                                  entry.mode == 'u', entry.mode == 't', entry.mode == 'f')
+
+    def run_entry(entry):
+
+        # Entries may run at the same time, so each logs through a logger of
+        # its own and sees the registry through a view of its own
+
+        entry_logger = logging.getLogger('MealieLogger.%d' % (entry.line_no))
+        entry_logger.setLevel(sb.log_severity)
+
+        er = entry_run(entry, entry_logger, registry.entry())
+
+        fh = logging.FileHandler(er.log_file)
+        fh.setLevel(sb.log_severity)
+        fh.setFormatter(logging.Formatter(LOG_FORMAT))
+        entry_logger.addHandler(fh)
+
+        print("Processing %s file %s" % (er.entity_type, er.source_xlsfile))
+        entry_logger.info("Processing %s file %s" % (er.entity_type, er.source_xlsfile))
+
+        # Call appropriate handler for the entity, importing it on first use. A
+        # handler that aborts with sys.exit() fails its entry rather than the worker
+        try:
+            try:
+                rs = get_handler(er.entity_type, entry_logger)(er)
+            except HandlerError, e:
+                print("ERROR: %s" % (e))
+                entry_logger.error("%s" % (e))
+                rs = False
+            except SystemExit:
+                rs = False
+            except Exception:
+                print("ERROR: %s file %s failed: %s" % (er.entity_type, er.source_xlsfile, sys.exc_info()[1]))
+                entry_logger.exception("%s file %s failed" % (er.entity_type, er.source_xlsfile))
+                rs = False
+        finally:
+            entry_logger.removeHandler(fh)
+            fh.close()
+
+        return rs
+
+    prefetcher = StagePrefetcher(entry_run, pool, mealie_logger)
+
+    rs = run_entries(entries, sb.workers, run_entry, mealie_logger, prefetcher)   # Abort the stage if an error occurs
+
+    prefetcher.close()
+    if (own_pool):
+        pool.close()
+    registry.close()
+
+    return rs
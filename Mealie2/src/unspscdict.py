@@ -25,33 +25,49 @@
 ########################################################################################
 
 import cx_Oracle
-import xlrd
 import sys
 import time
 
+from meabatch import MergeWriter
+from sheets import open_sheet
+from connpool import connect_target
+
 ########################################################################################
 #
 #     Class definitions
 #
 ########################################################################################
 
+# Columns of the source spreadsheet read by InterfaceableEntryFromXls
+sheet_columns = [
+    ('segment', 0),
+    ('segment_desc', 1),
+    ('family', 2),
+    ('family_desc', 3),
+    ('classcode', 4),
+    ('classcode_desc', 5),
+    ('commcode', 7),
+    ('commcode_desc', 8),
+    ('definition', 9)
+]
+
 class InterfaceableEntryFromXls:
 
     """Class representing a UNSPSC Dictionary Entity to be inserted from a spreadsheet"""
 
-    def __init__(self, worksheet, i, c, logger):
+    def __init__(self, row, c, logger):
         
         # Values are taken from the UNSPSC Dictionary Template
 
-        self.segment = worksheet.cell(i, 0).value
-        self.segment_desc = worksheet.cell(i, 1).value[:100] # commodities.description is varchar2(100)
-        self.family = worksheet.cell(i, 2).value
-        self.family_desc = worksheet.cell(i, 3).value[:100]
-        self.classcode = worksheet.cell(i, 4).value
-        self.classcode_desc = worksheet.cell(i, 5).value[:100]
-        self.commcode = worksheet.cell(i, 7).value
-        self.commcode_desc = worksheet.cell(i, 8).value[:100]
-        self.definition = worksheet.cell(i, 9).value # At commodity level
+        self.segment = row.segment
+        self.segment_desc = row.segment_desc[:100] # commodities.description is varchar2(100)
+        self.family = row.family
+        self.family_desc = row.family_desc[:100]
+        self.classcode = row.classcode
+        self.classcode_desc = row.classcode_desc[:100]
+        self.commcode = row.commcode
+        self.commcode_desc = row.commcode_desc[:100]
+        self.definition = row.definition # At commodity level
 
         self.errmsg = None
         self.severity = None
@@ -95,31 +111,36 @@ class InterfaceableEntryFromXls:
 #
 ########################################################################################
 
-def write_dict(c, code, codetype, description, definition, logger):
-
-    # Insert row into dictionary
-
-    q_insert_dict = """
-    INSERT INTO maximo.hul_unspsc_dict (
+def get_dict_writer(c, batch_size, logger):
+
+    # Rows are upserted into the dictionary in array-bound chunks
+
+    q_merge_dict = """
+    MERGE INTO maximo.hul_unspsc_dict d
+    USING (SELECT :code code,
+                  :codetype codetype,
+                  UPPER(:description) description,
+                  :definition definition
+           FROM DUAL) s
+    ON (d.code = s.code)
+    WHEN MATCHED THEN UPDATE
+        SET d.codetype = s.codetype, d.description = s.description, d.definition = s.definition
+    WHEN NOT MATCHED THEN INSERT (
                            code,
                            codetype,
                            description,
                            definition
                            )
-    VALUES (:code, :codetype, UPPER(:description), :definition)"""
+        VALUES (s.code, s.codetype, s.description, s.definition)"""
 
-    q_update_dict = """
-    UPDATE maximo.hul_unspsc_dict
-    SET codetype = :codetype, description = UPPER(:description), definition = :definition
-    WHERE code = :code"""
+    return MergeWriter(c, 'maximo.hul_unspsc_dict', ['code'], q_merge_dict, batch_size, logger)
 
-    logger.debug("Inserting dictionary for %d %s %s" % (codetype, code, description))
-    try:
-        c.execute(q_insert_dict, code=code, codetype=codetype, description=description, definition=definition)
-    except cx_Oracle.IntegrityError:
-        logger.debug("Row already exists, attempting update")
-        logger.debug("Updating dictionary for %d %s %s" % (codetype, code, description))
-        c.execute(q_update_dict, code=code, codetype=codetype, description=description, definition=definition)
+def write_dict(dict_writer, code, codetype, description, definition, logger):
+
+    # Merge row into dictionary
+
+    logger.debug("Merging dictionary for %d %s %s" % (codetype, code, description))
+    dict_writer.write(code=code, codetype=codetype, description=description, definition=definition)
 
     return True
 
@@ -127,7 +148,8 @@ def write_dict(c, code, codetype, description, definition, logger):
 def und_handler(er):
 
     type_handler = {
-        "XLS": und_handler_xls_ora
+        "XLS": und_handler_xls_ora,
+        "CSV": und_handler_xls_ora
     }
 
     return type_handler.get(er.source_type)(er)   # Call appropriate handler for the source type
@@ -142,17 +164,13 @@ def und_handler_xls_ora(er):
         er.target_pwd = str(raw_input("Enter password for target %s@%s: " % (er.target_user, er.target_db)))
 
     # Open source spreadsheet
-    try:
-        ifh = xlrd.open_workbook(er.source_xlsfile)
-    except IOError:
-        print("ERROR: Unable to open %s" % (er.source_xlsfile))
-        er.logger.error("Unable to open %s" % (er.source_xlsfile))
+    rows = open_sheet(er, sheet_columns)
+    if rows is None:
         return False
-    wsh = ifh.sheet_by_index(0)
 
     # Connect to target database
     try:
-        conn_target = cx_Oracle.connect("%s/%s@%s" % (er.target_user, er.target_pwd, er.target_db))
+        conn_target = connect_target(er)
     except cx_Oracle.DatabaseError, exc:
         error, = exc.args
         print("ERROR: %s" % (error.message))
@@ -161,10 +179,10 @@ def und_handler_xls_ora(er):
     
     # Open the necessary cursors on target database
     curs_target = conn_target.cursor()
+    dict_writer = get_dict_writer(curs_target, er.batch_size, er.logger)
 
     # Initialise local variables for fetch loop
     total_ct = 0       # Total no. of items
-    start_row = 1      # The first row in spreadsheet that contains data (starting at 0)
     
     prev_segment = None
     prev_family = None
@@ -172,9 +190,9 @@ def und_handler_xls_ora(er):
 
     # Iterate through all rows of data in input spreadsheet
 
-    for this_row in range(start_row, wsh.nrows):
+    for row in rows:
 
-        ie = InterfaceableEntryFromXls(wsh, this_row, curs_target, er.logger)
+        ie = InterfaceableEntryFromXls(row, curs_target, er.logger)
         er.logger.info("Processing %s %s %s %s" % (ie.segment, ie.family, ie.classcode, ie.commcode))
 
         if (ie.is_valid(curs_target, er.logger)):
@@ -184,24 +202,24 @@ def und_handler_xls_ora(er):
 
             # Code type 1 represents Segment level
             if ie.segment != prev_segment:
-                write_dict(curs_target, ie.segment, 1, ie.segment_desc, None, er.logger)
+                write_dict(dict_writer, ie.segment, 1, ie.segment_desc, None, er.logger)
                 total_ct += 1
                 prev_segment = ie.segment
 
             # Code type 2 represents Family level
             if ie.family != prev_family:
-                write_dict(curs_target, ie.family, 2, ie.family_desc, None, er.logger)
+                write_dict(dict_writer, ie.family, 2, ie.family_desc, None, er.logger)
                 total_ct += 1
                 prev_family = ie.family
 
             # Code type 3 represents Class level
             if ie.classcode != prev_classcode:
-                write_dict(curs_target, ie.classcode, 3, ie.classcode_desc, None, er.logger)
+                write_dict(dict_writer, ie.classcode, 3, ie.classcode_desc, None, er.logger)
                 total_ct += 1
                 prev_classcode = ie.classcode
 
             # Code type 4 represents Commodity level
-            write_dict(curs_target, ie.commcode, 4, ie.commcode_desc, ie.definition, er.logger)
+            write_dict(dict_writer, ie.commcode, 4, ie.commcode_desc, ie.definition, er.logger)
             total_ct += 1
                 
         else:
@@ -212,6 +230,9 @@ def und_handler_xls_ora(er):
             conn_target.close()         # Free the connection
             sys.exit(2)
 
+    dict_writer.flush()
+    er.logger.info("Dictionary rows inserted: %d, updated: %d" % (dict_writer.inserted, dict_writer.updated))
+
     # The transaction will not be committed if we are in 'test mode'
     # Otherwise we commit the whole transaction
 